@@ -3,18 +3,22 @@ import streamlit as st
 import os
 import sys
 import datetime
-import shutil
-import glob
 import json
 
 # ============================================================
 #  CONFIG LOADER
 # ============================================================
 
+@st.cache_data(show_spinner=False)
+def _read_config(config_path, mtime_ns):
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 def load_config(config_path="config.json"):
+    # Riletto solo quando il file cambia (mtime), non a ogni rerun
     try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _read_config(config_path, os.stat(config_path).st_mtime_ns)
     except Exception as e:
         st.error(f"Errore nel leggere il file di configurazione: {e}")
         st.stop()
@@ -42,14 +46,21 @@ has_old_new_expert_structure = config.get("has_old_new_expert_structure", False)
 st.sidebar.info(f"Root folder: {root_folder}")
 
 # ============================================================
-#  IMPORT TEST RUNNERS
+#  JOBS
 # ============================================================
 
-sys.path.append(r"C:\_git\CategorizationEnginePython")
-sys.path.append(r"C:\_git\CategorizationEnginePython\CategorizationEngineTests\CETestSuite")
+# Le run girano in processi separati (lambda/jobs.py): un rerun o un refresh della pagina non le interrompe
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda")
+if LAMBDA_DIR not in sys.path:
+    sys.path.append(LAMBDA_DIR)
+import scheduler
+import local_backend
+import jobs
+import report_sidecar
+import dashboard_pipeline
 
-from suite_tests.testRunner import TestRunner
-from suite_tests.testRunner_tagger import TestRunner as TestRunnerTagger
+jobs_db = config.get("jobs_db") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "dashboard_jobs.db")
+job_queue = jobs.get_queue(jobs_db, "dashboard_pipeline:run", max_workers=config.get("dashboard_max_jobs", 2))
 
 
 # ============================================================
@@ -64,86 +75,29 @@ def safe_listdir(path):
         return []
 
 
-def get_batch_dir():
-    """Trova automaticamente la cartella data/batch relativa al TestSuite."""
-    import suite_tests
-    suite_file = getattr(suite_tests, '__file__', None)
-    if suite_file is None:
-        # Fallback: use the sys.path entry where suite_tests was found
-        for p in sys.path:
-            candidate = os.path.join(p, "suite_tests", "data", "batch")
-            if os.path.isdir(candidate):
-                return candidate
-            candidate2 = os.path.join(p, "data", "batch")
-            if os.path.isdir(candidate2):
-                return candidate2
-        st.warning("⚠️ Impossibile determinare la cartella batch automaticamente.")
-        return None
-    suite_root = os.path.dirname(os.path.abspath(suite_file))
-    return os.path.join(suite_root, "data", "batch")
+def fmt_time(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else ""
 
 
-# ============================================================
-#  COPY OUTPUTS
-# ============================================================
+@st.cache_data(show_spinner=False, max_entries=32)
+def _read_model_information(report_path, mtime_ns):
+    # Dal sidecar Parquet del report se presente, senza aprire tutto il workbook
+    return report_sidecar.read_sheet(report_path, "model_information")
+
+
+def read_model_information(report_path):
+    """Sheet model_information del final report, letto una volta per report (path + mtime)."""
+    return _read_model_information(report_path, os.stat(report_path).st_mtime_ns)
 
-def copy_latest_outputs(output_folder: str, segment: str, report_type: str,
-                        country_code: str, model_name: str, date_str: str):
-
-    messages = {
-        "ACC": "Report di Accuracy generato!",
-        "ANOM": "Report di Anomalie generato!",
-        "PREC": "Report di Precision generato!",
-        "STAB": "Report di Stabilità generato!"
-    }
-    suffix_map = {
-        "ACC": "_ACC.xlsx",
-        "ANOM": "_ANOM.xlsx",
-        "PREC": "_PREC.xlsx",
-        "STAB": "_STAB.xlsx"
-    }
-    suffix = suffix_map.get(report_type, "")
-
-    value = "OUT"
-    try:
-        parts = model_name.split("_")
-        idx = parts.index(country_code) + 1
-        if parts[idx] == "1":
-            value = "IN"
-    except Exception:
-        pass
-
-    # Copia report Excel
-    for root, dirs, files in os.walk(output_folder):
-        if root != output_folder:
-            for f in files:
-                if suffix and f.endswith(suffix):
-                    src = os.path.join(root, f)
-                    new_name = f"report_{messages[report_type].split()[2]}_{country_code}_CE_{segment}_{value}_{date_str}.xlsx"
-                    dst = os.path.join(output_folder, new_name)
-                    try:
-                        shutil.copy2(src, dst)
-                        st.success(f"📄 {messages.get(report_type)} → {new_name}")
-                    except Exception as e:
-                        st.warning(f"⚠️ Non riesco a copiare {src}: {e}")
-
-    # Copia batch CSV
-    batch_dir = get_batch_dir()
-    if batch_dir is None:
-        st.warning("⚠️ Cartella batch non trovata, skip copia batch CSV.")
-        return
-    pattern = "*categorized.csv" if segment in ["Consumer", "Business"] else "*tagged.csv"
-    files = glob.glob(os.path.join(batch_dir, pattern))
-
-    if files:
-        latest = max(files, key=os.path.getmtime)
-        new_batch_name = f"{messages[report_type].split()[2]}_{country_code}_CE_{segment}_{value}_{date_str}.csv"
-        dst = os.path.join(output_folder, new_batch_name)
-        try:
-            shutil.copy2(latest, dst)
-            st.info(f"📄 File batch copiato: {new_batch_name}")
-        except Exception as e:
-            st.warning(f"⚠️ Non riesco a copiare {latest}: {e}")
+
+run_history_store = dashboard_pipeline.open_run_history(config)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _read_history(db_mtime_ns, country, segment, last):
+    # Solo il database dello storico: nessun xlsx da aprire
+    runs = run_history_store.runs(country, segment, status="completed", limit=last)
+    return pd.DataFrame(runs), pd.DataFrame(run_history_store.metric_trend(country, segment, last=last))
 
 
 # ============================================================
@@ -154,201 +108,144 @@ st.title("📊 Model Performance Test Suite Dashboard")
 st.header(f"{country} → {segment}")
 
 # ============================================================
-#  PATHS
+#  AZURE BATCH SETTINGS
 # ============================================================
 
-country_path = os.path.join(root_folder, country)
-segment_path = os.path.join(country_path, segment)
+vm_bench = config.get("vm_for_bench", 1)
+vm_dev = config.get("vm_for_dev", 2)
+vm_slots = scheduler.vm_slots(config)
 
-sample_path = os.path.join(segment_path, "sample")
-model_path = os.path.join(segment_path, "model")
+st.sidebar.info(f"VM Benchmark: {vm_bench} | VM Development: {vm_dev}")
+if len(vm_slots) > 1:
+    st.sidebar.info(f"Pool VM: {', '.join(f'{b}/{d}' for b, d in vm_slots)}")
 
-today = datetime.date.today().strftime("%y%m%d")
+# Campioni piccoli sui core locali, il resto su Azure Batch (execution_backend / local_max_rows)
+if config.get("local_max_rows") or config.get("execution_backend") == "local":
+    st.sidebar.info(f"Backend locale: fino a {local_backend.local_workers(config)} processi")
 
 # ============================================================
-#  MODELS & EXPERT RULES
+#  RUN TESTS
 # ============================================================
 
-old_model = config.get("old_model")
-new_model = config.get("new_model")
-
-old_model_path = os.path.join(model_path, "prod", old_model)
-new_model_path = os.path.join(model_path, "develop", new_model)
+job_label = f"{country}/{segment}"
 
-if has_old_new_expert_structure:
-    old_expert_path = os.path.join(model_path, "expertrules", "old", config.get("old_expert_rules"))
-    new_expert_path = os.path.join(model_path, "expertrules", "new", config.get("new_expert_rules"))
-else:
-    old_expert_path = os.path.join(model_path, "expertrules", config.get("old_expert_rules"))
-    new_expert_path = os.path.join(model_path, "expertrules", config.get("new_expert_rules"))
-
-# ============================================================
-#  SAMPLE FILES
-# ============================================================
-
-accuracy_files = sample_files_cfg.get("accuracy", [])
-anomalies_files = sample_files_cfg.get("anomalies", [])
-precision_files = sample_files_cfg.get("precision", [])
-stability_files = sample_files_cfg.get("stability", [])
+if st.button("🚀 Run Tests"):
+    try:
+        job_id = job_queue.submit(config, job_label)
+        st.query_params["job"] = job_id
+        st.success(f"Job {job_id} in coda per {job_label}")
+    except ValueError as e:
+        st.warning(f"⚠️ {e}")
+
+# ============================================================
+#  JOBS
+# ============================================================
+
+recent_jobs = job_queue.store.list(limit=20)
+if recent_jobs:
+    st.subheader("🗂️ Job")
+    st.dataframe(pd.DataFrame([
+        {"job": j["id"], "paese/segmento": j["label"], "stato": j["status"],
+         "creato": fmt_time(j["created"]), "finito": fmt_time(j["finished"])}
+        for j in recent_jobs
+    ]), hide_index=True)
+
+# Il job seguito resta nell'URL (?job=...), quindi dopo un refresh la pagina si ricollega
+job_ids = [j["id"] for j in recent_jobs]
+selected = st.query_params.get("job")
+if selected not in job_ids:
+    selected = next((j["id"] for j in recent_jobs if j["label"] == job_label), None)
+if job_ids:
+    selected = st.selectbox("Job da seguire", job_ids, index=job_ids.index(selected) if selected in job_ids else 0,
+                            format_func=lambda i: f"{i} · {next(j['label'] for j in recent_jobs if j['id'] == i)}")
+    st.query_params["job"] = selected
+
+LOG_LEVELS = {"success": st.success, "info": st.info, "warning": st.warning, "error": st.error}
+
+
+def show_job(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        st.warning(f"⚠️ Job {job_id} non trovato")
+        return
+    stages = job_queue.store.stages(job_id)
+    done = sum(1 for s in stages if s["status"] == jobs.COMPLETED)
+    st.write(f"**{job['label']}** · {job['status']} · creato {fmt_time(job['created'])}")
+    if stages:
+        st.progress(done / len(stages), text=f"{done}/{len(stages)} stage completati")
+        st.dataframe(pd.DataFrame([
+            {"stage": s["stage_id"], "stato": s["status"], "backend": s["detail"].get("backend", ""),
+             "VM": s["detail"].get("vms") or "", "inizio": fmt_time(s["started"]), "fine": fmt_time(s["finished"])}
+            for s in stages
+        ]), hide_index=True)
+
+    # Eventi già filtrati e raggruppati dal job (log_pipeline); l'ultimo progresso come didascalia
+    entries = job_queue.store.logs(job_id, limit=200)
+    latest_progress = next((e for e in reversed(entries) if e.get("kind") == "progress"), None)
+    if latest_progress is not None and job["status"] in jobs.ACTIVE:
+        st.caption(f"⏱️ {latest_progress['message']}")
+    entries = [e for e in entries if e.get("kind") != "progress"]
+    issues = {kind: sum(1 for e in entries if e.get("kind") == kind) for kind in ("vm_busy", "error", "warning")}
+    with st.expander(f"Log · {issues['error']} errori · {issues['warning']} warning · {issues['vm_busy']} VM occupate",
+                     expanded=job["status"] in jobs.ACTIVE):
+        for entry in entries[-50:]:
+            LOG_LEVELS.get(entry["level"], st.info)(entry["message"])
+
+    if job["status"] == jobs.QUEUED:
+        st.info("⏳ In coda...")
+    elif job["status"] == jobs.RUNNING:
+        st.write("⏳ Running tests...")
+        if st.button("⛔ Annulla job"):
+            job_queue.cancel(job_id)
+    elif job["status"] in (jobs.FAILED, jobs.INTERRUPTED):
+        st.error(f"❌ Job {job['status']}: {job['error']}")
+    elif job["status"] == jobs.COMPLETED:
+        st.success("🎉 Tests completed!")
+        celebrated = st.session_state.setdefault("celebrated_jobs", set())
+        if job_id not in celebrated:
+            celebrated.add(job_id)
+            st.balloons()
+        st.info("✅ Esecuzione completata. Puoi chiudere questa scheda e tornare alla dashboard principale.")
+
+        # --- Show model_information ---
+        try:
+            model_info_df = read_model_information(job["result"]["report_path"])
+            st.subheader("📄 Model Information")
+            st.dataframe(model_info_df)
+        except Exception as e:
+            st.warning(f"⚠️ Impossibile leggere lo sheet 'model_information': {e}")
 
-# ============================================================
-#  AZURE BATCH SETTINGS
-# ============================================================
 
-vm_bench = config.get("vm_for_bench", 1)
-vm_dev = config.get("vm_for_dev", 2)
-
-st.sidebar.info(f"VM Benchmark: {vm_bench} | VM Development: {vm_dev}")
-
-azure_batch = True
-
-# ============================================================
-#  VM BUSY DETECTION
-# ============================================================
-
-import logging
-import io
-
-class StreamlitLogHandler(logging.Handler):
-    """Captures log messages and checks for VM busy state."""
-    def __init__(self):
-        super().__init__()
-        self.vm_busy = False
-    
-    def emit(self, record):
-        msg = self.format(record)
-        if "Virtual machine is already running" in msg:
-            self.vm_busy = True
-            st.error("🚫 La macchina virtuale Azure è già in uso! Attendi che l'esecuzione corrente termini o seleziona una VM diversa.")
-
-log_handler = StreamlitLogHandler()
-logging.getLogger().addHandler(log_handler)
-
-# Also capture stdout for subprocess messages
-class VMBusyCapture:
-    def __init__(self, original):
-        self.original = original
-    def write(self, text):
-        if "Virtual machine is already running" in text:
-            st.error("🚫 La macchina virtuale Azure è già in uso! Attendi che l'esecuzione corrente termini o seleziona una VM diversa.")
-        self.original.write(text)
-    def flush(self):
-        self.original.flush()
-
-sys.stdout = VMBusyCapture(sys.stdout)
-sys.stderr = VMBusyCapture(sys.stderr)
+if selected:
+    poll_s = config.get("dashboard_poll_s", 2)
+    if hasattr(st, "fragment"):
+        # Solo questo blocco si aggiorna ogni poll_s secondi
+        st.fragment(run_every=poll_s)(show_job)(selected)
+    else:
+        show_job(selected)
+        st.button("🔄 Aggiorna")
 
 # ============================================================
-#  RUN TESTS
+#  STORICO RUN
 # ============================================================
 
-if st.button("🚀 Run Tests"):
-
-    output_folder = os.path.join(segment_path, output_folder_name)
-    os.makedirs(output_folder, exist_ok=True)
-
-    st.write("⏳ Running tests...")
-
-    runner = TestRunner(
-        old_model_path,
-        new_model_path,
-        output_folder,
-        old_expert_path,
-        new_expert_path
-    )
-
-    # --- Crossvalidation ---
-    runner.compute_crossvalidation_score(
-        old_expert_rules_zip_path=old_expert_path,
-        new_expert_rules_zip_path=new_expert_path,
-        save=True
-    )
-
-    # --- Accuracy ---
-    for i, f in enumerate(accuracy_files, start=1):
-        tag = "A_1" if i == 1 else f"A_{i}"
-        runner.compute_validation_scores(
-            os.path.join(sample_path, f),
-            save=True,
-            tag=tag,
-            azure_batch=azure_batch,
-            azure_batch_vm_path=azure_batch_vm_path,
-            old_expert_rules_zip_path=old_expert_path,
-            new_expert_rules_zip_path=new_expert_path,
-            ServicePrincipal_CertificateThumbprint=ServicePrincipal_CertificateThumbprint,
-            ServicePrincipal_ApplicationId=ServicePrincipal_ApplicationId,
-            vm_for_bench=vm_bench,
-            vm_for_dev=vm_dev
-        )
-        copy_latest_outputs(output_folder, segment, "ACC", country, new_model, today)
-
-    # --- Anomalie ---
-    for f in anomalies_files:
-        runner.compute_validation_scores(
-            os.path.join(sample_path, f),
-            save=True,
-            tag="ANOM",
-            azure_batch=azure_batch,
-            azure_batch_vm_path=azure_batch_vm_path,
-            old_expert_rules_zip_path=old_expert_path,
-            new_expert_rules_zip_path=new_expert_path,
-            ServicePrincipal_CertificateThumbprint=ServicePrincipal_CertificateThumbprint,
-            ServicePrincipal_ApplicationId=ServicePrincipal_ApplicationId,
-            vm_for_bench=vm_bench,
-            vm_for_dev=vm_dev
-        )
-        copy_latest_outputs(output_folder, segment, "ANOM", country, new_model, today)
-
-    # --- Precision ---
-    for f in precision_files:
-        runner.compute_validation_scores(
-            os.path.join(sample_path, f),
-            save=True,
-            tag="PREC",
-            azure_batch=azure_batch,
-            azure_batch_vm_path=azure_batch_vm_path,
-            old_expert_rules_zip_path=old_expert_path,
-            new_expert_rules_zip_path=new_expert_path,
-            ServicePrincipal_CertificateThumbprint=ServicePrincipal_CertificateThumbprint,
-            ServicePrincipal_ApplicationId=ServicePrincipal_ApplicationId,
-            vm_for_bench=vm_bench,
-            vm_for_dev=vm_dev
-        )
-        copy_latest_outputs(output_folder, segment, "PREC", country, new_model, today)
-
-    # --- Stability ---
-    for i, f in enumerate(stability_files, start=1):
-        tag = "S_1" if i == 1 else f"S_{i}"
-        runner.compute_validation_distribution(
-            os.path.join(sample_path, f),
-            save=True,
-            tag=tag,
-            azure_batch=azure_batch,
-            azure_batch_vm_path=azure_batch_vm_path,
-            old_expert_rules_zip_path=old_expert_path,
-            new_expert_rules_zip_path=new_expert_path,
-            ServicePrincipal_CertificateThumbprint=ServicePrincipal_CertificateThumbprint,
-            ServicePrincipal_ApplicationId=ServicePrincipal_ApplicationId,
-            vm_for_bench=vm_bench,
-            vm_for_dev=vm_dev
-        )
-        copy_latest_outputs(output_folder, segment, "STAB", country, new_model, today)
-
-    # --- Save reports ---
-    final = runner.save_reports(weights=None, excel=True, pdf=False)
-
-    st.success("🎉 Tests completed!")
-
-    # Auto-close after a few seconds (Streamlit can't close the tab, but we show a message)
-    st.balloons()
-    st.info("✅ Esecuzione completata. Puoi chiudere questa scheda e tornare alla dashboard principale.")
-
-    # --- Show model_information ---
-    report_path = os.path.join(runner.output_folder, runner.old_uid,
-                               f"{runner.new_uid}_final_report_{runner.now}.xlsx")
-    try:
-        model_info_df = pd.read_excel(report_path, sheet_name="model_information")
-        st.subheader("📄 Model Information")
-        st.dataframe(model_info_df)
-    except Exception as e:
-        st.warning(f"⚠️ Impossibile leggere lo sheet 'model_information': {e}")
+if run_history_store is not None:
+    st.subheader("📈 Storico run")
+    if run_history_store.s3 is not None and st.button("🔄 Sincronizza storico da S3"):
+        st.info(f"{run_history_store.sync(country, segment)} run aggiunte dallo storico S3")
+    history_db = run_history_store.db_path
+    runs_df, metrics_df = _read_history(os.stat(history_db).st_mtime_ns if os.path.exists(history_db) else 0,
+                                        country, segment.lower(), config.get("run_history_last", 20))
+    if runs_df.empty:
+        st.info("Nessuna run registrata per questo paese/segmento")
+    else:
+        runs_df["data"] = pd.to_datetime(runs_df["started"], unit="s")
+        st.dataframe(runs_df[["data", "new_model", "source", "duration_s"]].rename(
+            columns={"new_model": "modello", "source": "origine", "duration_s": "durata (s)"}), hide_index=True)
+        st.line_chart(runs_df.set_index("data")["duration_s"], y_label="durata (s)")
+        if not metrics_df.empty:
+            metrics_df["data"] = pd.to_datetime(metrics_df["started"], unit="s")
+            metric = st.selectbox("Metrica", sorted(metrics_df["metric"].unique()))
+            trend = metrics_df[metrics_df["metric"] == metric].pivot_table(
+                index="data", columns="key", values="development", aggfunc="mean")
+            st.line_chart(trend, y_label=metric)
@@ -0,0 +1,384 @@
+"""
+Test suite run of the dashboard, executed as a background job (lambda/jobs.py).
+
+run(config, progress) is what the "🚀 Run Tests" button used to do inline:
+TestRunner, stages in parallel on the VM pairs (one TestRunner each, see
+lambda/runner_pool.py; on Windows "max_runners" sets how many) or local
+processes, report / batch CSV copies, output manifest and save_reports. It
+runs in its own process and reports through progress (stage states and log
+lines in the job table) instead of Streamlit calls.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import datetime
+import threading
+
+sys.path.append(r"C:\_git\CategorizationEnginePython")
+sys.path.append(r"C:\_git\CategorizationEnginePython\CategorizationEngineTests\CETestSuite")
+
+# Stage list and VM scheduler shared with the Lambda handler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda"))
+import scheduler
+import output_index
+from output_index import OutputIndex
+from batch_area import BatchArea, batch_pattern
+import local_backend
+import score_cache
+import metrics
+import runner_pool
+import output_format
+import report_sidecar
+import vm_lease
+import log_pipeline
+import run_history
+
+logger = logging.getLogger(__name__)
+
+VM_BUSY_MESSAGE = ("🚫 La macchina virtuale Azure è già in uso! Attendi che l'esecuzione corrente termini "
+                   "o seleziona una VM diversa.")
+
+
+# ============================================================
+#  PATHS
+# ============================================================
+
+def resolve_paths(config):
+    """Cartelle e percorsi di modelli / expert rules della config."""
+    segment = config.get("segment").capitalize()  # consumer → Consumer
+    segment_path = os.path.join(config.get("root_folder"), config.get("country"), segment)
+    model_path = os.path.join(segment_path, "model")
+    if config.get("has_old_new_expert_structure", False):
+        old_expert_path = os.path.join(model_path, "expertrules", "old", config.get("old_expert_rules"))
+        new_expert_path = os.path.join(model_path, "expertrules", "new", config.get("new_expert_rules"))
+    else:
+        old_expert_path = os.path.join(model_path, "expertrules", config.get("old_expert_rules"))
+        new_expert_path = os.path.join(model_path, "expertrules", config.get("new_expert_rules"))
+    return dict(
+        segment=segment,
+        segment_path=segment_path,
+        sample_path=os.path.join(segment_path, "sample"),
+        output_folder=os.path.join(segment_path, config.get("output_folder_name")),
+        old_model_path=os.path.join(model_path, "prod", config.get("old_model")),
+        new_model_path=os.path.join(model_path, "develop", config.get("new_model")),
+        old_expert_path=old_expert_path,
+        new_expert_path=new_expert_path,
+    )
+
+
+def get_batch_dir():
+    """Trova automaticamente la cartella data/batch relativa al TestSuite."""
+    import suite_tests
+    suite_file = getattr(suite_tests, '__file__', None)
+    if suite_file is None:
+        # Fallback: use the sys.path entry where suite_tests was found
+        for p in sys.path:
+            candidate = os.path.join(p, "suite_tests", "data", "batch")
+            if os.path.isdir(candidate):
+                return candidate
+            candidate2 = os.path.join(p, "data", "batch")
+            if os.path.isdir(candidate2):
+                return candidate2
+        logger.warning("Impossibile determinare la cartella batch automaticamente.")
+        return None
+    suite_root = os.path.dirname(os.path.abspath(suite_file))
+    return os.path.join(suite_root, "data", "batch")
+
+
+def open_vm_leases(config):
+    """
+    VM leases of the run: local lock files in data/vm_leases (shared by the jobs of this
+    machine) or, with vm_lease_store "s3", the same S3 leases as the Lambda.
+    """
+    s3 = None
+    if config.get("vm_lease_store") == "s3":
+        import boto3
+        s3 = boto3.client("s3")
+    config = dict(config)
+    config.setdefault("vm_lease_store", "local")
+    config.setdefault("vm_lease_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "vm_leases"))
+    return vm_lease.open_leases(config, s3, config.get("s3_bucket"), config.get("s3_prefix", ""),
+                                owner_label=f"dashboard {config.get('country')}/{config.get('segment')}")
+
+
+def open_run_history(config):
+    """
+    Run history of the dashboard: data/run_history.db, plus the S3 run records of the
+    Lambda when run_history_store is "s3" (sync() brings them into the local database).
+    """
+    s3 = None
+    if config.get("run_history_store") == "s3":
+        import boto3
+        s3 = boto3.client("s3")
+    config = dict(config)
+    config.setdefault("run_history_db", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                                                     "run_history.db"))
+    return run_history.open_history(config, s3, config.get("s3_bucket"), config.get("s3_prefix", ""))
+
+
+# ============================================================
+#  COPY OUTPUTS
+# ============================================================
+
+def copy_notifier(report_type, log):
+    """notify di output_index.copy_latest_outputs: i messaggi della copia nel log del job."""
+    message = f"Report di {output_index.REPORTS[report_type][1]} generato!"
+
+    def notify(event, name, error=None):
+        if event == "report":
+            log(f"📄 {message} → {name}", "success")
+        elif event == "batch":
+            log(f"📄 File batch copiato: {name}", "info")
+        elif event == "no_batch":
+            log("⚠️ Nessun CSV batch per questo stage, skip copia batch CSV.", "warning")
+        else:
+            log(f"⚠️ Non riesco a copiare {name}: {error}", "warning")
+    return notify
+
+
+# ============================================================
+#  LOG CAPTURE
+# ============================================================
+
+# Livello nel job log dei tipi di evento di log_pipeline
+EVENT_LEVELS = {"vm_busy": "error", "error": "error", "warning": "warning", "stage_start": "info",
+                "progress": "info"}
+
+
+def job_sink(progress):
+    """Sink di log_pipeline: un batch di eventi → una sola scrittura nella tabella del job."""
+    def sink(events):
+        entries = []
+        for event in events:
+            kind = event["kind"]
+            if kind == "vm_busy":
+                message = VM_BUSY_MESSAGE
+            elif kind == "stage_end":
+                # Gli esiti degli stage sono già nella tabella stages; restano i fallimenti
+                if event.get("outcome") != "failed":
+                    continue
+                message = event["message"]
+            else:
+                message = event["message"]
+            if event.get("count", 1) > 1:
+                message = f"{message} (×{event['count']})"
+            entries.append((event["ts"], EVENT_LEVELS.get(kind, "error"), message, kind))
+        progress.events(entries)
+    return sink
+
+
+_capture_lock = threading.Lock()
+_handler = None          # PipelineHandler installed in this process
+
+
+def install_capture(pipeline):
+    """
+    Root log handler and stdout/stderr capture, installed once per process: a later
+    run only points them at its own pipeline (None detaches), so the wrapper chain
+    never grows. The busy-VM check stays on the writing thread (scheduler.notice).
+    """
+    global _handler
+    with _capture_lock:
+        if _handler is None:
+            _handler = log_pipeline.PipelineHandler(pipeline)
+            logging.getLogger().addHandler(_handler)
+        _handler.pipeline = pipeline
+        for name in ("stdout", "stderr"):
+            stream = getattr(sys, name)
+            if isinstance(stream, log_pipeline.StreamCapture):
+                stream.pipeline = pipeline
+            else:
+                setattr(sys, name, log_pipeline.StreamCapture(stream, name, pipeline, notice=scheduler.notice))
+
+
+# ============================================================
+#  RUN
+# ============================================================
+
+def run(config, progress):
+    """Esegue la test suite della config; restituisce i percorsi dei risultati."""
+    output_folder = resolve_paths(config)["output_folder"]
+    os.makedirs(output_folder, exist_ok=True)
+    # Log grezzo compresso nella cartella di output, eventi a batch nella tabella del job
+    pipeline = log_pipeline.LogPipeline(os.path.join(output_folder, log_pipeline.RAW_LOG_NAME), job_sink(progress),
+                                        flush_s=config.get("log_flush_s", log_pipeline.DEFAULT_FLUSH_S))
+    install_capture(pipeline)
+    try:
+        result = _run(config, progress, pipeline)
+    finally:
+        # Già chiusa da _run se arrivata al manifest; close() è idempotente
+        install_capture(None)
+        pipeline.close()
+    result["log"] = pipeline.summary()
+    return result
+
+
+def _run(config, progress, pipeline):
+    from suite_tests.testRunner import TestRunner
+
+    country = config.get("country")
+    new_model = config.get("new_model")
+    paths = resolve_paths(config)
+    segment, segment_path, sample_path = paths["segment"], paths["segment_path"], paths["sample_path"]
+    output_folder = paths["output_folder"]
+    os.makedirs(output_folder, exist_ok=True)
+    today = datetime.date.today().strftime("%y%m%d")
+    vm_bench = config.get("vm_for_bench", 1)
+    vm_dev = config.get("vm_for_dev", 2)
+
+    progress.log("⏳ Running tests...")
+
+    def make_runner():
+        return TestRunner(
+            paths["old_model_path"],
+            paths["new_model_path"],
+            output_folder,
+            paths["old_expert_path"],
+            paths["new_expert_path"]
+        )
+
+    rss_before = metrics.current_rss_bytes()
+    first_runner = make_runner()
+    rss_after = metrics.current_rss_bytes()
+    # Gli stage girano sui runner del pool; il runner principale raccoglie solo i risultati
+    runner = runner_pool.main_runner(first_runner)
+
+    # Gli stage sul backend locale usano azure_batch=False
+    batch_kwargs = dict(
+        azure_batch=True,
+        azure_batch_vm_path=config.get("azure_batch_vm_path"),
+        old_expert_rules_zip_path=paths["old_expert_path"],
+        new_expert_rules_zip_path=paths["new_expert_path"],
+        ServicePrincipal_CertificateThumbprint=config.get("ServicePrincipal_CertificateThumbprint"),
+        ServicePrincipal_ApplicationId=config.get("ServicePrincipal_ApplicationId"),
+        vm_for_bench=vm_bench,
+        vm_for_dev=vm_dev
+    )
+
+    # Indice dei file prodotti da ogni stage (output_manifest.json)
+    out_index = OutputIndex(output_folder)
+    # CSV batch di questa run, separati da quelli di altre run nella cartella condivisa
+    batch_area = BatchArea(get_batch_dir(), os.path.join(segment_path, "batch"), f"{country}/{segment}")
+
+    # La dashboard usa sempre il TestRunner Consumer, anche per il segmento Tagger:
+    # stessi stage di prima (crossvalidation, accuracy, anomalie, precision, stability)
+    stages = scheduler.build_stages(config, tagger=False)
+    progress.plan([stage["id"] for stage in stages])
+    backends = local_backend.assign_backends(stages, config, sample_path)
+    local = None
+    if local_backend.LOCAL in backends:
+        local = local_backend.LocalBackend(
+            local_backend.runner_spec(False, paths["old_model_path"], paths["new_model_path"], output_folder,
+                                      paths["old_expert_path"], paths["new_expert_path"]),
+            min(local_backend.local_workers(config), len(backends[local_backend.LOCAL])),
+        )
+        progress.log(f"🖥️ Stage in locale: {', '.join(backends[local_backend.LOCAL])}")
+    # Un TestRunner per ogni stage in esecuzione nello stesso momento, quanti ne stanno in memoria
+    vm_pool = scheduler.vm_slots(config)
+    in_process = [stage for stage in stages if scheduler.needs_runner(stage)]
+    wanted = min(len(in_process), len(vm_pool) + any(not scheduler.needs_vm(stage) for stage in in_process))
+    runner_bytes = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+    runners = runner_pool.RunnerPool(make_runner, runner_pool.runner_budget(config, runner_bytes, max(1, wanted)),
+                                     first=first_runner)
+    # Ogni stage scrive in una cartella sua, spostata nella cartella di output a fine stage
+    stage_scratch = os.path.join(segment_path, "stage_outputs")
+    started = time.time()
+    timings = {}             # stage id -> entry for the run history
+
+    def execute(stage, slot):
+        kwargs = dict(batch_kwargs)
+        if slot is not None:
+            kwargs.update(vm_for_bench=slot[0], vm_for_dev=slot[1])
+        progress.stage(stage["id"], "running", backend=stage.get("backend") or "none",
+                       vms=f"{slot[0]}/{slot[1]}" if slot else None)
+        batch_mark = batch_area.mark()
+        folder = os.path.join(stage_scratch, stage["id"])
+        t0 = time.perf_counter()
+        try:
+            if stage.get("backend") == local_backend.LOCAL:
+                delta = local.run(stage, sample_path, kwargs, output_folder=folder)
+            else:
+                delta = runners.run(stage, sample_path, kwargs, folder)
+        except Exception as e:
+            progress.stage(stage["id"], "failed", error=str(e))
+            raise
+        timings[stage["id"]] = dict(stage_id=stage["id"], method=stage["method"], backend=stage.get("backend"),
+                                    sample=stage.get("sample"), seconds=round(time.perf_counter() - t0, 3))
+        return delta, batch_mark
+
+    def on_done(stage, outcome):
+        delta, batch_mark = outcome
+        # Solo su questo thread: il runner principale non cambia mentre un altro stage lo legge
+        score_cache.apply_delta(runner, delta)
+        produced = out_index.collect(os.path.join(stage_scratch, stage["id"]))
+        copies = []
+        if stage["report"]:
+            batch_area.claim(stage["id"], batch_pattern(segment), batch_mark,
+                             stem=os.path.splitext(os.path.basename(stage["sample"]))[0])
+            copies = output_index.copy_latest_outputs(
+                out_index, produced, segment, stage["report"], country, new_model, today,
+                batch_file=batch_area.latest(stage["id"]), batch_format=output_format.batch_format(config),
+                notify=copy_notifier(stage["report"], progress.log))
+        out_index.record(stage["id"], produced, copies, report=stage["report"])
+        progress.stage(stage["id"], "completed", files=len(produced) + len(copies))
+        progress.log(f"✅ Stage {stage['id']} completato", "success")
+
+    # Crossvalidation, Accuracy, Anomalie, Precision, Stability: in parallelo sulle coppie di VM libere
+    leases = open_vm_leases(config) if any(scheduler.needs_vm(stage) for stage in stages) else None
+    stage_scheduler = scheduler.StageScheduler(
+        vm_pool,
+        max_retries=config.get("vm_busy_retries", 3),
+        retry_delay=config.get("vm_busy_retry_delay_s", 60),
+        local_slots=local.max_workers if local is not None else 0,
+        leases=leases,
+        lease_retry_delay=config.get("vm_lease_retry_s", 15),
+        runners=runners.size,
+    )
+    try:
+        stage_scheduler.run(stages, execute, on_done)
+    finally:
+        if leases is not None:
+            leases.close()
+        if local is not None:
+            local.close()
+        runners.close()
+        shutil.rmtree(stage_scratch, ignore_errors=True)
+
+    # --- Save reports ---
+    progress.stage("save_reports", "running")
+    folder = os.path.join(segment_path, "save_reports")
+    runner_pool.save_reports(runner, folder, weights=None, excel=True, pdf=False)
+    reports = out_index.collect(folder)
+    out_index.record("save_reports", reports)
+    if report_sidecar.enabled(config):
+        sidecar_files = report_sidecar.write_sidecars([out_index.abs(rel) for rel in reports])
+        out_index.record("report_sidecar", out_index.add(sidecar_files))
+    # Il log grezzo entra nel manifest solo a stream gzip chiuso, con la dimensione finale
+    install_capture(None)
+    out_index.record("run_log", out_index.add([pipeline.close()]))
+    manifest = out_index.export()
+    batch_area.release()
+    shutil.rmtree(batch_area.run_dir, ignore_errors=True)
+    progress.stage("save_reports", "completed")
+    progress.log("🎉 Tests completed!", "success")
+
+    run_id = None
+    try:
+        history = open_run_history(config)
+        if history is not None:
+            run_id = history.record(run_history.build_record(
+                config, output_folder, run_history.stage_entries(list(timings.values()), sample_path), started,
+                source="dashboard", files=run_history.manifest_files(output_folder)))
+    except Exception as e:
+        logger.warning(f"Storico delle run non registrato: {e}")
+
+    return {
+        "output_folder": output_folder,
+        "manifest": manifest,
+        "run_history_id": run_id,
+        "report_path": os.path.join(runner.output_folder, runner.old_uid,
+                                    f"{runner.new_uid}_final_report_{runner.now}.xlsx"),
+    }
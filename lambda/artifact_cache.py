@@ -0,0 +1,225 @@
+"""
+Content-addressed cache of S3 artifacts in /tmp.
+
+Objects are stored once under ARTIFACT_CACHE_DIR, keyed by their S3 ETag and
+size, and hard-linked (or symlinked / copied) into each run's working tree.
+The cache lives outside /tmp/TEST_SUITE, so it survives the per-run cleanup
+and is reused by warm Lambda invocations. Least recently used entries are
+evicted once the configured byte budget is exceeded.
+
+Linked files share storage with the cache: the TestRunner must treat its
+inputs as read-only (it does today).
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+import s3_transfer
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", "/tmp/artifact_cache")
+DEFAULT_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_MB", "2048")) * s3_transfer.MB
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(root=None, max_bytes=None, link_mode=None):
+    """Return the process-wide cache for root, so warm invocations share its index."""
+    root = root or DEFAULT_CACHE_DIR
+    with _caches_lock:
+        cache = _caches.get(root)
+        if cache is None:
+            cache = _caches[root] = ArtifactCache(root, max_bytes, link_mode)
+        else:
+            if max_bytes:
+                cache.max_bytes = max_bytes
+            if link_mode:
+                cache.link_mode = link_mode
+        return cache
+
+
+class ArtifactCache:
+
+    def __init__(self, root, max_bytes=None, link_mode=None):
+        self.root = root
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+        self.link_mode = link_mode or "hardlink"
+        self.objects_dir = os.path.join(root, "objects")
+        self.staging_dir = os.path.join(root, "staging")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, ".lock")
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    # ---------- index ----------
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        # Drop entries whose object disappeared or was truncated
+        return {
+            digest: entry for digest, entry in index.items()
+            if os.path.isfile(self._object_path(digest))
+            and os.path.getsize(self._object_path(digest)) == entry.get("size")
+        }
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access to the index, across threads and (with fcntl) across batch processes."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, "a") as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    # Another process may have changed the index since we last read it
+                    self.index = self._load_index()
+                    yield
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    @staticmethod
+    def digest(etag, size):
+        return hashlib.sha1(f"{etag}:{size}".encode("utf-8")).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+    # ---------- linking ----------
+
+    def _link(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if self.link_mode == "hardlink":
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        if self.link_mode in ("hardlink", "symlink"):
+            try:
+                os.symlink(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    # ---------- eviction ----------
+
+    def _evict(self, pinned):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for digest, entry in sorted(self.index.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if digest in pinned:
+                continue
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+            total -= entry["size"]
+            del self.index[digest]
+            logger.info(f"Artifact cache evicted {entry['key']} ({entry['size']} bytes)")
+        if total > self.max_bytes:
+            logger.warning(f"Artifact cache over budget: {total} > {self.max_bytes} bytes (all entries in use)")
+
+    # ---------- fetch ----------
+
+    def fetch(self, s3, bucket, objects, stats=None, **opts):
+        """
+        Place every (key, local_path, size, etag) object at local_path, downloading
+        only cache misses. Hits and misses are recorded on stats.
+        Links are made while holding the lock, so no other process can evict in between.
+        """
+        stats = stats or s3_transfer.TransferStats()
+        pinned = set()
+        hits, misses = 0, {}
+
+        with self._locked():
+            now = time.time()
+            for key, local_path, size, etag in objects:
+                digest = self.digest(etag, size)
+                pinned.add(digest)
+                entry = self.index.get(digest)
+                if entry and os.path.isfile(self._object_path(digest)):
+                    entry["last_used"] = now
+                    self._link(self._object_path(digest), local_path)
+                    stats.add_cache(True, size)
+                    hits += 1
+                else:
+                    misses.setdefault(digest, []).append((key, local_path, size))
+            self._save_index()
+
+        tag = f"{os.getpid()}.{threading.get_ident()}"
+        staged = {digest: os.path.join(self.staging_dir, f"{digest}.{tag}") for digest in misses}
+        try:
+            s3_transfer.download_objects(
+                s3, bucket,
+                [(targets[0][0], staged[digest]) for digest, targets in misses.items()],
+                stats=stats, **opts,
+            )
+        finally:
+            try:
+                with self._locked():
+                    now = time.time()
+                    for digest, targets in misses.items():
+                        key, _local_path, size = targets[0]
+                        tmp = staged[digest]
+                        if not os.path.isfile(tmp) or os.path.getsize(tmp) != size:
+                            continue
+                        os.replace(tmp, self._object_path(digest))
+                        self.index[digest] = {"key": key, "size": size, "last_used": now}
+                        for _key, local_path, size in targets:
+                            self._link(self._object_path(digest), local_path)
+                            stats.add_cache(False, size)
+                    self._evict(pinned)
+                    self._save_index()
+            finally:
+                # Partial or unconsumed downloads would otherwise stay in the staging dir for good
+                for tmp in staged.values():
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+
+        logger.info(f"Artifact cache: {hits} hits, {sum(len(t) for t in misses.values())} misses, "
+                    f"{self.total_bytes()} bytes cached")
+        return stats
+
+    def clear(self):
+        with self._locked():
+            shutil.rmtree(self.objects_dir, ignore_errors=True)
+            os.makedirs(self.objects_dir, exist_ok=True)
+            self.index = {}
+            self._save_index()
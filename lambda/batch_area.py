@@ -0,0 +1,182 @@
+"""
+Per-run view of the TestRunner batch folder.
+
+The TestRunner writes its categorized/tagged CSVs into the shared
+suite_tests/data/batch folder, which every run (and every batch-mode process)
+uses. Instead of picking the newest CSV of the whole folder, each stage claims
+the CSVs of its own sample (named after the sample file) written while it ran,
+looked up by name when possible instead of listing the folder: they are copied into the run's own batch area
+(<segment>/batch/<stage>/) and listed in batch_index.json, so the copy step is
+a lookup. A claim is an exclusive marker file in <shared>/.claims named after
+the CSV and its mtime, so two runs never take the same version of a CSV.
+release() removes the claimed originals from the shared folder once the run's
+outputs are uploaded, so it stops growing.
+"""
+
+import os
+import json
+import time
+import shutil
+import fnmatch
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "batch_index.json"
+CLAIMS_DIR = ".claims"
+
+# Tolerance on file timestamps vs time.time_ns() (coarse filesystem clocks)
+MTIME_SLACK_NS = 50_000_000
+
+
+def batch_pattern(segment):
+    return "*categorized.csv" if segment in ["Consumer", "Business"] else "*tagged.csv"
+
+
+def is_part(name, key):
+    """True when the CSV name belongs to the sample stem key: "0_big" matches "0_big_categorized.csv", not "10_big_..."."""
+    return name.startswith(key) and name[len(key):len(key) + 1] in ("_", ".")
+
+
+class BatchArea:
+
+    def __init__(self, source_dir, run_dir, run_label=""):
+        self.source_dir = source_dir
+        self.run_dir = run_dir
+        self.run_label = run_label
+        self.index = {}          # stage id -> [file names, oldest first]
+        self._claimed = []       # (name, mtime_ns) claimed in source_dir
+        self._lock = threading.Lock()
+        os.makedirs(run_dir, exist_ok=True)
+
+    @staticmethod
+    def mark():
+        """Timestamp to pass to claim(); take it before the stage starts."""
+        return time.time_ns()
+
+    def _claim_path(self, name, mtime_ns):
+        return os.path.join(self.source_dir, CLAIMS_DIR, f"{name}.{mtime_ns}")
+
+    def _try_claim(self, name, mtime_ns):
+        os.makedirs(os.path.join(self.source_dir, CLAIMS_DIR), exist_ok=True)
+        try:
+            fd = os.open(self._claim_path(name, mtime_ns), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{self.run_label} pid={os.getpid()}\n")
+        return True
+
+    def _candidates(self, pattern, stem):
+        """Names in the shared folder that may belong to the stage: its sample's CSV when the name is known."""
+        if stem is not None:
+            exact = f"{stem}_{pattern.lstrip('*')}"
+            if fnmatch.fnmatch(exact, pattern) and os.path.isfile(os.path.join(self.source_dir, exact)):
+                return [exact]
+        with os.scandir(self.source_dir) as entries:
+            return [entry.name for entry in entries
+                    if fnmatch.fnmatch(entry.name, pattern) and (stem is None or is_part(entry.name, stem))
+                    and entry.is_file()]
+
+    def claim(self, stage_id, pattern, since_ns, until_ns=None, stem=None, accept=None):
+        """
+        Copy the unclaimed CSVs matching pattern written between since_ns and until_ns (the stage's
+        run) into the stage's area. stem (the stage's sample file name without extension) keeps
+        only the CSVs of that sample (is_part); accept(name), if given, further restricts the names.
+        """
+        if not self.source_dir or not os.path.isdir(self.source_dir):
+            return []
+        found = []
+        with self._lock:
+            for name in self._candidates(pattern, stem):
+                if accept is not None and not accept(name):
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(self.source_dir, name)).st_mtime_ns
+                except OSError:
+                    continue
+                if mtime < since_ns - MTIME_SLACK_NS:
+                    continue
+                # Written after the stage ended: another stage's file, possibly still being written
+                if until_ns is not None and mtime > until_ns + MTIME_SLACK_NS:
+                    continue
+                if self._try_claim(name, mtime):
+                    found.append((mtime, name))
+            found.sort()
+            stage_dir = os.path.join(self.run_dir, stage_id)
+            os.makedirs(stage_dir, exist_ok=True)
+            for mtime, name in found:
+                # A copy, not a link: the TestRunner may rewrite the same file in a later stage
+                shutil.copy2(os.path.join(self.source_dir, name), os.path.join(stage_dir, name))
+                self._claimed.append((name, mtime))
+            self.index.setdefault(stage_id, []).extend(name for _mtime, name in found)
+            self._save_index()
+        if not found:
+            logger.info(f"No new batch CSV for stage {stage_id}")
+        return [os.path.join(self.run_dir, stage_id, name) for _mtime, name in found]
+
+    def adopt(self, stage_id, path):
+        """Add a CSV that did not come from the shared folder (e.g. a score cache hit) to the stage's area."""
+        name = os.path.basename(path)
+        with self._lock:
+            stage_dir = os.path.join(self.run_dir, stage_id)
+            os.makedirs(stage_dir, exist_ok=True)
+            shutil.copy2(path, os.path.join(stage_dir, name))
+            self.index.setdefault(stage_id, []).append(name)
+            self._save_index()
+        return os.path.join(self.run_dir, stage_id, name)
+
+    def latest(self, stage_id):
+        """Path of the last CSV claimed by the stage, or None."""
+        with self._lock:
+            names = self.index.get(stage_id)
+        return os.path.join(self.run_dir, stage_id, names[-1]) if names else None
+
+    def merge(self, stage_id, part_keys, combine):
+        """
+        Combine the CSVs claimed by stage_id into one, ordered by part_keys (shard sample stems):
+        each part is the claimed file whose name starts with its key (is_part). When that is ambiguous
+        nothing is merged. Returns the merged path or None.
+        """
+        with self._lock:
+            claimed = list(self.index.get(stage_id, []))
+        parts = []
+        for key in part_keys:
+            matches = [name for name in claimed if is_part(name, key)]
+            if len(matches) != 1:
+                logger.warning(f"Batch CSVs of {stage_id} cannot be matched to its shards, not merged")
+                return None
+            parts.append(os.path.join(self.run_dir, stage_id, matches[0]))
+        name = "merged_" + os.path.basename(parts[0])
+        dst = combine(parts, os.path.join(self.run_dir, stage_id, name))
+        with self._lock:
+            self.index[stage_id].append(name)
+            self._save_index()
+        return dst
+
+    def _save_index(self):
+        path = os.path.join(self.run_dir, INDEX_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def release(self):
+        """Delete the claimed CSVs (and their claims) from the shared folder; the run area goes with the work root."""
+        with self._lock:
+            names, self._claimed = self._claimed, []
+        for name, mtime in names:
+            src = os.path.join(self.source_dir, name)
+            try:
+                # Leave it if it was rewritten after the claim (a newer version belongs to someone else)
+                if os.stat(src).st_mtime_ns == mtime:
+                    os.remove(src)
+            except OSError:
+                pass
+            try:
+                os.remove(self._claim_path(name, mtime))
+            except OSError:
+                pass
+        if names:
+            logger.info(f"Released {len(names)} batch CSVs from {self.source_dir}")
+        return len(names)
@@ -0,0 +1,208 @@
+"""
+Stage-level checkpoints for run_tests.
+
+A manifest stored on S3 next to the outputs records, for one config, which
+stages finished, how long they took and which output files they produced,
+together with a pickled snapshot of the TestRunner state written after every
+stage. The run id covers the config and the content (S3 ETags) of the inputs,
+so replacing a model or a sample under the same name starts a new checkpoint.
+Any invocation that finds an unfinished checkpoint for its run id (a hand-off,
+a Lambda retry after a timeout or crash, the same config sent again) restores
+the outputs and the runner state and continues from the first unfinished
+stage; "resume": false always starts from zero.
+
+Stages can also store their batch CSV (kept under the checkpoint prefix, not
+with the outputs), so steps that read every stage's CSV at the end of the run
+(prediction_diff) still find the ones of earlier invocations.
+"""
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+
+import s3_transfer
+
+logger = logging.getLogger(__name__)
+
+# Keys that change between invocations of the same logical run
+VOLATILE_KEYS = {"resume", "_handoffs", "mode", "work_root", "_source"}
+
+
+def config_hash(config):
+    stable = {k: v for k, v in config.items() if k not in VOLATILE_KEYS}
+    raw = json.dumps(stable, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def run_id(config, fingerprints):
+    """Id of a logical run: the config plus the content fingerprints of its inputs ({path: fingerprint})."""
+    raw = json.dumps([config_hash(config), sorted((fingerprints or {}).items())])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def snapshot_files(folder):
+    """Map of relative path -> (size, mtime_ns) for every file under folder."""
+    snap = {}
+    for root, _dirs, files in os.walk(folder):
+        for fname in files:
+            path = os.path.join(root, fname)
+            st = os.stat(path)
+            snap[os.path.relpath(path, folder).replace("\\", "/")] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+def changed_files(before, after):
+    return sorted(rel for rel, sig in after.items() if before.get(rel) != sig)
+
+
+def runner_state(runner):
+    """Pickle every attribute of runner that can be pickled; the rest is rebuilt by the constructor."""
+    state, skipped = {}, []
+    # Copy first: other stages may still be updating the runner on worker threads
+    for name, value in list(vars(runner).items()):
+        try:
+            pickle.dumps(value)
+        except Exception:
+            skipped.append(name)
+            continue
+        state[name] = value
+    if skipped:
+        logger.info(f"Runner attributes not checkpointed: {', '.join(skipped)}")
+    return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class Checkpoint:
+
+    def __init__(self, s3, bucket, prefix, output_prefix, run_id):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.output_prefix = output_prefix
+        self.run_id = run_id
+        self.manifest = {"run_id": run_id, "status": "running", "date_str": None, "stages": {}}
+        self.state_blob = None
+
+    @property
+    def manifest_key(self):
+        return f"{self.prefix}manifest.json"
+
+    @property
+    def state_key(self):
+        return f"{self.prefix}runner_state.pkl"
+
+    def batch_key(self, stage_id, name):
+        return f"{self.prefix}batch/{stage_id}/{name}"
+
+    # ---------- persistence ----------
+
+    def load(self):
+        """Load an unfinished manifest from S3. Returns True when there is something to resume."""
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.manifest_key)["Body"].read()
+        except Exception:
+            return False
+        manifest = json.loads(body)
+        if manifest.get("status") == "completed":
+            logger.info(f"Checkpoint {self.run_id} already completed, starting a fresh run")
+            return False
+        self.manifest = manifest
+        try:
+            self.state_blob = self.s3.get_object(Bucket=self.bucket, Key=self.state_key)["Body"].read()
+        except Exception:
+            self.state_blob = None
+        logger.info(f"Resuming checkpoint {self.run_id}: {len(self.done_stages())} stages already done")
+        return True
+
+    def save(self):
+        self.manifest["updated_at"] = time.time()
+        self.s3.put_object(Bucket=self.bucket, Key=self.manifest_key,
+                           Body=json.dumps(self.manifest, indent=2).encode("utf-8"),
+                           ContentType="application/json")
+
+    # ---------- stages ----------
+
+    def done_stages(self):
+        return [sid for sid, st in self.manifest["stages"].items() if st.get("status") == "done"]
+
+    def is_done(self, stage_id):
+        return self.manifest["stages"].get(stage_id, {}).get("status") == "done"
+
+    def longest_stage_seconds(self):
+        return max((st.get("seconds", 0) for st in self.manifest["stages"].values()), default=0)
+
+    def mark_done(self, stage_id, seconds, output_folder, artifacts, runner=None, uploader=None, batch_file=None):
+        """
+        Make sure the stage's artifacts (and batch_file, if given) are on S3, then persist runner
+        state and manifest. The manifest is written last, so a stage is only "done" once everything
+        it needs is stored.
+        """
+        paths = [os.path.join(output_folder, *rel.split("/")) for rel in artifacts]
+        if uploader is not None:
+            for path in paths:
+                uploader.submit(path)
+            uploader.flush()
+        elif paths:
+            s3_transfer.upload_files(
+                self.s3, self.bucket,
+                [(path, self.output_prefix + rel) for path, rel in zip(paths, artifacts)],
+            )
+        if batch_file:
+            s3_transfer.upload_files(self.s3, self.bucket,
+                                     [(batch_file, self.batch_key(stage_id, os.path.basename(batch_file)))])
+
+        if runner is not None:
+            self.save_state(runner)
+
+        self.manifest["stages"][stage_id] = {
+            "status": "done",
+            "seconds": round(seconds, 3),
+            "artifacts": artifacts,
+            "batch": os.path.basename(batch_file) if batch_file else None,
+        }
+        self.save()
+
+    def save_state(self, runner):
+        """Store the runner state for the next invocation."""
+        self.state_blob = runner_state(runner)
+        self.s3.put_object(Bucket=self.bucket, Key=self.state_key, Body=self.state_blob)
+
+    def complete(self):
+        self.manifest["status"] = "completed"
+        self.save()
+
+    # ---------- restore ----------
+
+    def restore_outputs(self, output_folder):
+        """Download the artifacts of completed stages back into output_folder; returns their local paths."""
+        items = []
+        for st in self.manifest["stages"].values():
+            for rel in st.get("artifacts", []):
+                items.append((self.output_prefix + rel, os.path.join(output_folder, *rel.split("/"))))
+        items = list(dict(items).items())
+        if items:
+            s3_transfer.download_objects(self.s3, self.bucket, items)
+        return [path for _key, path in items]
+
+    def restore_batches(self, folder):
+        """Download the batch CSVs stored by completed stages into folder; returns {stage_id: path}."""
+        items = {}
+        for stage_id, st in self.manifest["stages"].items():
+            if st.get("status") == "done" and st.get("batch"):
+                items[stage_id] = (self.batch_key(stage_id, st["batch"]), os.path.join(folder, stage_id, st["batch"]))
+        if items:
+            s3_transfer.download_objects(self.s3, self.bucket, list(items.values()))
+        return {stage_id: path for stage_id, (_key, path) in items.items()}
+
+    def restore_runner(self, runner):
+        if not self.state_blob:
+            return False
+        state = pickle.loads(self.state_blob)
+        # Local paths may differ between invocations: keep the ones set by the constructor
+        for name in ("output_folder",):
+            if hasattr(runner, name):
+                state.pop(name, None)
+        vars(runner).update(state)
+        return True
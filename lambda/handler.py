@@ -15,6 +15,29 @@ import shutil
 import datetime
 import logging
 import argparse
+import time
+
+import s3_transfer
+import artifact_cache
+import checkpoint
+import metrics
+import scheduler
+import score_cache
+import sample_cache
+import warmup
+import local_backend
+import sharding
+import prediction_diff
+import output_format
+import report_sidecar
+import vm_lease
+import run_history
+import planner
+import report_state
+import runner_pool
+from output_index import OutputIndex, copy_latest_outputs
+from batch_area import BatchArea, batch_pattern, is_part
+from scheduler import build_stages
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -23,94 +46,73 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(mess
 #  S3 HELPERS
 # ============================================================
 
-def _get_s3():
-    import boto3
-    return boto3.client("s3")
-
-
-def s3_download_prefix(s3, bucket, prefix, local_dir):
-    paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for obj in page.get("Contents", []):
-            key = obj["Key"]
-            rel = key[len(prefix):]
-            if not rel or rel.endswith("/"):
-                continue
-            local_path = os.path.join(local_dir, rel)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            logger.info(f"S3 download: s3://{bucket}/{key} -> {local_path}")
-            s3.download_file(bucket, key, local_path)
-
-
-def s3_upload_dir(s3, bucket, local_dir, prefix):
+def _get_s3(config=None):
+    config = config or {}
+    return s3_transfer.get_client(
+        endpoint_url=config.get("s3_endpoint_url"),
+        max_pool_connections=config.get("s3_max_pool_connections"),
+    )
+
+
+def _transfer_opts(config):
+    """Thread-pool and multipart settings for s3_transfer, from config or env defaults."""
+    config = config or {}
+    mb = s3_transfer.MB
+    return dict(
+        max_workers=config.get("s3_max_workers"),
+        config=s3_transfer.transfer_config(
+            multipart_threshold=(config.get("s3_multipart_threshold_mb") or 0) * mb or None,
+            multipart_chunksize=(config.get("s3_multipart_chunksize_mb") or 0) * mb or None,
+            part_concurrency=config.get("s3_part_concurrency"),
+        ),
+    )
+
+
+def _get_cache(config):
+    """The shared artifact cache, or None when artifact_cache is disabled."""
+    enabled = config.get("artifact_cache", os.environ.get("ARTIFACT_CACHE", "0") not in ("", "0", "false"))
+    if not enabled:
+        return None
+    max_mb = config.get("artifact_cache_max_mb")
+    return artifact_cache.get_cache(
+        root=config.get("artifact_cache_dir"),
+        max_bytes=max_mb * s3_transfer.MB if max_mb else None,
+        link_mode=config.get("artifact_cache_link"),
+    )
+
+
+def _download(s3, bucket, objects, stats=None, cache=None, **opts):
+    """Fetch (key, local_path, size, etag) objects, through the artifact cache when given."""
+    if cache is not None:
+        return cache.fetch(s3, bucket, objects, stats=stats, **opts)
+    items = [(key, local_path) for key, local_path, _size, _etag in objects]
+    return s3_transfer.download_objects(s3, bucket, items, stats=stats, **opts)
+
+
+def s3_download_prefix(s3, bucket, prefix, local_dir, stats=None, cache=None, **opts):
+    objects = []
+    for key, size, etag in s3_transfer.list_prefix(s3, bucket, prefix):
+        rel = key[len(prefix):]
+        if not rel or rel.endswith("/"):
+            continue
+        objects.append((key, os.path.join(local_dir, rel), size, etag))
+    return _download(s3, bucket, objects, stats=stats, cache=cache, **opts)
+
+
+def s3_upload_dir(s3, bucket, local_dir, prefix, stats=None, **opts):
+    items = []
     for root, _dirs, files in os.walk(local_dir):
         for fname in files:
             local_path = os.path.join(root, fname)
             rel = os.path.relpath(local_path, local_dir)
-            s3_key = prefix + rel.replace("\\", "/")
-            logger.info(f"S3 upload: {local_path} -> s3://{bucket}/{s3_key}")
-            s3.upload_file(local_path, bucket, s3_key)
+            items.append((local_path, prefix + rel.replace("\\", "/")))
+    return s3_transfer.upload_files(s3, bucket, items, stats=stats, **opts)
 
 
 # ============================================================
-#  COPY OUTPUTS  (adapted from dashboard.py)
+#  BATCH FOLDER
 # ============================================================
 
-def copy_latest_outputs(output_folder, segment, report_type, country_code, model_name, date_str):
-    messages = {
-        "ACC": "Report di Accuracy generato!",
-        "ANOM": "Report di Anomalie generato!",
-        "PREC": "Report di Precision generato!",
-        "STAB": "Report di Stabilità generato!",
-    }
-    suffix_map = {
-        "ACC": "_ACC.xlsx",
-        "ANOM": "_ANOM.xlsx",
-        "PREC": "_PREC.xlsx",
-        "STAB": "_STAB.xlsx",
-    }
-    suffix = suffix_map.get(report_type, "")
-
-    value = "OUT"
-    try:
-        parts = model_name.split("_")
-        idx = parts.index(country_code) + 1
-        if parts[idx] == "1":
-            value = "IN"
-    except Exception:
-        pass
-
-    for root, dirs, files in os.walk(output_folder):
-        if root != output_folder:
-            for f in files:
-                if suffix and f.endswith(suffix):
-                    src = os.path.join(root, f)
-                    new_name = f"report_{messages[report_type].split()[2]}_{country_code}_CE_{segment}_{value}_{date_str}.xlsx"
-                    dst = os.path.join(output_folder, new_name)
-                    try:
-                        shutil.copy2(src, dst)
-                        logger.info(f"Copied report: {new_name}")
-                    except Exception as e:
-                        logger.warning(f"Failed to copy {src}: {e}")
-
-    batch_dir = _get_batch_dir()
-    if batch_dir is None:
-        logger.warning("Batch directory not found, skipping batch CSV copy")
-        return
-
-    pattern = "*categorized.csv" if segment in ["Consumer", "Business"] else "*tagged.csv"
-    files = glob.glob(os.path.join(batch_dir, pattern))
-    if files:
-        latest = max(files, key=os.path.getmtime)
-        new_batch_name = f"{messages[report_type].split()[2]}_{country_code}_CE_{segment}_{value}_{date_str}.csv"
-        dst = os.path.join(output_folder, new_batch_name)
-        try:
-            shutil.copy2(latest, dst)
-            logger.info(f"Copied batch file: {new_batch_name}")
-        except Exception as e:
-            logger.warning(f"Failed to copy {latest}: {e}")
-
-
 def _get_batch_dir():
     try:
         import suite_tests
@@ -130,11 +132,116 @@ def _get_batch_dir():
     return None
 
 
+# ============================================================
+#  REQUIRED ARTIFACTS
+# ============================================================
+
+def resolve_model_paths(config, model_path):
+    """Returns (old_model_path, new_model_path, old_expert_path, new_expert_path) under model_path."""
+    is_tagger = config["segment"].lower() == "tagger"
+    old_model = config["old_model"]
+    new_model = config["new_model"]
+    old_expert_rules = config.get("old_expert_rules")
+    new_expert_rules = config.get("new_expert_rules")
+    has_old_new = config.get("has_old_new_expert_structure", False)
+
+    if is_tagger:
+        return os.path.join(model_path, old_model), os.path.join(model_path, new_model), None, None
+
+    old_model_path = os.path.join(model_path, "prod", old_model)
+    new_model_path = os.path.join(model_path, "develop", new_model)
+
+    if old_expert_rules:
+        sub = os.path.join("old", old_expert_rules) if has_old_new else old_expert_rules
+        old_expert_path = os.path.join(model_path, "expertrules", sub)
+    else:
+        old_expert_path = None
+
+    if new_expert_rules:
+        sub = os.path.join("new", new_expert_rules) if has_old_new else new_expert_rules
+        new_expert_path = os.path.join(model_path, "expertrules", sub)
+    else:
+        new_expert_path = None
+
+    return old_model_path, new_model_path, old_expert_path, new_expert_path
+
+
+def required_sample_files(config):
+    """Sample file names referenced by sample_files, in run order and without duplicates."""
+    sample_files_cfg = config.get("sample_files", {})
+    if config["segment"].lower() == "tagger":
+        names = [sample_files_cfg.get("distribution")]
+    else:
+        names = []
+        for category in ("accuracy", "anomalies", "precision", "stability"):
+            names.extend(sample_files_cfg.get(category, []))
+    return list(dict.fromkeys(n for n in names if n))
+
+
+def required_artifacts(config):
+    """
+    Paths, relative to the segment root and "/"-separated, that run_tests actually reads.
+    Each entry is either a single object or a folder (e.g. an unzipped model).
+    """
+    model_paths = resolve_model_paths(config, "model")
+    entries = [p for p in model_paths if p]
+    entries += [f"sample/{name}" for name in required_sample_files(config)]
+    return list(dict.fromkeys(e.replace(os.sep, "/") for e in entries))
+
+
+def list_artifact_objects(s3, bucket, base_prefix, rel_paths):
+    """
+    Returns ({rel_path: [(key, size, etag), ...]}, missing_rel_paths). An entry matches
+    the key itself or every key below it, so model folders work as well as single files.
+    """
+    found, missing = {}, []
+    for rel in rel_paths:
+        s3_key = base_prefix + rel
+        objects = [
+            (key, size, etag) for key, size, etag in s3_transfer.list_prefix(s3, bucket, s3_key)
+            if (key == s3_key or key.startswith(s3_key.rstrip("/") + "/")) and not key.endswith("/")
+        ]
+        if objects:
+            found[rel] = objects
+        else:
+            missing.append(rel)
+    return found, missing
+
+
+def artifact_fingerprints(s3, bucket, base_prefix, rel_paths):
+    """Content fingerprint (from S3 ETags and sizes) of every artifact in rel_paths."""
+    found, _missing = list_artifact_objects(s3, bucket, base_prefix, rel_paths)
+    return {
+        rel: score_cache.fingerprint([(key[len(base_prefix) + len(rel):], etag, size) for key, size, etag in objects])
+        for rel, objects in found.items()
+    }
+
+
+def s3_download_selected(s3, bucket, base_prefix, rel_paths, local_base, stats=None, cache=None, **opts):
+    """
+    Download only the objects behind rel_paths (see list_artifact_objects).
+    All entries are resolved before anything is fetched: missing ones raise FileNotFoundError.
+    """
+    found, missing = list_artifact_objects(s3, bucket, base_prefix, rel_paths)
+    items = {}
+    for objects in found.values():
+        for key, size, etag in objects:
+            items[key] = (key, os.path.join(local_base, *key[len(base_prefix):].split("/")), size, etag)
+
+    if missing:
+        raise FileNotFoundError(
+            f"Missing required artifacts under s3://{bucket}/{base_prefix}: {', '.join(missing)}"
+        )
+
+    logger.info(f"Selective download: {len(rel_paths)} artifacts -> {len(items)} objects")
+    return _download(s3, bucket, list(items.values()), stats=stats, cache=cache, **opts)
+
+
 # ============================================================
 #  RESOLVE PATHS  (always S3-based)
 # ============================================================
 
-def resolve_paths(config):
+def resolve_paths(config, transfer_stats=None, run_metrics=None):
     """
     Always download from S3 into a local temp directory, run tests there,
     then upload results back to S3.
@@ -154,17 +261,32 @@ def resolve_paths(config):
     if not s3_bucket or not s3_prefix:
         raise ValueError("s3_bucket and s3_prefix are required")
 
-    local_root = "/tmp/TEST_SUITE"
-    if os.path.exists(local_root):
-        shutil.rmtree(local_root)
+    run_metrics = run_metrics or metrics.Metrics(emit_emf=False)
+
+    local_root = config.get("work_root", "/tmp/TEST_SUITE")
+    with run_metrics.span("resolve_paths.cleanup"):
+        if os.path.exists(local_root):
+            shutil.rmtree(local_root)
 
-    s3 = _get_s3()
+    s3 = _get_s3(config)
     s3_base = f"{s3_prefix}{data_root}/"
     local_base = os.path.join(local_root, data_root)
 
-    # Download sample and model directories from S3
-    for subdir in ["sample", "model"]:
-        s3_download_prefix(s3, s3_bucket, f"{s3_base}{subdir}/", os.path.join(local_base, subdir))
+    # Download from S3: only what the config needs ("selective"), or the whole
+    # sample and model directories ("full", default)
+    opts = _transfer_opts(config)
+    cache = _get_cache(config)
+    download_mode = config.get("download_mode", os.environ.get("DOWNLOAD_MODE", "full"))
+    with run_metrics.span("resolve_paths.download", mode=download_mode):
+        if download_mode == "selective":
+            s3_download_selected(s3, s3_bucket, s3_base, required_artifacts(config), local_base,
+                                 stats=transfer_stats, cache=cache, **opts)
+        elif download_mode == "full":
+            for subdir in ["sample", "model"]:
+                s3_download_prefix(s3, s3_bucket, f"{s3_base}{subdir}/", os.path.join(local_base, subdir),
+                                   stats=transfer_stats, cache=cache, **opts)
+        else:
+            raise ValueError(f"Unknown download_mode: {download_mode}")
 
     segment_path = local_base
     cleanup = lambda: shutil.rmtree(local_root, ignore_errors=True)
@@ -181,57 +303,226 @@ def resolve_paths(config):
 #  UPLOAD RESULTS
 # ============================================================
 
-def upload_results(config, output_folder):
-    """Upload results to S3."""
-    s3_bucket = config.get("s3_bucket")
-    s3_prefix = config.get("s3_prefix")
+def _input_location(config):
+    """Returns (bucket, segment_prefix) of the run's sample/ and model/ folders on S3."""
+    s3_bucket = config.get("s3_bucket", os.environ.get("S3_BUCKET", ""))
+    s3_prefix = config.get("s3_prefix", os.environ.get("S3_PREFIX", ""))
     data_root = config.get("data_root", f"{config['country']}/{config['segment'].lower()}")
-    output_folder_name = config.get("output_folder_name", "output")
+    return s3_bucket, f"{s3_prefix}{data_root}/"
+
 
+def _output_location(config):
+    """Returns (bucket, output_prefix) for the run's outputs, or (None, None) without S3 config."""
+    s3_bucket = config.get("s3_bucket", os.environ.get("S3_BUCKET", ""))
+    s3_prefix = config.get("s3_prefix", os.environ.get("S3_PREFIX", ""))
+    data_root = config.get("data_root", f"{config['country']}/{config['segment'].lower()}")
+    output_folder_name = config.get("output_folder_name", "output")
     if not s3_bucket or not s3_prefix:
+        return None, None
+    return s3_bucket, f"{s3_prefix}{data_root}/{output_folder_name}/"
+
+
+def start_uploader(config, output_folder, transfer_stats=None):
+    """Background uploader fed by copy_latest_outputs, or None when streaming is off."""
+    s3_bucket, s3_output_prefix = _output_location(config)
+    if not s3_bucket or not config.get("stream_uploads", True):
+        return None
+    return s3_transfer.StreamingUploader(
+        _get_s3(config), s3_bucket, output_folder, s3_output_prefix,
+        stats=transfer_stats, **_transfer_opts(config),
+    )
+
+
+def upload_results(config, output_folder, transfer_stats=None, uploader=None):
+    """
+    Upload results to S3. With a streaming uploader, only files not already sent
+    are uploaded, then every uploaded object is verified against its local size.
+    """
+    s3_bucket, s3_output_prefix = _output_location(config)
+
+    if not s3_bucket:
         logger.warning("No S3 config provided, skipping upload.")
         return
 
     try:
-        s3 = _get_s3()
-        s3_output_prefix = f"{s3_prefix}{data_root}/{output_folder_name}/"
-        logger.info(f"Uploading results to s3://{s3_bucket}/{s3_output_prefix}")
-        s3_upload_dir(s3, s3_bucket, output_folder, s3_output_prefix)
+        if uploader is None:
+            s3 = _get_s3(config)
+            logger.info(f"Uploading results to s3://{s3_bucket}/{s3_output_prefix}")
+            s3_upload_dir(s3, s3_bucket, output_folder, s3_output_prefix, stats=transfer_stats,
+                          **_transfer_opts(config))
+        else:
+            logger.info(f"Flushing streamed results to s3://{s3_bucket}/{s3_output_prefix}")
+            try:
+                uploader.sync()
+                uploader.flush()
+            finally:
+                uploader.close()
+            mismatched = uploader.verify()
+            if mismatched:
+                raise RuntimeError(f"{len(mismatched)} uploaded files failed verification: {', '.join(mismatched)}")
         logger.info("Upload complete!")
     except Exception as e:
         logger.error(f"Failed to upload results to S3: {e}")
 
 
+# ============================================================
+#  CHECKPOINT & HAND-OFF
+# ============================================================
+
+def checkpoint_enabled(config):
+    return bool(_output_location(config)[0]) and config.get("checkpoint", True)
+
+
+def open_checkpoint(config, fingerprints):
+    """
+    Checkpoint for this config and input content on S3. An unfinished one is loaded (the run resumes)
+    by any invocation: hand-off, Lambda retry or the same request sent again; "resume": false starts over.
+    """
+    if not checkpoint_enabled(config):
+        return None
+    s3_bucket, s3_output_prefix = _output_location(config)
+    run_id = checkpoint.run_id(config, fingerprints)
+    ckpt = checkpoint.Checkpoint(
+        _get_s3(config), s3_bucket, f"{s3_output_prefix.rstrip('/')}_checkpoints/{run_id}/",
+        s3_output_prefix, run_id,
+    )
+    if config.get("resume") is not False:
+        ckpt.load()
+    return ckpt
+
+
+def open_score_cache(config):
+    """Stage result cache for the config's segment, or None when score_cache is off."""
+    mode = config.get("score_cache", False)
+    if mode in (False, None, "off"):
+        return None
+    s3_bucket, s3_base = _input_location(config)
+    return score_cache.ScoreCache(
+        _get_s3(config) if s3_bucket else None, s3_bucket, f"{s3_base}score_cache/",
+        local_dir=config.get("score_cache_dir"), refresh=(mode == "refresh"),
+    )
+
+
+def open_sample_cache(config, sample_path):
+    """Columnar cache of the parsed samples under sample_path, or None when sample_cache is off."""
+    enabled = config.get("sample_cache", os.environ.get("SAMPLE_CACHE", "0") not in ("", "0", "false"))
+    if not enabled:
+        return None
+    s3_bucket, s3_base = _input_location(config)
+    return sample_cache.SampleCache(
+        [sample_path], _get_s3(config) if s3_bucket else None, s3_bucket, f"{s3_base}sample_cache/",
+        local_dir=config.get("sample_cache_dir"),
+    )
+
+
+def open_vm_leases(config):
+    """Leases on the Azure Batch VMs shared with other runs, or None when vm_lease is off."""
+    s3_bucket = config.get("s3_bucket", os.environ.get("S3_BUCKET", ""))
+    s3_prefix = config.get("s3_prefix", os.environ.get("S3_PREFIX", ""))
+    use_s3 = config.get("vm_lease_store", "s3" if s3_bucket else "local") == "s3"
+    return vm_lease.open_leases(config, _get_s3(config) if use_s3 else None, s3_bucket, s3_prefix,
+                                owner_label=f"{config['country']}/{config['segment']}")
+
+
+def open_run_history(config):
+    """Run history store mirrored under <s3_prefix>run_history/, or None when run_history is off."""
+    s3_bucket = config.get("s3_bucket", os.environ.get("S3_BUCKET", ""))
+    s3_prefix = config.get("s3_prefix", os.environ.get("S3_PREFIX", ""))
+    return run_history.open_history(config, _get_s3(config) if s3_bucket else None, s3_bucket, s3_prefix)
+
+
+def record_run(config, output_folder, stages, started, run_metrics, sample_path, ckpt=None, skipped=()):
+    """Store the completed run in the run history; returns its run id, or None (never fails the run)."""
+    try:
+        history = open_run_history(config)
+        if history is None:
+            return None
+        timings = run_history.stages_from_spans(run_metrics.summary()["spans"], stages)
+        if ckpt is not None:
+            # Stages finished by earlier invocations keep the timing saved in the checkpoint
+            for stage_id in skipped:
+                timings.append(dict(stage_id=stage_id, seconds=ckpt.manifest["stages"][stage_id].get("seconds")))
+        record = run_history.build_record(config, output_folder, run_history.stage_entries(timings, sample_path),
+                                          started)
+        return history.record(record)
+    except Exception as e:
+        logger.warning(f"Run history not recorded: {e}")
+        return None
+
+
+def _remaining_seconds(context):
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return context.get_remaining_time_in_millis() / 1000.0
+
+
+def _should_hand_off(config, context, ckpt):
+    """True when the next stage is unlikely to finish before the Lambda deadline."""
+    remaining = _remaining_seconds(context)
+    if remaining is None or ckpt is None:
+        return False
+    if config.get("_handoffs", 0) >= config.get("max_handoffs", 5):
+        return False
+    margin = max(config.get("handoff_margin_s", 120), ckpt.longest_stage_seconds())
+    return remaining < margin
+
+
+def hand_off(config, context):
+    """Re-invoke this Lambda asynchronously with the same config; the checkpoint carries the progress."""
+    import boto3
+    payload = dict(config, _handoffs=config.get("_handoffs", 0) + 1)
+    boto3.client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(payload, default=str).encode("utf-8"),
+    )
+    logger.info(f"Handed off to a new invocation (hand-off #{payload['_handoffs']})")
+
+
 # ============================================================
 #  RUN TESTS
 # ============================================================
 
-def run_tests(config):
+def run_tests(config, context=None):
     """Core logic: download from S3, import TestRunner, execute tests, upload results."""
     country = config["country"]
     segment = config["segment"].capitalize()
     is_tagger = segment.lower() == "tagger"
 
     # Add CategorizationEnginePython to sys.path if provided
-    ce_path = config.get("ce_python_path")
-    if ce_path:
-        paths_to_add = [
-            ce_path,
-            os.path.join(ce_path, "CategorizationEngineTests", "CETestSuite"),
-        ]
-        for p in paths_to_add:
-            if p not in sys.path:
-                sys.path.insert(0, p)
-                logger.info(f"Added to sys.path: {p}")
+    warmup.add_ce_paths(config)
 
-    segment_path, sample_path, model_path, output_folder, today, cleanup = resolve_paths(config)
+    transfer_stats = s3_transfer.TransferStats()
+    run_metrics = metrics.Metrics(
+        dimensions={"Country": country, "Segment": segment},
+        emit_emf=config.get("emit_emf"),
+    )
+    segment_path, sample_path, model_path, output_folder, today, cleanup = resolve_paths(
+        config, transfer_stats, run_metrics)
 
-    old_model = config["old_model"]
     new_model = config["new_model"]
-    old_expert_rules = config.get("old_expert_rules")
-    new_expert_rules = config.get("new_expert_rules")
-    has_old_new = config.get("has_old_new_expert_structure", False)
-    sample_files_cfg = config.get("sample_files", {})
+    started = time.time()
+
+    # Content of the inputs (S3 ETags): part of the checkpoint run id and of the score cache keys
+    memo = open_score_cache(config)
+    fingerprints = {}
+    s3_bucket, s3_base = _input_location(config)
+    if s3_bucket and (memo is not None or checkpoint_enabled(config)):
+        with run_metrics.span("artifact_fingerprints"):
+            fingerprints = artifact_fingerprints(_get_s3(config), s3_bucket, s3_base, required_artifacts(config))
+
+    ckpt = open_checkpoint(config, fingerprints)
+    resumed = bool(ckpt and ckpt.done_stages())
+    restored = []
+    if ckpt is not None:
+        # Keep the report names of the first invocation, even across midnight
+        today = ckpt.manifest.get("date_str") or today
+        ckpt.manifest["date_str"] = today
+        started = ckpt.manifest.setdefault("started", started)
+        if resumed:
+            with run_metrics.span("checkpoint.restore"):
+                restored = ckpt.restore_outputs(output_folder)
+            logger.info(f"Restored {len(restored)} output files from checkpoint")
 
     azure_batch_vm_path = config.get("azure_batch_vm_path")
     cert_thumbprint = config.get("ServicePrincipal_CertificateThumbprint")
@@ -239,132 +530,561 @@ def run_tests(config):
     vm_bench = config.get("vm_for_bench", 1)
     vm_dev = config.get("vm_for_dev", 2)
 
-    # Resolve model paths
-    if is_tagger:
-        old_model_path = os.path.join(model_path, old_model)
-        new_model_path = os.path.join(model_path, new_model)
-        old_expert_path = None
-        new_expert_path = None
-    else:
-        old_model_path = os.path.join(model_path, "prod", old_model)
-        new_model_path = os.path.join(model_path, "develop", new_model)
-
-        if old_expert_rules:
-            sub = os.path.join("old", old_expert_rules) if has_old_new else old_expert_rules
-            old_expert_path = os.path.join(model_path, "expertrules", sub)
-        else:
-            old_expert_path = None
+    old_model_path, new_model_path, old_expert_path, new_expert_path = resolve_model_paths(config, model_path)
 
-        if new_expert_rules:
-            sub = os.path.join("new", new_expert_rules) if has_old_new else new_expert_rules
-            new_expert_path = os.path.join(model_path, "expertrules", sub)
-        else:
-            new_expert_path = None
+    uploader = start_uploader(config, output_folder, transfer_stats)
 
     logger.info(f"Old model: {old_model_path}")
     logger.info(f"New model: {new_model_path}")
 
-    azure_batch = True
+    # Stages on the local backend override this with azure_batch=False
+    batch_kwargs = dict(
+        azure_batch=True,
+        azure_batch_vm_path=azure_batch_vm_path,
+        ServicePrincipal_CertificateThumbprint=cert_thumbprint,
+        ServicePrincipal_ApplicationId=app_id,
+        vm_for_bench=vm_bench,
+        vm_for_dev=vm_dev,
+    )
 
     # Import TestRunner
+    rss_before = metrics.current_rss_bytes()
     if is_tagger:
-        from suite_tests.testRunner_tagger import TestRunner as TestRunnerTagger
-        runner = TestRunnerTagger(old_model_path, new_model_path, output_folder)
-
-        accuracy_files = [sample_files_cfg.get("distribution")] if sample_files_cfg.get("distribution") else []
-        for f in accuracy_files:
-            if f:
-                runner.compute_validation_distribution(
-                    os.path.join(sample_path, f),
-                    save=True,
-                    azure_batch=azure_batch,
-                    azure_batch_vm_path=azure_batch_vm_path,
-                    ServicePrincipal_CertificateThumbprint=cert_thumbprint,
-                    ServicePrincipal_ApplicationId=app_id,
-                    vm_for_bench=vm_bench,
-                    vm_for_dev=vm_dev,
-                )
+        with run_metrics.span("runner.init"):
+            from suite_tests.testRunner_tagger import TestRunner as TestRunnerTagger
+            first_runner = TestRunnerTagger(old_model_path, new_model_path, output_folder)
     else:
-        from suite_tests.testRunner import TestRunner
-        runner = TestRunner(old_model_path, new_model_path, output_folder, old_expert_path, new_expert_path)
-
-        runner.compute_crossvalidation_score(
+        with run_metrics.span("runner.init"):
+            from suite_tests.testRunner import TestRunner
+            first_runner = TestRunner(old_model_path, new_model_path, output_folder, old_expert_path, new_expert_path)
+        batch_kwargs.update(
             old_expert_rules_zip_path=old_expert_path,
             new_expert_rules_zip_path=new_expert_path,
-            save=True,
         )
-
-        accuracy_files = sample_files_cfg.get("accuracy", [])
-        anomalies_files = sample_files_cfg.get("anomalies", [])
-        precision_files = sample_files_cfg.get("precision", [])
-        stability_files = sample_files_cfg.get("stability", [])
-
-        batch_kwargs = dict(
-            azure_batch=azure_batch,
-            azure_batch_vm_path=azure_batch_vm_path,
-            old_expert_rules_zip_path=old_expert_path,
-            new_expert_rules_zip_path=new_expert_path,
-            ServicePrincipal_CertificateThumbprint=cert_thumbprint,
-            ServicePrincipal_ApplicationId=app_id,
-            vm_for_bench=vm_bench,
-            vm_for_dev=vm_dev,
+    rss_after = metrics.current_rss_bytes()
+    runner_bytes = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+
+    def make_runner(folder):
+        if is_tagger:
+            return TestRunnerTagger(old_model_path, new_model_path, folder)
+        return TestRunner(old_model_path, new_model_path, folder, old_expert_path, new_expert_path)
+
+    # Stages run on the runners of the pool; the main runner only collects their results
+    runner = runner_pool.main_runner(first_runner)
+    if resumed and ckpt.restore_runner(runner):
+        logger.info("Restored TestRunner state from checkpoint")
+
+    # Runner changes of every stage stored next to the outputs, to rebuild the reports later
+    recorder = None
+    if report_state.enabled(config) and not is_tagger:
+        recorder = report_state.StateRecorder(runner, output_folder, dict(
+            country=country, segment=segment, version=config.get("version"),
+            old_model=config.get("old_model"), new_model=new_model))
+
+    stages = []
+    skipped = []
+    for stage in build_stages(config):
+        if ckpt is not None and ckpt.is_done(stage["id"]):
+            skipped.append(stage["id"])
+        else:
+            stages.append(stage)
+
+    if memo is not None:
+        rel_models = [p.replace(os.sep, "/") if p else None for p in resolve_model_paths(config, "model")]
+
+    # Large samples run as shards on several VM pairs / local workers, merged afterwards
+    vm_pool = scheduler.vm_slots(config)
+    # One runner per stage running at the same time (Azure Batch shards included), as many as fit in memory
+    runner_slots = runner_pool.runner_budget(config, runner_bytes, len(vm_pool) + 1)
+    sharded = {}   # parent stage id -> {"stage", "shards", "results"}
+    planned = []
+    shard_slots = sharding.shard_slots(config, min(len(vm_pool), runner_slots))
+    shard_metrics = sharding.metrics_hook(config)
+    for stage in stages:
+        # Sharded stages bypass the score cache: keep whole the ones it already holds
+        cached = memo is not None and memo.contains(score_cache.stage_key(stage, segment, fingerprints, *rel_models))
+        shards = None if cached else sharding.plan(stage, config, sample_path, shard_slots)
+        if shards:
+            sharded[stage["id"]] = {"stage": stage, "shards": shards, "results": {}}
+        planned.extend(shards or [stage])
+    stages = planned
+
+    # Samples parsed once into Parquet, memory-mapped by later stages and runs
+    samples = open_sample_cache(config, sample_path)
+    if samples is not None and not sample_cache.install(samples):
+        samples = None
+
+    backends = local_backend.assign_backends(stages, config, sample_path)
+    local_slots = local_backend.local_workers(config) if local_backend.LOCAL in backends else 0
+    local = None
+    if local_slots:
+        spec = local_backend.runner_spec(is_tagger, old_model_path, new_model_path, output_folder,
+                                         old_expert_path, new_expert_path)
+        if samples is not None:
+            spec["sample_cache"] = dict(roots=samples.roots, bucket=samples.bucket,
+                                        s3_prefix=samples.s3_prefix, local_dir=samples.local_dir)
+        local = local_backend.LocalBackend(
+            spec, min(local_slots, len(backends[local_backend.LOCAL])), config.get("local_start_method", "spawn"),
         )
+        local_slots = local.max_workers
+    in_process = [stage for stage in stages if scheduler.needs_runner(stage)]
+    wanted = min(len(in_process), len(vm_pool) + any(not scheduler.needs_vm(stage) for stage in in_process))
+    runners = runner_pool.RunnerPool(lambda: make_runner(output_folder), min(runner_slots, max(1, wanted)),
+                                     first=first_runner)
+    # Every stage writes into its own folder; its files are moved to the output folder when it ends
+    stage_scratch = os.path.join(segment_path, "stage_outputs")
+
+    batch_format = output_format.batch_format(config)
+
+    # Files restored from a checkpoint or written before the first stage are listed, not attributed to any stage
+    out_index = OutputIndex(output_folder)
+    out_index.add(restored)
+    if recorder is not None:
+        out_index.add([path for path in (os.path.join(recorder.folder, recorder.index["base"]),
+                                         os.path.join(recorder.folder, report_state.INDEX_NAME))
+                       if os.path.isfile(path)])
+    batch_area = BatchArea(_get_batch_dir(), os.path.join(segment_path, "batch"), f"{country}/{segment}")
+    # prediction_diff reads every stage's batch CSV at the end: keep them in the checkpoint too
+    keep_batches = ckpt is not None and bool(config.get("prediction_diff"))
+    if keep_batches and resumed:
+        with run_metrics.span("checkpoint.restore_batches"):
+            for stage_id, path in ckpt.restore_batches(os.path.join(segment_path, "checkpoint_batch")).items():
+                batch_area.adopt(stage_id, path)
+
+    def execute(stage, slot):
+        kwargs = dict(batch_kwargs)
+        if slot is not None:
+            kwargs.update(vm_for_bench=slot[0], vm_for_dev=slot[1])
+        t0 = time.perf_counter()
+        batch_mark = batch_area.mark()
+        folder = os.path.join(stage_scratch, stage["id"])
+        outcome = {}
+        if stage.get("shard_of"):
+            with run_metrics.span(f"runner.{stage['method']}", stage=stage["id"], vms=str(slot),
+                                  backend=stage.get("backend") or "none"):
+                if stage.get("backend") == local_backend.LOCAL:
+                    delta = local.run(stage, sample_path, kwargs, output_folder=folder)
+                else:
+                    delta = runners.run(stage, sample_path, kwargs, folder)
+            return dict(seconds=time.perf_counter() - t0, batch_mark=batch_mark, delta=delta)
+        if memo is not None:
+            key = score_cache.stage_key(stage, segment, fingerprints, *rel_models)
+            with run_metrics.span("score_cache.lookup", stage=stage["id"]):
+                hit = memo.get(key, stage["id"], folder)
+            if hit is not None:
+                if hit["batch"]:
+                    batch_area.adopt(stage["id"], hit["batch"])
+                return dict(seconds=time.perf_counter() - t0, memo_hit=True, delta=hit["delta"])
+            outcome["memo_key"] = key
+        with run_metrics.span(f"runner.{stage['method']}", stage=stage["id"], vms=str(slot),
+                              backend=stage.get("backend") or "none"):
+            if stage.get("backend") == local_backend.LOCAL:
+                delta = local.run(stage, sample_path, kwargs, output_folder=folder)
+            else:
+                delta = runners.run(stage, sample_path, kwargs, folder)
+        outcome.update(seconds=time.perf_counter() - t0, delta=delta, batch_mark=batch_mark,
+                       batch_end=batch_area.mark())
+        return outcome
+
+    def on_done(stage, outcome):
+        if not stage.get("shard_of"):
+            # On this thread only: the main runner is never touched while a stage changes it
+            score_cache.apply_delta(runner, outcome["delta"])
+            return finish_stage(stage, outcome)
+        group = sharded[stage["shard_of"]]
+        group["results"][stage["shard_index"]] = outcome
+        if len(group["results"]) == len(group["shards"]):
+            return merge_shards(group)
+
+    def merge_shards(group):
+        parent = group["stage"]
+        results = [group["results"][i] for i in range(len(group["shards"]))]
+        rows = group["shards"][0]["shard_rows"]
+        scratch = [os.path.join(stage_scratch, shard["id"]) for shard in group["shards"]]
+        # Every shard has finished writing: claim their CSVs together, by shard sample name
+        keys = [os.path.splitext(os.path.basename(shard["sample"]))[0] for shard in group["shards"]]
+        batch_area.claim(parent["id"], batch_pattern(segment), min(r["batch_mark"] for r in results),
+                         accept=lambda name: any(is_part(name, key) for key in keys))
+        batch_file = batch_area.merge(parent["id"], keys, sharding.concat_csv)
+        try:
+            with run_metrics.span("shards.merge", stage=parent["id"]):
+                delta, unresolved = sharding.merge_deltas([r["delta"] for r in results], rows, dict(vars(runner)))
+                if unresolved:
+                    # Metrics computed per shard, recomputed from the merged rows and batch CSV
+                    delta = sharding.recompute(shard_metrics, runner, parent, delta, unresolved, batch_file)
+                if parent["report"]:
+                    # The stage report, written by save_reports into the folder the unsharded stage writes to
+                    sharding.rebuild_reports(runner, delta, scratch, f"_{parent['report']}.xlsx",
+                                             os.path.join(stage_scratch, parent["id"]))
+        except sharding.ShardMergeError as e:
+            logger.warning(f"Stage {parent['id']}: shard results cannot be merged exactly ({e}), running it whole")
+            sharding.cleanup(sample_path, parent["id"])
+            for folder in scratch:
+                shutil.rmtree(folder, ignore_errors=True)
+            retry = dict(parent, no_shard=True, backend=local_backend.choose_backend(parent, config, sample_path))
+            if retry["backend"] == local_backend.LOCAL and not local_slots:
+                retry["backend"] = local_backend.AZURE_BATCH
+            return [retry]
+        score_cache.apply_delta(runner, delta)
+        sharding.cleanup(sample_path, parent["id"])
+        for folder in scratch:
+            shutil.rmtree(folder, ignore_errors=True)
+        finish_stage(parent, dict(
+            seconds=sum(r["seconds"] for r in results),
+            shards=len(results),
+        ))
+
+    def finish_stage(stage, outcome):
+        with run_metrics.span("output_index.collect", stage=stage["id"]):
+            produced = out_index.collect(os.path.join(stage_scratch, stage["id"]))
+        stage_outputs = list(produced)
+        if recorder is not None:
+            with run_metrics.span("report_state", stage=stage["id"]):
+                produced += out_index.add(recorder.record(stage["id"]))
+        copies = []
+        if stage["report"]:
+            # Also on a score cache hit: the final names carry this run's date
+            with run_metrics.span("copy_latest_outputs", stage=stage["id"]):
+                if "batch_mark" in outcome:
+                    batch_area.claim(stage["id"], batch_pattern(segment), outcome["batch_mark"], outcome["batch_end"],
+                                     stem=os.path.splitext(os.path.basename(stage["sample"]))[0])
+                copies = copy_latest_outputs(out_index, stage_outputs, segment, stage["report"], country, new_model,
+                                             today, batch_file=batch_area.latest(stage["id"]),
+                                             batch_format=batch_format)
+            if uploader is not None:
+                for _src, dst in copies:
+                    uploader.submit(out_index.abs(dst))
+        out_index.record(stage["id"], produced, copies, report=stage["report"], memo_hit=bool(outcome.get("memo_hit")))
+        stage_files = list(dict.fromkeys(produced + [dst for _src, dst in copies]))
+        if "memo_key" in outcome:
+            with run_metrics.span("score_cache.store", stage=stage["id"]):
+                memo.put(outcome["memo_key"], stage["id"], output_folder, stage_outputs, outcome["delta"],
+                         batch_file=batch_area.latest(stage["id"]))
+        if ckpt is not None:
+            with run_metrics.span("checkpoint.save", stage=stage["id"]):
+                ckpt.mark_done(stage["id"], outcome["seconds"], output_folder, stage_files, runner, uploader,
+                               batch_file=batch_area.latest(stage["id"]) if keep_batches else None)
+
+    # Leases on the VM pairs, so concurrent runs never submit to the same VM
+    leases = open_vm_leases(config) if any(scheduler.needs_vm(stage) for stage in stages) else None
+    stage_scheduler = scheduler.StageScheduler(
+        vm_pool,
+        max_retries=config.get("vm_busy_retries", 3),
+        retry_delay=config.get("vm_busy_retry_delay_s", 60),
+        local_slots=local_slots,
+        leases=leases,
+        lease_retry_delay=config.get("vm_lease_retry_s", 15),
+        runners=runners.size,
+    )
+    try:
+        remaining = stage_scheduler.run(
+            stages, execute, on_done,
+            should_stop=lambda: _should_hand_off(config, context, ckpt),
+        )
+    finally:
+        if leases is not None:
+            leases.close()
+        if local is not None:
+            local.close()
+        runners.close()
+        shutil.rmtree(stage_scratch, ignore_errors=True)
+        if samples is not None:
+            sample_cache.uninstall()
+    handed_off = bool(remaining)
+    if handed_off:
+        # Runner state and batch CSVs were stored with each stage: the next invocation has all it needs
+        hand_off(config, context)
+
+    if not handed_off and config.get("prediction_diff"):
+        # Old vs new predictions of every stage's batch CSV, uploaded with the reports
+        with run_metrics.span("prediction_diff"):
+            diff_files = prediction_diff.write_reports(
+                {stage_id: batch_area.latest(stage_id) for stage_id in batch_area.index},
+                output_folder, prediction_diff.options(config))
+        out_index.record("prediction_diff", out_index.add(diff_files))
+        if uploader is not None:
+            for path in diff_files:
+                uploader.submit(path)
+
+    if not handed_off and not is_tagger:
+        with run_metrics.span("save_reports"):
+            folder = os.path.join(segment_path, "save_reports")
+            runner_pool.save_reports(runner, folder, weights=None, excel=True, pdf=False)
+            reports = out_index.collect(folder)
+        out_index.record("save_reports", reports)
+        if report_sidecar.enabled(config):
+            # One Parquet file per sheet, so readers skip parsing the whole workbook
+            with run_metrics.span("report_sidecar"):
+                sidecar_files = report_sidecar.write_sidecars([out_index.abs(rel) for rel in reports])
+            out_index.record("report_sidecar", out_index.add(sidecar_files))
+    out_index.export()
 
-        for i, f in enumerate(accuracy_files, 1):
-            runner.compute_validation_scores(os.path.join(sample_path, f), save=True, tag=f"A_{i}", **batch_kwargs)
-            copy_latest_outputs(output_folder, segment, "ACC", country, new_model, today)
-
-        for f in anomalies_files:
-            runner.compute_validation_scores(os.path.join(sample_path, f), save=True, tag="ANOM", **batch_kwargs)
-            copy_latest_outputs(output_folder, segment, "ANOM", country, new_model, today)
-
-        for f in precision_files:
-            runner.compute_validation_scores(os.path.join(sample_path, f), save=True, tag="PREC", **batch_kwargs)
-            copy_latest_outputs(output_folder, segment, "PREC", country, new_model, today)
-
-        for i, f in enumerate(stability_files, 1):
-            runner.compute_validation_distribution(os.path.join(sample_path, f), save=True, tag=f"S_{i}", **batch_kwargs)
-            copy_latest_outputs(output_folder, segment, "STAB", country, new_model, today)
+    # Upload results to S3
+    with run_metrics.span("upload_results"):
+        upload_results(config, output_folder, transfer_stats, uploader)
+    batch_area.release()
 
-        runner.save_reports(weights=None, excel=True, pdf=False)
+    if ckpt is not None and not handed_off:
+        ckpt.complete()
 
-    # Upload results to S3
-    upload_results(config, output_folder)
+    history_run_id = None
+    if not handed_off:
+        with run_metrics.span("run_history"):
+            history_run_id = record_run(config, output_folder, stages, started, run_metrics, sample_path,
+                                        ckpt, skipped)
 
     # Cleanup temp files
-    cleanup()
+    with run_metrics.span("cleanup"):
+        cleanup()
 
     result = {
-        "status": "completed",
+        "status": "handed_off" if handed_off else "completed",
         "country": country,
         "segment": segment,
         "version": config.get("version", "x.x.x"),
         "output_folder": output_folder,
+        "backends": backends,
+        "transfers": transfer_stats.summary(),
+        "metrics": run_metrics.summary(),
     }
+    if memo is not None:
+        result["score_cache"] = memo.summary()
+    if samples is not None:
+        result["sample_cache"] = samples.summary()
+    if leases is not None:
+        result["vm_leases"] = leases.summary()
+    if history_run_id is not None:
+        result["run_history_id"] = history_run_id
+    if ckpt is not None:
+        result["checkpoint"] = {
+            "run_id": ckpt.run_id,
+            "resumed": resumed,
+            "skipped_stages": skipped,
+            "completed_stages": ckpt.done_stages(),
+            "handoffs": config.get("_handoffs", 0),
+        }
     logger.info(f"Execution completed: {json.dumps(result)}")
     return result
 
 
+# ============================================================
+#  BATCH MODE  (several configs, one process each)
+# ============================================================
+
+def _config_label(config, index):
+    return config.get("_source") or f"{index}:{config.get('country')}/{config.get('segment')}"
+
+
+def _batch_child(config, conn):
+    try:
+        result = {"status": "completed", "result": run_tests(config)}
+    except Exception as e:
+        logger.exception(f"Run failed for {config.get('country')}/{config.get('segment')}")
+        result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+    try:
+        conn.send(result)
+    finally:
+        conn.close()
+
+
+def run_batch(configs, max_workers=None, work_base=None):
+    """
+    Run several configs in parallel, each in its own process and working root
+    under work_base. Uses plain Process + Pipe because Lambda has no /dev/shm for
+    multiprocessing pools. Returns an aggregated result with per-config status and timings.
+    """
+    import tempfile
+    import multiprocessing
+    from multiprocessing.connection import wait as wait_conns
+
+    max_workers = max_workers or int(os.environ.get("BATCH_MAX_WORKERS", "4"))
+    work_base = work_base or os.environ.get("BATCH_WORK_BASE", "/tmp")
+    os.makedirs(work_base, exist_ok=True)
+
+    pending = list(enumerate(configs))
+    running = {}   # conn -> (index, process, start, work_root created here or None)
+    runs = [None] * len(configs)
+    t_batch = time.perf_counter()
+
+    while pending or running:
+        while pending and len(running) < max_workers:
+            index, cfg = pending.pop(0)
+            cfg = dict(cfg)
+            own_root = None
+            if "work_root" not in cfg:
+                own_root = cfg["work_root"] = tempfile.mkdtemp(
+                    prefix=f"TEST_SUITE_{cfg.get('country')}_{cfg.get('segment')}_", dir=work_base)
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=_batch_child, args=(cfg, child_conn), daemon=False)
+            proc.start()
+            child_conn.close()
+            running[parent_conn] = (index, proc, time.perf_counter(), own_root)
+            logger.info(f"Batch: started {_config_label(cfg, index)} (pid {proc.pid})")
+
+        for conn in wait_conns(list(running)):
+            index, proc, start, own_root = running.pop(conn)
+            try:
+                outcome = conn.recv()
+            except EOFError:
+                outcome = {"status": "failed", "error": "worker process exited without a result"}
+            conn.close()
+            proc.join()
+            if own_root:
+                # run_tests cleans up after itself, but not when it failed
+                shutil.rmtree(own_root, ignore_errors=True)
+            if proc.exitcode not in (0, None) and outcome["status"] == "completed":
+                outcome = {"status": "failed", "error": f"worker exit code {proc.exitcode}"}
+            cfg = configs[index]
+            runs[index] = dict(
+                config=_config_label(cfg, index),
+                country=cfg.get("country"),
+                segment=cfg.get("segment"),
+                seconds=round(time.perf_counter() - start, 3),
+                **outcome,
+            )
+            logger.info(f"Batch: {runs[index]['config']} {outcome['status']} in {runs[index]['seconds']}s")
+
+    failed = sum(1 for r in runs if r["status"] != "completed")
+    return {
+        "status": "completed" if not failed else ("failed" if failed == len(runs) else "partial"),
+        "total": len(runs),
+        "failed": failed,
+        "max_workers": max_workers,
+        "seconds": round(time.perf_counter() - t_batch, 3),
+        "runs": runs,
+    }
+
+
+def load_configs(paths):
+    """Configs from JSON files (one config or a list) and directories of *.json files."""
+    configs = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+        for fpath in files:
+            with open(fpath, "r") as f:
+                data = json.load(f)
+            for i, cfg in enumerate(data if isinstance(data, list) else [data]):
+                cfg.setdefault("_source", fpath if not isinstance(data, list) else f"{fpath}[{i}]")
+                configs.append(cfg)
+    return configs
+
+
 # ============================================================
 #  ENTRY POINTS
 # ============================================================
 
+def invalidate_score_cache(config):
+    """Drop every stored stage result for the config's segment, locally and on S3."""
+    memo = open_score_cache(dict(config, score_cache=True))
+    deleted = memo.invalidate()
+    return {"status": "invalidated", "country": config["country"], "segment": config["segment"],
+            "deleted_objects": deleted}
+
+
+def rebuild_reports(config):
+    """
+    Final reports rebuilt from the report_state of a previous run of the config, with
+    report_weights / report_excel / report_pdf; no model, sample or VM is touched.
+    """
+    s3_bucket, s3_output_prefix = _output_location(config)
+    if not s3_bucket:
+        raise ValueError("s3_bucket and s3_prefix are required")
+    warmup.add_ce_paths(config)
+    s3 = _get_s3(config)
+    opts = _transfer_opts(config)
+    work_root = config.get("work_root", "/tmp/TEST_SUITE_REBUILD")
+    shutil.rmtree(work_root, ignore_errors=True)
+    state_dir = os.path.join(work_root, report_state.FOLDER)
+    out_dir = os.path.join(work_root, "reports")
+    s3_download_prefix(s3, s3_bucket, config.get("report_state_prefix") or f"{s3_output_prefix}{report_state.FOLDER}/",
+                       state_dir, **opts)
+    if not os.path.isfile(os.path.join(state_dir, report_state.INDEX_NAME)):
+        raise FileNotFoundError(f"No report_state under s3://{s3_bucket}/{s3_output_prefix}: "
+                                f"run the config once with \"report_state\": true")
+    try:
+        files = report_state.rebuild(state_dir, out_dir, weights=config.get("report_weights"),
+                                     excel=config.get("report_excel", True), pdf=config.get("report_pdf", False))
+        if report_sidecar.enabled(config):
+            report_sidecar.write_sidecars([os.path.join(out_dir, *rel.split("/")) for rel in files])
+        dest = config.get("rebuild_output_prefix") or \
+            f"{s3_output_prefix}rebuilt/{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}/"
+        s3_upload_dir(s3, s3_bucket, out_dir, dest, **opts)
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+    return {"status": "rebuilt", "country": config["country"], "segment": config["segment"],
+            "reports": files, "s3_prefix": f"s3://{s3_bucket}/{dest}"}
+
+
+def plan_run(config, context=None):
+    """Dry run: inputs, /tmp and duration estimates and recommendations, without downloading or scoring."""
+    s3_bucket, s3_base = _input_location(config)
+    if not s3_bucket:
+        raise ValueError("s3_bucket is required")
+    history = open_run_history(config)
+    if history is not None:
+        try:
+            history.sync(config["country"], config["segment"])
+        except Exception as e:
+            logger.warning(f"Run history not synced from S3: {e}")
+    remaining = _remaining_seconds(context)
+    return planner.plan(config, _get_s3(config), s3_bucket, s3_base, required_artifacts(config), history,
+                        timeout_s=config.get("lambda_timeout_s") or (round(remaining) if remaining else None))
+
+
 def handler(event, context):
     """AWS Lambda entry point."""
     logger.info(f"Lambda event: {json.dumps(event, default=str)}")
-    return run_tests(event)
+    if "configs" in event:
+        return run_batch(event["configs"], max_workers=event.get("max_workers"), work_base=event.get("work_base"))
+    if event.get("mode") == "invalidate_score_cache":
+        return invalidate_score_cache(event)
+    if event.get("mode") == "warmup":
+        return warmup.warmup(event, _get_s3)
+    if event.get("mode") == "profile_imports":
+        return warmup.profile_imports(event, top=event.get("top", 20))
+    if event.get("mode") == "plan":
+        return plan_run(event, context)
+    if event.get("mode") == "rebuild_reports":
+        return rebuild_reports(event)
+    return run_tests(event, context)
 
 
 def main():
     """CLI entry point for local execution."""
     parser = argparse.ArgumentParser(description="Run TestSuite")
-    parser.add_argument("--config", required=True, help="Path to config JSON file")
+    parser.add_argument("--config", action="append",
+                        help="Path to config JSON file, JSON list of configs or directory of configs (repeatable)")
+    parser.add_argument("--max-workers", type=int, default=None,
+                        help="Parallel runs in batch mode (default: BATCH_MAX_WORKERS or 4)")
+    parser.add_argument("--invalidate-score-cache", action="store_true",
+                        help="Delete the stored stage results of each config's segment and exit")
+    parser.add_argument("--warmup", action="store_true",
+                        help="Import the TestRunner, load .NET and create the S3 client, then exit")
+    parser.add_argument("--profile-imports", action="store_true",
+                        help="Report the most expensive imports of the TestRunner modules and exit")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Plan each config (inputs, /tmp, duration, recommendations) without running it")
+    parser.add_argument("--rebuild-reports", action="store_true",
+                        help="Rebuild the final reports of each config from its stored report_state and exit")
     args = parser.parse_args()
-
-    with open(args.config, "r") as f:
-        config = json.load(f)
-
-    result = run_tests(config)
+    if not args.config and not (args.warmup or args.profile_imports):
+        parser.error("--config is required")
+
+    configs = load_configs(args.config) if args.config else [{}]
+    if args.warmup:
+        result = warmup.warmup(configs[0], _get_s3)
+    elif args.profile_imports:
+        result = warmup.profile_imports(configs[0])
+    elif args.dry_run:
+        result = [plan_run(cfg) for cfg in configs]
+    elif args.rebuild_reports:
+        result = [rebuild_reports(cfg) for cfg in configs]
+    elif args.invalidate_score_cache:
+        result = [invalidate_score_cache(cfg) for cfg in configs]
+    elif len(configs) == 1 and not os.path.isdir(args.config[0]):
+        result = run_tests(configs[0])
+    else:
+        result = run_batch(configs, max_workers=args.max_workers)
     print(json.dumps(result, indent=2))
 
 
@@ -0,0 +1,334 @@
+"""
+Background job queue for the dashboard.
+
+A job is one config run by a target function ("module:function") in its own
+"spawn" process, so the Streamlit script only submits and polls: a rerun or a
+browser refresh does not interrupt it, and jobs for different countries /
+segments run side by side (at most max_workers at a time, the rest queued).
+
+Jobs, their stages and their log lines are kept in a SQLite table (WAL, one
+connection per call), written by the job processes and read by any dashboard
+session, so a reloaded page reattaches to a running job by its id. Queued jobs
+survive a restart of the dashboard; running jobs whose process stopped
+sending heartbeats are marked "interrupted".
+
+The target is called as target(config, progress), with progress a Progress
+bound to the job; its return value (JSON-serializable) is stored as the
+job result.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import traceback
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, COMPLETED, FAILED, INTERRUPTED = "queued", "running", "completed", "failed", "interrupted"
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, label TEXT, config TEXT, status TEXT, pid INTEGER,
+    created REAL, started REAL, finished REAL, heartbeat REAL, error TEXT, result TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT, stage_id TEXT, position INTEGER, status TEXT, started REAL, finished REAL, detail TEXT,
+    PRIMARY KEY (job_id, stage_id)
+);
+CREATE TABLE IF NOT EXISTS logs (
+    job_id TEXT, ts REAL, level TEXT, message TEXT, kind TEXT
+);
+CREATE INDEX IF NOT EXISTS logs_job ON logs (job_id, ts);
+"""
+
+
+HEARTBEAT_S = 10
+# A running job without a heartbeat for this long has lost its process
+STALE_S = 6 * HEARTBEAT_S
+
+
+def _now():
+    return time.time()
+
+
+# ============================================================
+#  STORE
+# ============================================================
+
+class JobStore:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            # Tables created before log events had a kind
+            if "kind" not in [row["name"] for row in db.execute("PRAGMA table_info(logs)")]:
+                db.execute("ALTER TABLE logs ADD COLUMN kind TEXT")
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _write(self, sql, args=()):
+        db = self._connect()
+        try:
+            with db:
+                db.execute(sql, args)
+        finally:
+            db.close()
+
+    def _read(self, sql, args=()):
+        db = self._connect()
+        try:
+            return [dict(row) for row in db.execute(sql, args)]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _decode(job):
+        for field in ("config", "result"):
+            if job.get(field):
+                job[field] = json.loads(job[field])
+        return job
+
+    def create(self, label, config):
+        job_id = uuid.uuid4().hex[:12]
+        self._write("INSERT INTO jobs (id, label, config, status, created) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, label, json.dumps(config, default=str), QUEUED, _now()))
+        return job_id
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], default=str)
+        cols = ", ".join(f"{name} = ?" for name in fields)
+        self._write(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        rows = self._read("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._decode(rows[0]) if rows else None
+
+    def list(self, limit=50, statuses=None):
+        """Most recent jobs first; statuses restricts them (e.g. ACTIVE)."""
+        if statuses:
+            marks = ", ".join("?" for _ in statuses)
+            rows = self._read(f"SELECT * FROM jobs WHERE status IN ({marks}) ORDER BY created DESC LIMIT ?",
+                              (*statuses, limit))
+        else:
+            rows = self._read("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,))
+        return [self._decode(row) for row in rows]
+
+    def plan_stages(self, job_id, stage_ids):
+        db = self._connect()
+        try:
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO stages (job_id, stage_id, position, status) VALUES (?, ?, ?, 'pending')",
+                    [(job_id, stage_id, i) for i, stage_id in enumerate(stage_ids)])
+        finally:
+            db.close()
+
+    def stage(self, job_id, stage_id, status, **detail):
+        now = _now()
+        started = now if status == RUNNING else None
+        finished = now if status not in ("pending", RUNNING) else None
+        self._write(
+            "INSERT INTO stages (job_id, stage_id, position, status, started, finished, detail) "
+            "VALUES (?, ?, (SELECT COUNT(*) FROM stages WHERE job_id = ?), ?, ?, ?, ?) "
+            "ON CONFLICT (job_id, stage_id) DO UPDATE SET status = excluded.status, "
+            "started = COALESCE(excluded.started, stages.started), finished = excluded.finished, "
+            "detail = COALESCE(excluded.detail, stages.detail)",
+            (job_id, stage_id, job_id, status, started, finished, json.dumps(detail, default=str) if detail else None))
+
+    def stages(self, job_id):
+        rows = self._read("SELECT * FROM stages WHERE job_id = ? ORDER BY position", (job_id,))
+        for row in rows:
+            row["detail"] = json.loads(row["detail"]) if row["detail"] else {}
+        return rows
+
+    def log(self, job_id, message, level="info", kind=None):
+        self._write("INSERT INTO logs (job_id, ts, level, message, kind) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, _now(), level, message, kind))
+
+    def log_many(self, job_id, entries):
+        """entries: (ts, level, message, kind) tuples, written in one transaction."""
+        db = self._connect()
+        try:
+            with db:
+                db.executemany("INSERT INTO logs (job_id, ts, level, message, kind) VALUES (?, ?, ?, ?, ?)",
+                               [(job_id, *entry) for entry in entries])
+        finally:
+            db.close()
+
+    def logs(self, job_id, limit=200):
+        rows = self._read("SELECT * FROM logs WHERE job_id = ? ORDER BY ts DESC LIMIT ?", (job_id, limit))
+        return rows[::-1]
+
+
+class Progress:
+    """What a job target reports while it runs."""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    def plan(self, stage_ids):
+        self.store.plan_stages(self.job_id, list(stage_ids))
+
+    def stage(self, stage_id, status, **detail):
+        self.store.stage(self.job_id, stage_id, status, **detail)
+
+    def log(self, message, level="info"):
+        self.store.log(self.job_id, message, level)
+
+    def events(self, entries):
+        """Batch of (ts, level, message, kind) log events, e.g. from a log_pipeline sink."""
+        if entries:
+            self.store.log_many(self.job_id, entries)
+
+
+# ============================================================
+#  WORKER PROCESS
+# ============================================================
+
+def _job_main(store_path, job_id, target, sys_path):
+    for p in reversed(sys_path):
+        if p not in sys.path:
+            sys.path.insert(0, p)
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)s [job {job_id}] %(message)s")
+    store = JobStore(store_path)
+    job = store.get(job_id)
+    progress = Progress(store, job_id)
+
+    def beat():
+        while True:
+            try:
+                store.update(job_id, heartbeat=_now())
+            except Exception as e:
+                logger.warning(f"Job heartbeat: {e}")
+            time.sleep(HEARTBEAT_S)
+
+    threading.Thread(target=beat, name="job-heartbeat", daemon=True).start()
+    try:
+        module_name, func_name = target.split(":")
+        func = getattr(__import__(module_name, fromlist=[func_name]), func_name)
+        result = func(job["config"], progress)
+    except BaseException as e:
+        store.update(job_id, status=FAILED, finished=_now(), error=f"{type(e).__name__}: {e}")
+        progress.log(traceback.format_exc(), "error")
+        raise SystemExit(1)
+    store.update(job_id, status=COMPLETED, finished=_now(), result=result)
+
+
+class JobQueue:
+    """Runs queued jobs of a JobStore, each in its own process, at most max_workers at a time."""
+
+    def __init__(self, store, target, max_workers=2, start_method="spawn", poll_s=1.0):
+        self.store = store
+        self.target = target
+        self.max_workers = max(1, int(max_workers))
+        self.poll_s = poll_s
+        self._ctx = multiprocessing.get_context(start_method)
+        self._running = {}            # job id -> Process
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._recover()
+        self._thread = threading.Thread(target=self._loop, name="job-queue", daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        """Jobs left running by a previous dashboard process whose process is gone (no recent heartbeat)."""
+        for job in self.store.list(limit=1000, statuses=[RUNNING]):
+            if _now() - (job["heartbeat"] or job["started"] or 0) > STALE_S:
+                self.store.update(job["id"], status=INTERRUPTED, finished=_now(),
+                                  error="Job process lost (dashboard restarted?)")
+
+    def submit(self, config, label):
+        """Queue a config; refuses a second active job with the same label (same output folder)."""
+        for job in self.store.list(limit=1000, statuses=ACTIVE):
+            if job["label"] == label:
+                raise ValueError(f"Job {job['id']} for {label} is already {job['status']}")
+        job_id = self.store.create(label, config)
+        self._wake.set()
+        return job_id
+
+    def _reap(self):
+        with self._lock:
+            finished = [(job_id, proc) for job_id, proc in self._running.items() if not proc.is_alive()]
+            for job_id, _proc in finished:
+                del self._running[job_id]
+        for job_id, proc in finished:
+            proc.join()
+            job = self.store.get(job_id)
+            if job and job["status"] == RUNNING:
+                # Killed before it could record an outcome (out of memory, terminated)
+                self.store.update(job_id, status=FAILED, finished=_now(),
+                                  error=f"Job process exited with code {proc.exitcode}")
+
+    def _start_queued(self):
+        with self._lock:
+            free = self.max_workers - len(self._running)
+        if free <= 0:
+            return
+        # Oldest first
+        for job in self.store.list(limit=1000, statuses=[QUEUED])[::-1][:free]:
+            proc = self._ctx.Process(target=_job_main, args=(self.store.path, job["id"], self.target, list(sys.path)),
+                                     name=f"job-{job['id']}", daemon=False)
+            self.store.update(job["id"], status=RUNNING, started=_now(), heartbeat=_now())
+            proc.start()
+            self.store.update(job["id"], pid=proc.pid)
+            with self._lock:
+                self._running[job["id"]] = proc
+            logger.info(f"Job {job['id']} ({job['label']}) started, pid {proc.pid}")
+
+    def _loop(self):
+        while True:
+            try:
+                self._reap()
+                self._start_queued()
+            except Exception as e:
+                logger.warning(f"Job queue: {e}")
+            self._wake.wait(self.poll_s)
+            self._wake.clear()
+
+    def cancel(self, job_id):
+        """Drop a queued job or terminate a running one."""
+        with self._lock:
+            proc = self._running.get(job_id)
+        if proc is not None:
+            proc.terminate()
+            proc.join(10)
+        job = self.store.get(job_id)
+        if job and job["status"] in ACTIVE:
+            self.store.update(job_id, status=INTERRUPTED, finished=_now(), error="Cancelled")
+
+    def running(self):
+        with self._lock:
+            return list(self._running)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(db_path, target, max_workers=2):
+    """The process-wide queue for db_path, so Streamlit reruns share its worker thread."""
+    with _queues_lock:
+        queue = _queues.get(db_path)
+        if queue is None:
+            queue = _queues[db_path] = JobQueue(JobStore(db_path), target, max_workers)
+        else:
+            queue.max_workers = max(1, int(max_workers))
+        return queue
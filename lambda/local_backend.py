@@ -0,0 +1,340 @@
+"""
+Local execution backend: scores validation stages on the host's cores.
+
+Stages whose sample is small enough run here instead of on an Azure Batch VM
+pair, where provisioning alone can take longer than scoring. Each worker is a
+separate process holding its own TestRunner (built once, on its first stage);
+it runs the stage with azure_batch=False and sends back the runner attributes
+the stage changed (score_cache.state_delta), which the caller applies to the
+main runner. Reports go to the folder the caller passes for the stage, batch
+CSVs to the shared batch folder. With the sample cache on, workers read the
+samples through it as well.
+
+Workers talk over plain Process + Pipe (Lambda has no /dev/shm for
+multiprocessing pools) and use the "spawn" start method by default, so no
+TensorFlow or .NET state is forked.
+
+Backend choice (choose_backend), per stage:
+  execution_backend  "auto" (default), "azure_batch" or "local"
+  local_max_rows     auto: samples with at most this many rows run locally;
+                     a number, or {"ANOM": 20000, "PREC": 20000, "default": 5000};
+                     unset: every stage stays on Azure Batch
+  local_max_mb       auto, for samples whose rows cannot be counted (not CSV)
+  local_workers      worker processes (default: CPU count)
+
+Benchmark with no network (local model and sample files):
+  python local_backend.py --config bench.json --workers 1,2,4,8
+"""
+
+import os
+import sys
+import time
+import pickle
+import logging
+import threading
+import traceback
+import multiprocessing
+
+import score_cache
+import sample_cache
+import s3_transfer
+from scheduler import run_stage
+
+logger = logging.getLogger(__name__)
+
+AZURE_BATCH = "azure_batch"
+LOCAL = "local"
+
+ROW_COUNT_EXTENSIONS = (".csv", ".tsv", ".txt")
+
+
+# ============================================================
+#  BACKEND CHOICE
+# ============================================================
+
+def sample_rows(path):
+    """Data rows of a delimited text sample (header excluded), or None for other formats."""
+    if not path.lower().endswith(ROW_COUNT_EXTENSIONS):
+        return None
+    lines, last = 0, b"\n"
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        lines += 1
+    return max(0, lines - 1)
+
+
+def _threshold(value, report):
+    """Per-report threshold; None (the default) keeps the stage on Azure Batch."""
+    if isinstance(value, dict):
+        return value.get(report, value.get("default"))
+    return value
+
+
+def local_workers(config):
+    return int(config.get("local_workers") or os.cpu_count() or 1)
+
+
+def choose_backend(stage, config, sample_path):
+    """AZURE_BATCH or LOCAL for one stage; stages without a sample (crossvalidation) return None."""
+    if not stage["sample"]:
+        return None
+    mode = config.get("execution_backend", "auto")
+    if mode in (AZURE_BATCH, LOCAL):
+        return mode
+    if mode != "auto":
+        raise ValueError(f"Unknown execution_backend: {mode}")
+    if local_workers(config) < 1:
+        return AZURE_BATCH
+
+    path = os.path.join(sample_path, stage["sample"])
+    rows = sample_rows(path) if os.path.isfile(path) else None
+    return backend_for_size(stage, config, rows, os.path.getsize(path) if os.path.isfile(path) else None)
+
+
+def backend_for_size(stage, config, rows, size):
+    """Backend of an "auto" stage whose sample has rows rows (None when unknown) and size bytes."""
+    report = stage["report"] or stage["id"]
+    if rows is not None:
+        max_rows = _threshold(config.get("local_max_rows"), report)
+        return LOCAL if max_rows is not None and rows <= max_rows else AZURE_BATCH
+    max_mb = _threshold(config.get("local_max_mb"), report)
+    if max_mb is not None and size is not None and size <= max_mb * 1024 * 1024:
+        return LOCAL
+    return AZURE_BATCH
+
+
+def assign_backends(stages, config, sample_path):
+    """Set stage["backend"] on every stage; returns {backend: [stage ids]} for logging."""
+    chosen = {}
+    for stage in stages:
+        stage["backend"] = choose_backend(stage, config, sample_path)
+        if stage["backend"]:
+            chosen.setdefault(stage["backend"], []).append(stage["id"])
+    for backend, ids in chosen.items():
+        logger.info(f"Backend {backend}: {', '.join(ids)}")
+    return chosen
+
+
+# ============================================================
+#  WORKERS
+# ============================================================
+
+def runner_spec(is_tagger, old_model_path, new_model_path, output_folder, old_expert_path=None, new_expert_path=None):
+    """Picklable recipe to build the same TestRunner in a worker process."""
+    if is_tagger:
+        return dict(module="suite_tests.testRunner_tagger", cls="TestRunner",
+                    args=[old_model_path, new_model_path, output_folder], sys_path=list(sys.path))
+    return dict(module="suite_tests.testRunner", cls="TestRunner",
+                args=[old_model_path, new_model_path, output_folder, old_expert_path, new_expert_path],
+                sys_path=list(sys.path))
+
+
+def _dump_delta(delta):
+    """Pickle a runner delta, leaving out values that cannot cross processes (models, handles)."""
+    try:
+        return pickle.dumps(delta, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        pass
+    kept, skipped = {"set": {}, "dict": {}, "list": {}}, []
+    for kind, entries in delta.items():
+        for name, value in entries.items():
+            try:
+                pickle.dumps(value)
+            except Exception:
+                skipped.append(name)
+                continue
+            kept[kind][name] = value
+    logger.warning(f"Runner attributes not sent back from local worker: {', '.join(skipped)}")
+    return pickle.dumps(kept, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _worker_main(spec, conn):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [local %(process)d] %(message)s")
+    for p in reversed(spec["sys_path"]):
+        if p not in sys.path:
+            sys.path.insert(0, p)
+    if spec.get("sample_cache"):
+        opts = spec["sample_cache"]
+        try:
+            sample_cache.install(sample_cache.SampleCache(
+                opts["roots"], s3_transfer.get_client() if opts["bucket"] else None,
+                opts["bucket"], opts["s3_prefix"], opts["local_dir"]))
+        except Exception as e:
+            logger.warning(f"Sample cache not available in local worker: {e}")
+    runner = None
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        stage, sample_path, kwargs, output_folder = task
+        try:
+            if runner is None:
+                module = __import__(spec["module"], fromlist=[spec["cls"]])
+                runner = getattr(module, spec["cls"])(*spec["args"])
+            default_folder = runner.output_folder
+            if output_folder:
+                # Shards write their partial reports to a scratch folder
+                os.makedirs(output_folder, exist_ok=True)
+                runner.output_folder = output_folder
+            try:
+                before = score_cache.shallow_state(runner)
+                run_stage(runner, stage, sample_path, kwargs)
+                delta = score_cache.state_delta(before, runner)
+            finally:
+                runner.output_folder = default_folder
+            payload = ("ok", _dump_delta(delta))
+        except Exception as e:
+            payload = ("error", f"{type(e).__name__}: {e}\n{traceback.format_exc()}")
+        conn.send(payload)
+    conn.close()
+
+
+class _Worker:
+
+    def __init__(self, ctx, spec):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(spec, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self, timeout=10):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class LocalBackend:
+    """Pool of up to max_workers runner processes, started on demand."""
+
+    def __init__(self, spec, max_workers, start_method="spawn"):
+        self.spec = spec
+        self.max_workers = max(1, int(max_workers))
+        self._ctx = multiprocessing.get_context(start_method)
+        self._idle = []
+        self._started = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._started >= self.max_workers:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return _Worker(self._ctx, self.spec)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        with self._cond:
+            if worker is None:
+                self._started -= 1
+            else:
+                self._idle.append(worker)
+            self._cond.notify()
+
+    def run(self, stage, sample_path, kwargs, output_folder=None):
+        """
+        Run one stage in a worker and return the runner delta it produced.
+        output_folder, if given, replaces the runner's output folder for this stage only.
+        """
+        worker = self._acquire()
+        kwargs = dict(kwargs, azure_batch=False)
+        try:
+            worker.conn.send((stage, sample_path, kwargs, output_folder))
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died (typically out of memory): drop it, a new one starts on demand
+            worker.stop(timeout=0)
+            self._release(None)
+            raise RuntimeError(f"Local worker for stage {stage['id']} exited: {e}") from e
+        self._release(worker)
+        if status == "error":
+            raise RuntimeError(f"Stage {stage['id']} failed in local worker: {payload}")
+        return pickle.loads(payload)
+
+    def close(self):
+        with self._cond:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.stop()
+
+
+# ============================================================
+#  BENCHMARK
+# ============================================================
+
+def benchmark(config, workers_list):
+    """
+    Time the config's scoring stages on the local backend for each worker count.
+    Models and samples are read from local paths (models_dir, sample_dir), so no network is used.
+    """
+    from scheduler import build_stages, StageScheduler
+    from warmup import add_ce_paths
+
+    add_ce_paths(config)
+
+    is_tagger = config["segment"].lower() == "tagger"
+    models_dir = config["models_dir"]
+    expert = os.path.join(models_dir, "expertrules")
+    old_expert = os.path.join(expert, config["old_expert_rules"]) if config.get("old_expert_rules") else None
+    new_expert = os.path.join(expert, config["new_expert_rules"]) if config.get("new_expert_rules") else None
+    stages = [s for s in build_stages(config) if s["sample"]]
+    results = []
+    for n in workers_list:
+        output_folder = os.path.join(config.get("bench_output", "/tmp/local_bench"), f"workers_{n}")
+        os.makedirs(output_folder, exist_ok=True)
+        spec = runner_spec(is_tagger, os.path.join(models_dir, "prod", config["old_model"]),
+                           os.path.join(models_dir, "develop", config["new_model"]),
+                           output_folder, old_expert, new_expert)
+        backend = LocalBackend(spec, n, config.get("local_start_method", "spawn"))
+        kwargs = dict(old_expert_rules_zip_path=old_expert, new_expert_rules_zip_path=new_expert) if not is_tagger else {}
+        for stage in stages:
+            stage["backend"] = LOCAL
+        t0 = time.perf_counter()
+        try:
+            StageScheduler([], local_slots=n).run(
+                stages, lambda stage, _slot: backend.run(stage, config["sample_dir"], kwargs))
+        finally:
+            backend.close()
+        seconds = round(time.perf_counter() - t0, 3)
+        results.append({"workers": n, "stages": len(stages), "seconds": seconds})
+        logger.info(f"Local backend, {n} workers: {len(stages)} stages in {seconds}s")
+    return results
+
+
+def main():
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the local execution backend (no network)")
+    parser.add_argument("--config", required=True,
+                        help="Config JSON with models_dir, sample_dir and local model/sample names")
+    parser.add_argument("--workers", default=str(os.cpu_count() or 1),
+                        help="Comma-separated worker counts to compare (default: CPU count)")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    print(json.dumps(benchmark(config, [int(n) for n in args.workers.split(",")]), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main()
@@ -0,0 +1,224 @@
+"""
+Buffered log capture of a run, parsed into structured events off the hot path.
+
+The TestRunner, TensorFlow and the .NET bridge write a lot to stdout / stderr
+and to the root logger. Capturing that line by line (substring checks, a
+database write per message) slows the run and floods the UI. LogPipeline
+splits the work:
+
+  - writers only append (stream, time, text) or a log record to a bounded ring
+    buffer (collections.deque): no formatting or parsing on their thread; past
+    half its capacity the background thread is woken early, and when it is full
+    the oldest entries are dropped and counted;
+  - a background thread drains it every flush_s seconds, writes every line to a
+    gzip-compressed raw log (run_log.txt.gz, uploaded with the outputs) and
+    parses the lines into events:
+        stage_start, stage_end   scheduler / stage messages
+        vm_busy                  "Virtual machine is already running"
+        error, warning           log records >= WARNING, tracebacks on stderr
+        progress                 "45%", "12/100" progress bars (last one per flush)
+    repeated events within a flush are collapsed into one with a count;
+  - sink(events) receives each batch once per flush (the dashboard job writes
+    it to its job table in a single transaction, and the page renders it at its
+    own refresh rate).
+
+Plain chatter (INFO lines that match no rule) only goes to the raw log.
+"""
+
+import re
+import sys
+import gzip
+import time
+import logging
+import threading
+from collections import deque
+
+from scheduler import VM_BUSY_MARKER
+
+logger = logging.getLogger(__name__)
+
+RAW_LOG_NAME = "run_log.txt.gz"
+DEFAULT_CAPACITY = 20000
+DEFAULT_FLUSH_S = 0.5
+
+# (kind, regex) tried in order on every line; the first match wins
+RULES = (
+    ("vm_busy", re.compile(re.escape(VM_BUSY_MARKER))),
+    ("stage_start", re.compile(r"Stage (?P<stage>[\w#]+) -> (?P<target>.+)")),
+    ("stage_end", re.compile(r"Stage (?P<stage>[\w#]+) (?P<outcome>completato|completed|failed)")),
+    ("error", re.compile(r"^(Traceback \(most recent call last\)|\w*(Error|Exception)\b:)")),
+    ("progress", re.compile(r"(?P<pct>\d{1,3})%\||\b(?P<done>\d+)/(?P<total>\d+)\s*\[")),
+)
+
+LEVEL_KINDS = {logging.ERROR: "error", logging.WARNING: "warning"}
+
+
+def parse_line(line, level=None):
+    """Event dict for one line (kind, message and named groups), or None for plain chatter."""
+    for kind, rx in RULES:
+        m = rx.search(line)
+        if m:
+            event = {"kind": kind, "message": line.strip()}
+            event.update({k: v for k, v in m.groupdict().items() if v is not None})
+            return event
+    if level is not None and level >= logging.WARNING:
+        return {"kind": LEVEL_KINDS[logging.ERROR if level >= logging.ERROR else logging.WARNING],
+                "message": line.strip()}
+    return None
+
+
+class LogPipeline:
+
+    def __init__(self, raw_path=None, sink=None, capacity=DEFAULT_CAPACITY, flush_s=DEFAULT_FLUSH_S):
+        self.raw_path = raw_path
+        self.sink = sink
+        self.flush_s = flush_s
+        self._buffer = deque(maxlen=capacity)
+        self._high_water = capacity // 2
+        self.dropped = 0              # entries pushed out of the full buffer (approximate)
+        self._partial = {}            # stream name -> text after its last newline
+        self._raw = gzip.open(raw_path, "wt", encoding="utf-8", compresslevel=6) if raw_path else None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self.counts = {}              # event kind -> events seen
+        self._thread = threading.Thread(target=self._loop, name="log-pipeline", daemon=True)
+        self._thread.start()
+
+    # --- writer side: append only ---
+
+    def _append(self, item):
+        size = len(self._buffer)
+        if size >= self._high_water:
+            if size == self._buffer.maxlen:
+                self.dropped += 1
+            self._wake.set()              # drain early instead of waiting for the next tick
+        self._buffer.append(item)
+
+    def feed(self, stream, text):
+        self._append((stream, time.time(), text))
+
+    def feed_record(self, record):
+        self._append((None, record.created, record))
+
+    # --- background side ---
+
+    def _lines(self, items):
+        """(ts, level, stream, line) of the drained items, joining partial writes per stream."""
+        for stream, ts, item in items:
+            if stream is None:
+                record = item
+                try:
+                    text = record.getMessage()
+                except Exception:
+                    text = str(record.msg)
+                yield ts, record.levelno, f"{record.levelname} {record.name}", text
+                continue
+            text = self._partial.pop(stream, "") + item
+            *complete, rest = text.split("\n")
+            if rest:
+                self._partial[stream] = rest
+            for line in complete:
+                if line.strip():
+                    yield ts, None, stream, line.rstrip()
+
+    def flush(self):
+        with self._flush_lock:
+            items = []
+            while True:
+                try:
+                    items.append(self._buffer.popleft())
+                except IndexError:
+                    break
+            if not items:
+                return
+            events, seen, progress = [], {}, None
+            raw = []
+            for ts, level, source, line in self._lines(items):
+                raw.append(f"{time.strftime('%H:%M:%S', time.localtime(ts))} [{source}] {line}\n")
+                event = parse_line(line, level)
+                if event is None:
+                    continue
+                event["ts"] = ts
+                self.counts[event["kind"]] = self.counts.get(event["kind"], 0) + 1
+                if event["kind"] == "progress":
+                    progress = event
+                    continue
+                key = (event["kind"], event["message"])
+                if key in seen:
+                    seen[key]["count"] += 1
+                    continue
+                event["count"] = 1
+                seen[key] = event
+                events.append(event)
+            if progress is not None:
+                events.append(dict(progress, count=1))
+            if self._raw is not None and raw:
+                self._raw.writelines(raw)
+            if events and self.sink is not None:
+                try:
+                    self.sink(events)
+                except Exception as e:
+                    sys.__stderr__.write(f"log pipeline sink failed: {e}\n")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_s)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.flush()
+
+    def close(self):
+        """Stop the thread, flush what is left and close the raw log; returns its path."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        for stream in list(self._partial):
+            self._append((stream, time.time(), "\n"))
+        self.flush()
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+        return self.raw_path
+
+    def summary(self):
+        return {"events": dict(self.counts), "dropped": self.dropped, "raw_log": self.raw_path}
+
+
+# ============================================================
+#  CAPTURE
+# ============================================================
+
+class PipelineHandler(logging.Handler):
+    """Root logger handler feeding records to the pipeline unformatted."""
+
+    def __init__(self, pipeline, level=logging.INFO):
+        super().__init__(level)
+        self.pipeline = pipeline
+
+    def emit(self, record):
+        if self.pipeline is not None and record.name != __name__:
+            self.pipeline.feed_record(record)
+
+
+class StreamCapture:
+    """stdout / stderr replacement: notice() hook on the writer's thread, then buffer and pass through."""
+
+    def __init__(self, original, name, pipeline, notice=None):
+        self.original = original
+        self.name = name
+        self.pipeline = pipeline
+        self.notice = notice
+
+    def write(self, text):
+        if self.notice is not None:
+            self.notice(text)
+        if self.pipeline is not None:
+            self.pipeline.feed(self.name, text)
+        return self.original.write(text)
+
+    def flush(self):
+        self.original.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
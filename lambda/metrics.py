@@ -0,0 +1,136 @@
+"""
+Span timers and resource metrics for handler.py.
+
+Every span records wall time, the process peak RSS and the bytes used on the
+/tmp volume when it ends. Spans are returned in the result dict and, on
+Lambda (or with emit_emf), printed as CloudWatch Embedded Metric Format lines
+so they become metrics without any API call.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "TestSuite")
+MB = 1024 * 1024
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_bytes():
+    """High-water mark of resident memory for this process and its finished children."""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def current_rss_bytes():
+    """Resident memory of this process right now (Linux), or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def tmp_used_bytes(path="/tmp"):
+    try:
+        return shutil.disk_usage(path).used
+    except OSError:
+        return None
+
+
+def _mb(value):
+    return round(value / MB, 1) if value is not None else None
+
+
+class Metrics:
+
+    def __init__(self, dimensions=None, emit_emf=None, tmp_path="/tmp"):
+        self.dimensions = dict(dimensions or {})
+        if emit_emf is None:
+            emit_emf = "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+        self.emit_emf = emit_emf
+        self.tmp_path = tmp_path
+        self.spans = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **dimensions):
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record(name, time.perf_counter() - t0, status=status, **dimensions)
+
+    def record(self, name, seconds, status="ok", **dimensions):
+        entry = {
+            "name": name,
+            "seconds": round(seconds, 3),
+            "status": status,
+            "peak_rss_mb": _mb(peak_rss_bytes()),
+            "tmp_used_mb": _mb(tmp_used_bytes(self.tmp_path)),
+        }
+        entry.update(dimensions)
+        with self._lock:
+            self.spans.append(entry)
+        logger.info(f"[metrics] {name}: {entry['seconds']}s, peak RSS {entry['peak_rss_mb']} MB, "
+                    f"/tmp {entry['tmp_used_mb']} MB")
+        if self.emit_emf:
+            self._emit(entry)
+        return entry
+
+    def _emit(self, entry):
+        dims = dict(self.dimensions, Span=entry["name"])
+        doc = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [sorted(dims)],
+                    "Metrics": [
+                        {"Name": "Duration", "Unit": "Seconds"},
+                        {"Name": "PeakRSS", "Unit": "Megabytes"},
+                        {"Name": "TmpUsed", "Unit": "Megabytes"},
+                    ],
+                }],
+            },
+            "Duration": entry["seconds"],
+            "PeakRSS": entry["peak_rss_mb"] or 0,
+            "TmpUsed": entry["tmp_used_mb"] or 0,
+            "Status": entry["status"],
+        }
+        doc.update({k: str(v) for k, v in dims.items()})
+        # Extra span fields (stage, mode, ...) travel as searchable properties, not dimensions
+        doc.update({k: v for k, v in entry.items() if k not in ("name", "seconds", "status",
+                                                                 "peak_rss_mb", "tmp_used_mb")})
+        # EMF lines must reach stdout as a single JSON document each
+        sys.__stdout__.write(json.dumps(doc) + "\n")
+        sys.__stdout__.flush()
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "total_seconds": round(time.perf_counter() - self._start, 3),
+            "peak_rss_mb": _mb(peak_rss_bytes()),
+            "spans": spans,
+        }
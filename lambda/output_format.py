@@ -0,0 +1,105 @@
+"""
+Storage format of the batch CSVs copied into the output folder.
+
+The renamed batch CSVs are the largest outputs: they are uploaded to S3 and
+downloaded again by their readers. write_batch() copies one into the output
+folder in the configured format, streaming it so the file is never held in
+memory:
+  csv       plain copy (default)
+  csv.gz    gzip-compressed CSV
+  csv.zst   zstandard-compressed CSV (needs zstandard, else csv.gz)
+  parquet   Parquet with zstd compression, every column as text so values are
+            kept exactly as written (needs pyarrow, else csv.gz)
+
+Config batch_output_format, or the BATCH_OUTPUT_FORMAT environment variable.
+"""
+
+import os
+import csv
+import gzip
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "csv.gz", "csv.zst", "parquet")
+
+CHUNK_BYTES = 1024 * 1024
+PARQUET_BLOCK_BYTES = 16 * 1024 * 1024
+
+
+def batch_format(config):
+    fmt = (config.get("batch_output_format") or os.environ.get("BATCH_OUTPUT_FORMAT") or "csv").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown batch_output_format: {fmt} (one of {', '.join(FORMATS)})")
+    return fmt
+
+
+def target_path(csv_path, fmt):
+    """Output path of a .csv destination once written in fmt."""
+    base = csv_path[:-4] if csv_path.lower().endswith(".csv") else csv_path
+    return f"{base}.{fmt}"
+
+
+def _sniff_header(path):
+    with open(path, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+        line = f.readline().rstrip("\r\n")
+    sep = max(",;\t|", key=line.count)
+    return sep, next(csv.reader([line], delimiter=sep), [])
+
+
+def _write_gzip(src, dst):
+    with open(src, "rb") as fin, gzip.open(dst, "wb", compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK_BYTES)
+
+
+def _write_zstd(src, dst):
+    import zstandard
+
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        zstandard.ZstdCompressor(level=3).copy_stream(fin, fout, read_size=CHUNK_BYTES)
+
+
+def _write_parquet(src, dst):
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    sep, header = _sniff_header(src)
+    reader = pacsv.open_csv(
+        src,
+        read_options=pacsv.ReadOptions(block_size=PARQUET_BLOCK_BYTES),
+        parse_options=pacsv.ParseOptions(delimiter=sep, newlines_in_values=True),
+        # Text columns only: the type inferred from the first block may not fit the later ones
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in header},
+                                             strings_can_be_null=False),
+    )
+    with pq.ParquetWriter(dst, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def write_batch(src, dst_csv, fmt="csv"):
+    """
+    Write the batch CSV src to dst_csv (a .csv path) in fmt; returns the path written,
+    whose extension follows the format actually used.
+    """
+    if fmt == "csv":
+        shutil.copy2(src, dst_csv)
+        return dst_csv
+    writers = {"csv.gz": _write_gzip, "csv.zst": _write_zstd, "parquet": _write_parquet}
+    dst = target_path(dst_csv, fmt)
+    tmp = dst + ".tmp"
+    try:
+        writers[fmt](src, tmp)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if not isinstance(e, ImportError):
+            raise
+        logger.warning(f"Batch output format {fmt} not available ({e}), writing csv.gz")
+        return write_batch(src, dst_csv, "csv.gz")
+    os.replace(tmp, dst)
+    src_size, size = os.path.getsize(src), os.path.getsize(dst)
+    logger.info(f"Batch CSV written as {fmt}: {src_size} -> {size} bytes")
+    return dst
@@ -0,0 +1,191 @@
+"""
+Index of the files each stage wrote to the output folder, and the copies of
+the stage reports under their final names.
+
+Nothing walks the output folder: each stage (and save_reports) writes into a
+folder of its own, and collect() moves those files into the output folder
+when it ends, so they belong to that stage whatever ran at the same time and
+only files that are new are ever looked at. Files placed by the handler
+itself (report and batch copies, checkpoint restores, sidecars) are
+registered with add(). copy_latest_outputs() finds a stage's report among the
+files recorded for it. The index is exported as output_manifest.json next to
+the reports.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+import output_format
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "output_manifest.json"
+
+
+class OutputIndex:
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.stages = []
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def rel(self, path):
+        return os.path.relpath(path, self.output_folder).replace("\\", "/")
+
+    def abs(self, rel):
+        return os.path.join(self.output_folder, *rel.split("/"))
+
+    @staticmethod
+    def _sig(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def collect(self, folder):
+        """
+        Move the files a stage wrote into its own folder (removed afterwards) to the same relative
+        paths in the output folder and register them; returns their relative paths.
+        """
+        moved = []
+        for root, _dirs, files in os.walk(folder):
+            for fname in files:
+                src = os.path.join(root, fname)
+                dst = self.abs(os.path.relpath(src, folder).replace("\\", "/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+                moved.append(dst)
+        shutil.rmtree(folder, ignore_errors=True)
+        return sorted(self.add(moved))
+
+    def add(self, paths):
+        """Register files written into the output folder; returns their relative paths."""
+        rels = []
+        with self._lock:
+            for path in paths:
+                rel = self.rel(path)
+                self._known[rel] = self._sig(path)
+                rels.append(rel)
+        return rels
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path if os.path.isabs(path) else self.abs(path))
+        except OSError:
+            return None
+
+    def record(self, stage_id, produced, copies=(), **extra):
+        """
+        produced: files the stage wrote; copies: (src, dst_rel) pairs, src relative when inside the folder.
+        Copies keep the size of both sides (the batch CSV may be stored compressed).
+        """
+        entry = dict(stage=stage_id, produced=list(produced),
+                     copies=[{"src": src, "dst": dst, "src_size": self._size(src), "size": self._size(dst)}
+                             for src, dst in copies],
+                     finished_at=time.strftime("%Y-%m-%d %H:%M:%S"), **extra)
+        with self._lock:
+            self.stages.append(entry)
+        return entry
+
+    def stage_files(self, stage_id):
+        files = []
+        with self._lock:
+            for entry in self.stages:
+                if entry["stage"] == stage_id:
+                    files += entry["produced"] + [c["dst"] for c in entry["copies"]]
+        return list(dict.fromkeys(files))
+
+    def export(self):
+        """Write output_manifest.json in the output folder; returns its path."""
+        with self._lock:
+            doc = {
+                "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "stages": list(self.stages),
+                "files": {rel: {"size": sig[0]} for rel, sig in sorted(self._known.items())},
+            }
+        path = os.path.join(self.output_folder, MANIFEST_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+
+# ============================================================
+#  REPORT COPIES
+# ============================================================
+
+# Report type of a stage -> suffix of the TestRunner's report, name used in the final file names
+REPORTS = {
+    "ACC": ("_ACC.xlsx", "Accuracy"),
+    "ANOM": ("_ANOM.xlsx", "Anomalie"),
+    "PREC": ("_PREC.xlsx", "Precision"),
+    "STAB": ("_STAB.xlsx", "Stabilità"),
+}
+
+
+def model_scope(model_name, country_code):
+    """IN when the model name has "1" after the country code (it_1_...), else OUT."""
+    try:
+        parts = model_name.split("_")
+        if parts[parts.index(country_code) + 1] == "1":
+            return "IN"
+    except Exception:
+        pass
+    return "OUT"
+
+
+def _log_copy(event, name, error=None):
+    if event == "report":
+        logger.info(f"Copied report: {name}")
+    elif event == "batch":
+        logger.info(f"Copied batch file: {name}")
+    elif event == "no_batch":
+        logger.warning(f"No batch CSV for this {name} stage, skipping batch CSV copy")
+    else:
+        logger.warning(f"Failed to copy {name}: {error}")
+
+
+def copy_latest_outputs(index, produced, segment, report_type, country_code, model_name, date_str,
+                        batch_file=None, batch_format="csv", notify=None):
+    """
+    Copy a stage's report and batch CSV under their final names into the output folder and register them.
+    produced are the files recorded for the stage (relative paths): the report is looked up among them,
+    in the TestRunner's subfolders. batch_file is the CSV the stage claimed in its BatchArea, written in
+    batch_format (see output_format). notify(event, name, error=None) hears of every copy ("report",
+    "batch"), of a missing batch CSV ("no_batch", with the report type) and of failures ("failed");
+    by default they are logged.
+    Returns (src, dst) pairs for record(): dst relative, src relative when inside the output folder.
+    """
+    notify = notify or _log_copy
+    suffix, name = REPORTS[report_type]
+    scope = model_scope(model_name, country_code)
+
+    copies = []
+    for rel in produced:
+        if "/" not in rel or not rel.endswith(suffix):
+            continue
+        new_name = f"report_{name}_{country_code}_CE_{segment}_{scope}_{date_str}.xlsx"
+        try:
+            shutil.copy2(index.abs(rel), index.abs(new_name))
+        except Exception as e:
+            notify("failed", rel, e)
+            continue
+        copies.append((rel, index.add([index.abs(new_name)])[0]))
+        notify("report", new_name)
+
+    if batch_file is None:
+        notify("no_batch", report_type)
+        return copies
+    new_batch_name = f"{name}_{country_code}_CE_{segment}_{scope}_{date_str}.csv"
+    try:
+        dst = output_format.write_batch(batch_file, index.abs(new_batch_name), batch_format)
+    except Exception as e:
+        notify("failed", batch_file, e)
+        return copies
+    copies.append((batch_file, index.add([dst])[0]))
+    notify("batch", os.path.basename(dst))
+    return copies
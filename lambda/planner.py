@@ -0,0 +1,311 @@
+"""
+Pre-flight plan of a run: what it will download, how much /tmp it needs and
+how long it should take, without downloading or scoring anything.
+
+  inputs      the S3 objects run_tests would download (download_mode "full":
+              everything under sample/ and model/; "selective": only the
+              artifacts of the config), their total size, and the required
+              artifacts that are missing
+  storage     inputs + sample shards + outputs (median of the previous runs of
+              the segment in the run history) against the ephemeral storage
+  stages      rows of every sample (exact from the run history when the same
+              file was seen with the same size, else estimated from its first
+              plan_probe_kb KB, read with a ranged GET), backend, shards, and
+              seconds: rows x the median seconds per row of the same method on
+              the same backend in the run history, else the median seconds of
+              the same stage
+  duration    the stages laid out on the VM pairs and local workers as the
+              scheduler would, plus the median non-stage time of the previous
+              runs (download, reports, upload), against the Lambda timeout
+  recommendations
+              what to change when the run is blocked or does not fit: selective
+              download, more ephemeral storage, sharding, more VM pairs, or
+              splitting sample_files across several configs (batch mode)
+
+Config:
+  ephemeral_storage_mb  /tmp budget (default: size of /tmp on Lambda, else 512)
+  lambda_timeout_s      invocation budget (default: the remaining time of the
+                        planning invocation on Lambda, else 900)
+  plan_probe_kb         bytes read from each sample to estimate its rows (default 256)
+"""
+
+import os
+import math
+import shutil
+import logging
+import statistics
+
+import s3_transfer
+import local_backend
+import scheduler
+import sharding
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+DEFAULT_STORAGE_MB = 512          # Lambda default ephemeral storage
+DEFAULT_TIMEOUT_S = 900
+DEFAULT_PROBE_KB = 256
+
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def _mb(n):
+    return round(n / MB, 1) if n is not None else None
+
+
+# ============================================================
+#  INPUTS
+# ============================================================
+
+def list_inputs(s3, bucket, base_prefix, required, download_mode="full"):
+    """
+    ({key: size} of the objects the run would download, missing required entries).
+    required: the config's artifacts relative to base_prefix (handler.required_artifacts).
+    """
+    objects, missing = {}, []
+    for rel in required:
+        key = base_prefix + rel
+        found = {k: size for k, size, _etag in s3_transfer.list_prefix(s3, bucket, key)
+                 if (k == key or k.startswith(key.rstrip("/") + "/")) and not k.endswith("/")}
+        if not found:
+            missing.append(rel)
+        if download_mode == "selective":
+            objects.update(found)
+    if download_mode == "full":
+        for subdir in ("sample", "model"):
+            for key, size, _etag in s3_transfer.list_prefix(s3, bucket, f"{base_prefix}{subdir}/"):
+                if not key.endswith("/"):
+                    objects[key] = size
+    elif download_mode != "selective":
+        raise ValueError(f"Unknown download_mode: {download_mode}")
+    return objects, missing
+
+
+def probe_rows(s3, bucket, key, size, probe_bytes):
+    """Data rows of a delimited sample estimated from its first probe_bytes (exact when it fits)."""
+    if not key.lower().endswith(local_backend.ROW_COUNT_EXTENSIONS):
+        return None
+    if size == 0:
+        return 0
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{probe_bytes - 1}")["Body"].read()[:probe_bytes]
+    header_end = body.find(b"\n") + 1
+    if len(body) >= size:
+        lines = body.count(b"\n") + (0 if body.endswith(b"\n") else 1)
+        return max(0, lines - 1)
+    data = body[header_end:body.rfind(b"\n") + 1] if header_end else b""
+    rows = data.count(b"\n")
+    if not rows:
+        return None
+    return int(round((size - header_end) / (len(data) / rows)))
+
+
+# ============================================================
+#  ESTIMATES
+# ============================================================
+
+def _known_rows(history_stages, sample, size):
+    """Row count recorded for the same sample file with the same size."""
+    for row in history_stages:
+        if row["sample"] == sample and row["sample_bytes"] == size and row["sample_rows"] is not None:
+            return row["sample_rows"]
+    return None
+
+
+def estimate_seconds(stage, rows, history_stages):
+    """(seconds, source) of one stage from the run history, or (None, None)."""
+    same_method = [r for r in history_stages if r["method"] == stage["method"] and r["seconds"] is not None]
+    for backend in (stage.get("backend"), None):
+        rated = [r["seconds"] / r["sample_rows"] for r in same_method
+                 if r["sample_rows"] and (backend is None or r["backend"] == backend)]
+        if rows and rated:
+            return round(rows * _median(rated), 1), "history_rate" if backend else "history_rate_any_backend"
+    same_stage = [r["seconds"] for r in history_stages if r["stage_id"] == stage["id"] and r["seconds"] is not None]
+    if same_stage:
+        return round(_median(same_stage), 1), "history_stage"
+    return None, None
+
+
+def layout(stages, vm_pairs, local_slots):
+    """Finish time of the stages laid out in order on the VM pairs / local workers, like StageScheduler."""
+    vm_free = [0.0] * max(1, vm_pairs)
+    local_free = [0.0] * max(1, local_slots)
+    end = 0.0
+    for stage in stages:
+        seconds = stage["seconds"] or 0.0
+        if scheduler.needs_local_slot(stage):
+            lane = local_free
+        elif scheduler.needs_vm(stage):
+            lane = vm_free
+        else:
+            end = max(end, seconds)          # runs alongside the others (crossvalidation)
+            continue
+        i = lane.index(min(lane))
+        lane[i] += seconds
+        end = max(end, lane[i])
+    return end
+
+
+def _overhead(history, country, segment):
+    """Median seconds of previous runs not spent in stages (download, reports, upload)."""
+    overheads = []
+    for run in history.runs(country, segment, status="completed", limit=10):
+        stages = history.run(run["run_id"])["stages"]
+        if not stages:
+            continue
+        vm_pairs = len(scheduler.vm_slots(dict(run["config"], segment=segment)))
+        busy = layout([dict(s, id=s["stage_id"]) for s in stages], vm_pairs,
+                      local_backend.local_workers(run["config"]))
+        overheads.append(max(0.0, run["duration_s"] - busy))
+    return _median(overheads)
+
+
+def storage_budget_mb(config):
+    if config.get("ephemeral_storage_mb"):
+        return config["ephemeral_storage_mb"], "config"
+    if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+        return round(shutil.disk_usage("/tmp").total / MB), "lambda /tmp"
+    return DEFAULT_STORAGE_MB, "default"
+
+
+# ============================================================
+#  PLAN
+# ============================================================
+
+def plan(config, s3, bucket, base_prefix, required, history=None, timeout_s=None):
+    """Plan of the run described by config; see the module docstring for the fields."""
+    country = config["country"]
+    segment = config["segment"].lower()
+    download_mode = config.get("download_mode", os.environ.get("DOWNLOAD_MODE", "full"))
+    probe_bytes = int(config.get("plan_probe_kb", DEFAULT_PROBE_KB)) * 1024
+    recommendations = []
+
+    objects, missing = list_inputs(s3, bucket, base_prefix, required, download_mode)
+    input_bytes = sum(objects.values())
+    if download_mode == "full":
+        selective, _ = list_inputs(s3, bucket, base_prefix, required, "selective")
+        selective_bytes = sum(selective.values())
+    else:
+        selective_bytes = input_bytes
+
+    history_stages = history.stage_timings(country, segment, limit=500) if history is not None else []
+    previous = history.runs(country, segment, status="completed", limit=10) if history is not None else []
+
+    # --- stages ---
+    stages = scheduler.build_stages(config)
+    vm_pairs = len(scheduler.vm_slots(config))
+    local_slots = local_backend.local_workers(config)
+    mode = config.get("execution_backend", "auto")
+    shard_slots = sharding.shard_slots(config, vm_pairs)
+    shard_bytes = 0
+    planned = []
+    for stage in stages:
+        entry = dict(id=stage["id"], method=stage["method"], sample=stage["sample"], bytes=None, rows=None,
+                     rows_source=None, backend=None, shards=1, seconds=None, seconds_source=None)
+        if stage["sample"]:
+            key = f"{base_prefix}sample/{stage['sample']}"
+            size = objects.get(key)
+            entry["bytes"] = size
+            if size is not None:
+                entry["rows"] = _known_rows(history_stages, stage["sample"], size)
+                entry["rows_source"] = "history" if entry["rows"] is not None else None
+                if entry["rows"] is None:
+                    try:
+                        entry["rows"] = probe_rows(s3, bucket, key, size, probe_bytes)
+                        entry["rows_source"] = "probe" if entry["rows"] is not None else None
+                    except Exception as e:
+                        logger.warning(f"Plan: cannot probe {key}: {e}")
+            if mode in (local_backend.AZURE_BATCH, local_backend.LOCAL):
+                entry["backend"] = mode
+            elif local_slots >= 1:
+                entry["backend"] = local_backend.backend_for_size(stage, config, entry["rows"], size)
+            else:
+                entry["backend"] = local_backend.AZURE_BATCH
+        stage_for_estimate = dict(stage, backend=entry["backend"])
+        entry["seconds"], entry["seconds_source"] = estimate_seconds(stage_for_estimate, entry["rows"],
+                                                                     history_stages)
+        min_rows = config.get("shard_min_rows")
+        if (min_rows is not None and entry["rows"] and entry["rows"] > min_rows
+                and stage["sample"].lower().endswith(".csv")):
+            entry["shards"] = sharding.shard_count(config, shard_slots, entry["rows"])
+            shard_bytes += entry["bytes"] or 0
+        planned.append(entry)
+
+    lanes = []
+    for entry in planned:
+        if entry["shards"] > 1:
+            part = (entry["seconds"] or 0.0) / entry["shards"]
+            lanes += [dict(entry, id=f"{entry['id']}#{i}", seconds=part) for i in range(entry["shards"])]
+        else:
+            lanes.append(entry)
+    stage_seconds = layout(lanes, vm_pairs, local_slots)
+    overhead = _overhead(history, country, segment) if history is not None else None
+    unknown = [e["id"] for e in planned if e["seconds"] is None]
+    total = stage_seconds + (overhead or 0.0)
+
+    # --- storage ---
+    output_bytes = _median([sum(a["size"] for a in history.run(r["run_id"])["artifacts"]) for r in previous]) \
+        if previous else None
+    needed = input_bytes + shard_bytes + (output_bytes or 0)
+    budget_mb, budget_source = storage_budget_mb(config)
+    storage = dict(budget_mb=budget_mb, budget_source=budget_source, inputs_mb=_mb(input_bytes),
+                   shards_mb=_mb(shard_bytes), outputs_mb=_mb(output_bytes), needed_mb=_mb(needed))
+
+    # --- duration ---
+    if timeout_s is None:
+        timeout_s = config.get("lambda_timeout_s", DEFAULT_TIMEOUT_S)
+    # Time an invocation can spend on stages before handing off (handler._should_hand_off)
+    usable = max(timeout_s - config.get("handoff_margin_s", 120), timeout_s / 2)
+    checkpointing = bool(bucket) and config.get("checkpoint", True)
+    invocations = max(1, math.ceil(total / usable)) if total > timeout_s else 1
+    longest = max((e for e in lanes if e["seconds"]), key=lambda e: e["seconds"], default=None)
+    duration = dict(stages_s=round(stage_seconds, 1), overhead_s=round(overhead, 1) if overhead is not None else None,
+                    total_s=round(total, 1), timeout_s=timeout_s, invocations=invocations, vm_pairs=vm_pairs,
+                    local_workers=local_slots, unknown_stages=unknown)
+
+    # --- recommendations ---
+    status = "ok"
+    if missing:
+        status = "blocked"
+        recommendations.append(f"Missing on s3://{bucket}/{base_prefix}: {', '.join(missing)}")
+    if needed > budget_mb * MB:
+        status = "blocked"
+        if download_mode == "full" and selective_bytes < input_bytes:
+            recommendations.append(f"Use \"download_mode\": \"selective\": inputs drop from {_mb(input_bytes)} MB "
+                                   f"to {_mb(selective_bytes)} MB")
+        recommendations.append(f"Raise the Lambda ephemeral storage to at least "
+                               f"{int(math.ceil(needed / MB * 1.2 / 512) * 512)} MB, or split sample_files "
+                               f"across several configs (batch mode)")
+    if total > timeout_s:
+        if longest is not None and longest["seconds"] > usable:
+            status = "blocked"
+            recommendations.append(
+                f"Stage {longest['id']} alone needs ~{round(longest['seconds'])}s, more than one invocation: set "
+                f"shard_min_rows below its {longest['rows']} rows to split it across VM pairs, or run on ECS")
+        elif checkpointing and invocations - 1 <= config.get("max_handoffs", 5):
+            status = "warning" if status == "ok" else status
+            recommendations.append(f"Needs ~{invocations} invocations: the checkpoint hands off "
+                                   f"{invocations - 1} time(s)")
+        else:
+            status = "blocked"
+            recommendations.append(f"~{round(total)}s exceeds the {timeout_s}s timeout and cannot hand off "
+                                   f"(checkpoint off or max_handoffs reached)")
+        vm_seconds = sum(e["seconds"] or 0 for e in lanes if scheduler.needs_vm(e))
+        if vm_seconds and stage_seconds > usable - (overhead or 0):
+            pairs = math.ceil(vm_seconds / max(1.0, usable - (overhead or 0)))
+            if pairs > vm_pairs:
+                recommendations.append(f"Fan out over {pairs} VM pairs (vm_pool) to fit one invocation")
+        if len(planned) > 2:
+            recommendations.append("Or split sample_files into several configs and run them as a batch "
+                                   "({\"configs\": [...]}), one invocation each")
+    if unknown:
+        status = "warning" if status == "ok" else status
+        recommendations.append(f"No timing history for {', '.join(unknown)}: duration is a lower bound")
+
+    return dict(status=status, country=country, segment=segment, download_mode=download_mode,
+                inputs=dict(objects=len(objects), total_mb=_mb(input_bytes), missing=missing,
+                            keys=sorted(objects)),
+                storage=storage, stages=planned, duration=duration, recommendations=recommendations)
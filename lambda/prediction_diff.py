@@ -0,0 +1,300 @@
+"""
+Row-level comparison of old and new predictions in the batch CSVs.
+
+The categorized / tagged CSV of a stage holds, for every transaction, the
+category given by the old and by the new model. diff_file() reads it in
+chunks (only the needed columns, as strings) and accumulates, with vectorized
+pandas operations:
+  - the category transition matrix (old -> new, row counts);
+  - per-category flip rates (rows of each old category whose prediction changed);
+  - the most frequent changed merchants / descriptions, with their transition.
+
+Memory is bounded by the chunk size and by max_tracked, the number of
+(text, old, new) groups kept per text column: beyond it only the largest
+counts are kept, so the top list of a very long tail may undercount.
+
+write_reports() writes prediction_diff.json (summaries) and
+prediction_diff.parquet (full transition matrix of every stage, CSV without
+pyarrow) into the output folder, so they are uploaded with the reports.
+
+Config "prediction_diff": true, or a dict with
+  old_column, new_column   prediction columns (default: detected from the header,
+                           e.g. category_old / category_new, old_tag / new_tag)
+  text_columns             merchant / description columns (default: detected)
+  chunk_rows               rows per chunk (default 200000)
+  top                      changed texts listed per column (default 50)
+  max_tracked              groups kept per text column (default 100000)
+
+Standalone:
+  python prediction_diff.py --csv Accuracy_it_CE_Consumer_OUT_250101.csv --out diff/
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIFF_JSON = "prediction_diff.json"
+DIFF_PARQUET = "prediction_diff.parquet"
+
+# Old/new naming pairs seen in prediction columns, tried in order
+PAIR_TOKENS = (("old", "new"), ("prod", "develop"), ("prod", "dev"), ("bench", "dev"))
+LABEL_HINTS = ("categ", "tag", "pred", "label", "class")
+TEXT_HINTS = ("merchant", "description", "desc", "counterpart", "text")
+
+DEFAULTS = dict(old_column=None, new_column=None, text_columns=None,
+                chunk_rows=200_000, top=50, max_tracked=100_000)
+
+
+def options(config):
+    value = config.get("prediction_diff")
+    opts = dict(DEFAULTS)
+    if isinstance(value, dict):
+        opts.update({k: v for k, v in value.items() if k in DEFAULTS})
+    return opts
+
+
+# ============================================================
+#  COLUMNS
+# ============================================================
+
+def _tokens(name):
+    return [t for t in re.split(r"[^0-9a-z]+", name.lower()) if t]
+
+
+def find_prediction_columns(header):
+    """(old, new) prediction column names from a CSV header, or None."""
+    by_tokens = {tuple(_tokens(col)): col for col in header}
+    candidates = []
+    for old_tok, new_tok in PAIR_TOKENS:
+        for tokens, col in by_tokens.items():
+            if old_tok not in tokens:
+                continue
+            counterpart = by_tokens.get(tuple(new_tok if t == old_tok else t for t in tokens))
+            if counterpart:
+                labelled = any(hint in t for t in tokens for hint in LABEL_HINTS)
+                candidates.append((not labelled, len(candidates), col, counterpart))
+    if not candidates:
+        return None
+    _unlabelled, _order, old, new = min(candidates)
+    return old, new
+
+
+def find_text_columns(header, exclude=()):
+    return [col for col in header
+            if col not in exclude and any(hint in col.lower() for hint in TEXT_HINTS)]
+
+
+def sniff_header(path):
+    """(separator, column names) from the first line of a CSV."""
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        line = f.readline().rstrip("\r\n")
+    sep = max(",;\t|", key=line.count)
+    return sep, next(csv.reader([line], delimiter=sep))
+
+
+# ============================================================
+#  DIFF
+# ============================================================
+
+class PredictionDiff:
+    """Accumulates the old/new comparison over the chunks of one CSV."""
+
+    def __init__(self, old_column, new_column, text_columns=(), top=50, max_tracked=100_000):
+        self.old_column = old_column
+        self.new_column = new_column
+        self.text_columns = list(text_columns)
+        self.top = top
+        self.max_tracked = max_tracked
+        self.rows = 0
+        self.changed = 0
+        self.transitions = None                     # Series indexed by (old, new)
+        self.changed_texts = {col: None for col in self.text_columns}
+        self.truncated = set()
+
+    def update(self, chunk):
+        import pandas as pd
+
+        old = chunk[self.old_column].fillna("").astype(str)
+        new = chunk[self.new_column].fillna("").astype(str)
+        flipped = old.to_numpy() != new.to_numpy()
+        self.rows += len(chunk)
+        self.changed += int(flipped.sum())
+
+        pairs = pd.DataFrame({"old": old, "new": new}).groupby(["old", "new"], sort=False).size()
+        self.transitions = pairs if self.transitions is None else self.transitions.add(pairs, fill_value=0)
+
+        if not flipped.any():
+            return
+        for col in self.text_columns:
+            moved = pd.DataFrame({"text": chunk[col].fillna("").astype(str).to_numpy()[flipped],
+                                  "old": old.to_numpy()[flipped], "new": new.to_numpy()[flipped]})
+            counts = moved.groupby(["text", "old", "new"], sort=False).size()
+            acc = self.changed_texts[col]
+            acc = counts if acc is None else acc.add(counts, fill_value=0)
+            if len(acc) > self.max_tracked:
+                acc = acc.nlargest(self.max_tracked)
+                self.truncated.add(col)
+            self.changed_texts[col] = acc
+
+    def transition_frame(self):
+        import pandas as pd
+
+        if self.transitions is None:
+            return pd.DataFrame(columns=["old", "new", "rows"])
+        frame = self.transitions.astype("int64").rename("rows").reset_index()
+        return frame.sort_values(["rows", "old", "new"], ascending=[False, True, True], ignore_index=True)
+
+    def flip_rates(self):
+        frame = self.transition_frame()
+        if frame.empty:
+            return []
+        flips = frame[frame["old"] != frame["new"]]
+        # Categories only the new model predicts have no old rows, only rows flipped in
+        categories = frame["old"].drop_duplicates().tolist()
+        seen = set(categories)
+        categories += [c for c in flips["new"].drop_duplicates() if c not in seen]
+        total = frame.groupby("old")["rows"].sum().reindex(categories, fill_value=0)
+        out = flips.groupby("old")["rows"].sum().reindex(categories, fill_value=0)
+        into = flips.groupby("new")["rows"].sum().reindex(categories, fill_value=0)
+        rates = [
+            {"category": cat, "rows": int(total[cat]), "flipped_out": int(out[cat]), "flipped_in": int(into[cat]),
+             "flip_rate": round(float(out[cat]) / float(total[cat]), 6) if total[cat] else 0.0}
+            for cat in categories
+        ]
+        return sorted(rates, key=lambda r: (-r["flipped_out"], r["category"]))
+
+    def top_changed(self):
+        result = {}
+        for col, acc in self.changed_texts.items():
+            if acc is None:
+                result[col] = []
+                continue
+            result[col] = [
+                {"text": text, "old": old, "new": new, "rows": int(rows)}
+                for (text, old, new), rows in acc.nlargest(self.top).items()
+            ]
+        return result
+
+    def summary(self):
+        return {
+            "old_column": self.old_column,
+            "new_column": self.new_column,
+            "rows": self.rows,
+            "changed": self.changed,
+            "change_rate": round(self.changed / self.rows, 6) if self.rows else 0.0,
+            "flip_rates": self.flip_rates(),
+            "top_changed": self.top_changed(),
+            "top_changed_truncated": sorted(self.truncated),
+        }
+
+
+def diff_file(path, old_column=None, new_column=None, text_columns=None, chunk_rows=200_000, top=50,
+              max_tracked=100_000):
+    """PredictionDiff of one batch CSV, or None when its prediction columns cannot be found."""
+    import pandas as pd
+
+    sep, header = sniff_header(path)
+    if old_column and new_column:
+        missing = [c for c in (old_column, new_column) if c not in header]
+        if missing:
+            logger.warning(f"Prediction diff: {os.path.basename(path)} has no column {', '.join(missing)}")
+            return None
+    else:
+        found = find_prediction_columns(header)
+        if found is None:
+            logger.warning(f"Prediction diff: no old/new prediction columns in {os.path.basename(path)}")
+            return None
+        old_column, new_column = found
+    if text_columns is None:
+        text_columns = find_text_columns(header, exclude=(old_column, new_column))
+    text_columns = [c for c in text_columns if c in header]
+
+    diff = PredictionDiff(old_column, new_column, text_columns, top=top, max_tracked=max_tracked)
+    reader = pd.read_csv(path, sep=sep, usecols=[old_column, new_column] + text_columns, dtype=str,
+                         keep_default_na=False, chunksize=chunk_rows, encoding="utf-8-sig",
+                         encoding_errors="replace")
+    with reader:
+        for chunk in reader:
+            diff.update(chunk)
+    return diff
+
+
+# ============================================================
+#  REPORTS
+# ============================================================
+
+def write_reports(batch_files, output_folder, opts=None):
+    """
+    Diff every {stage_id: csv_path} and write prediction_diff.json / .parquet into output_folder.
+    Returns the paths written (none when no file could be compared).
+    """
+    opts = dict(DEFAULTS, **(opts or {}))
+    stages, frames = {}, []
+    for stage_id, path in batch_files.items():
+        if not path or not os.path.isfile(path):
+            continue
+        t0 = time.perf_counter()
+        try:
+            diff = diff_file(path, **opts)
+        except Exception as e:
+            logger.warning(f"Prediction diff of {stage_id} failed: {e}")
+            continue
+        if diff is None:
+            continue
+        stages[stage_id] = dict(file=os.path.basename(path), seconds=round(time.perf_counter() - t0, 3),
+                                **diff.summary())
+        frame = diff.transition_frame()
+        frame.insert(0, "stage", stage_id)
+        frames.append(frame)
+        logger.info(f"Prediction diff {stage_id}: {diff.changed}/{diff.rows} rows changed")
+    if not stages:
+        return []
+
+    import pandas as pd
+
+    written = []
+    transitions = pd.concat(frames, ignore_index=True)
+    matrix_path = os.path.join(output_folder, DIFF_PARQUET)
+    try:
+        transitions.to_parquet(matrix_path, index=False)
+    except ImportError:
+        matrix_path = os.path.splitext(matrix_path)[0] + "_transitions.csv"
+        transitions.to_csv(matrix_path, index=False)
+    written.append(matrix_path)
+
+    doc = {"generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "transitions": os.path.basename(matrix_path), "stages": stages}
+    json_path = os.path.join(output_folder, DIFF_JSON)
+    with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    os.replace(json_path + ".tmp", json_path)
+    written.append(json_path)
+    return written
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare old and new predictions of batch CSVs")
+    parser.add_argument("--csv", action="append", required=True, help="Categorized / tagged CSV (repeatable)")
+    parser.add_argument("--out", default=".", help="Folder for prediction_diff.json / .parquet")
+    parser.add_argument("--old-column")
+    parser.add_argument("--new-column")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULTS["chunk_rows"])
+    parser.add_argument("--top", type=int, default=DEFAULTS["top"])
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    files = {os.path.splitext(os.path.basename(p))[0]: p for p in args.csv}
+    written = write_reports(files, args.out, dict(old_column=args.old_column, new_column=args.new_column,
+                                                  chunk_rows=args.chunk_rows, top=args.top))
+    print(json.dumps(written, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main()
@@ -0,0 +1,215 @@
+"""
+Parquet sidecar of the final report sheets.
+
+save_reports() writes {new_uid}_final_report_{now}.xlsx, a multi-sheet
+workbook that takes seconds to parse with openpyxl, and its readers usually
+need one sheet (the dashboard only shows model_information). write_sidecar()
+parses the workbook once, right after save_reports, and stores every sheet as
+a Parquet file next to it, with a small JSON index:
+
+  <stem>.sheets.json           source name / size / SHA-1, and for every sheet
+                               its name, file, rows and columns
+  <stem>.sheets/NN_<name>.parquet
+
+read_sheet() then loads a single sheet from the sidecar in milliseconds, and
+falls back to pandas.read_excel when there is no sidecar, pyarrow is missing or
+the workbook changed since the sidecar was written (SHA-1 mismatch).
+
+A sheet is stored as pandas.read_excel(path, sheet_name=name) returns it, with
+column labels as text; columns mixing numbers and text are stored as text and
+listed under text_columns in the index.
+
+Config "report_sidecar": false disables it (default on).
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+FINAL_REPORT_RE = re.compile(r"_final_report_.*\.xlsx$", re.IGNORECASE)
+SIDECAR_VERSION = 1
+
+_digests = {}            # (path, size, mtime_ns) -> sha1
+_digests_lock = threading.Lock()
+
+
+def enabled(config):
+    return bool(config.get("report_sidecar", True))
+
+
+def is_final_report(path):
+    return bool(FINAL_REPORT_RE.search(os.path.basename(path)))
+
+
+def index_path(report_path):
+    return os.path.splitext(report_path)[0] + ".sheets.json"
+
+
+def sheets_dir(report_path):
+    return os.path.splitext(report_path)[0] + ".sheets"
+
+
+def _digest(path):
+    st = os.stat(path)
+    sig = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    with _digests_lock:
+        digest = _digests.get(sig)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _digests_lock:
+            _digests[sig] = digest
+    return digest
+
+
+def _slug(name):
+    return re.sub(r"[^0-9A-Za-z_-]+", "_", name).strip("_")[:60] or "sheet"
+
+
+def _storable(df):
+    """df with text column labels and mixed object columns as text; returns (frame, text columns)."""
+    import pandas as pd
+
+    df = df.copy()
+    df.columns = [str(c) for c in df.columns]
+    text_columns = []
+    for col in df.columns[df.dtypes.eq(object)]:
+        values = df[col].dropna()
+        if values.map(type).nunique() > 1:
+            df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+            text_columns.append(col)
+    return df, text_columns
+
+
+# ============================================================
+#  WRITE
+# ============================================================
+
+def write_sidecar(report_path):
+    """
+    Write the Parquet sheets and the JSON index of one final report.
+    Returns the paths written (empty without pyarrow).
+    """
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.warning("Report sidecar skipped: pandas/pyarrow not available")
+        return []
+
+    t0 = time.perf_counter()
+    digest = _digest(report_path)
+    sheets = pd.read_excel(report_path, sheet_name=None)
+    out_dir = sheets_dir(report_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    written, entries = [], []
+    for position, (name, df) in enumerate(sheets.items()):
+        frame, text_columns = _storable(df)
+        path = os.path.join(out_dir, f"{position:02d}_{_slug(name)}.parquet")
+        try:
+            frame.to_parquet(path + ".tmp", engine="pyarrow", index=False)
+        except Exception as e:
+            logger.warning(f"Report sidecar: sheet {name!r} not stored ({e})")
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+            continue
+        os.replace(path + ".tmp", path)
+        written.append(path)
+        rel = os.path.relpath(path, os.path.dirname(report_path)).replace(os.sep, "/")
+        entries.append({"name": name, "file": rel,
+                        "rows": len(frame), "columns": list(frame.columns), "text_columns": text_columns})
+
+    doc = {"version": SIDECAR_VERSION, "source": os.path.basename(report_path),
+           "size": os.path.getsize(report_path), "sha1": digest,
+           "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"), "sheets": entries}
+    idx = index_path(report_path)
+    with open(idx + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    os.replace(idx + ".tmp", idx)
+    written.append(idx)
+    logger.info(f"Report sidecar of {os.path.basename(report_path)}: {len(entries)} sheets "
+                f"in {time.perf_counter() - t0:.2f}s")
+    return written
+
+
+def write_sidecars(paths):
+    """write_sidecar() for every final report among paths; returns all the files written."""
+    written = []
+    for path in paths:
+        if not is_final_report(path) or not os.path.isfile(path):
+            continue
+        try:
+            written += write_sidecar(path)
+        except Exception as e:
+            logger.warning(f"Report sidecar of {os.path.basename(path)} failed: {e}")
+    return written
+
+
+# ============================================================
+#  READ
+# ============================================================
+
+def load_index(report_path):
+    """Sidecar index of report_path, or None when missing or stale."""
+    idx = index_path(report_path)
+    if not os.path.isfile(idx):
+        return None
+    try:
+        with open(idx, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if doc.get("version") != SIDECAR_VERSION:
+        return None
+    if os.path.isfile(report_path) and (os.path.getsize(report_path) != doc.get("size")
+                                        or _digest(report_path) != doc.get("sha1")):
+        return None
+    return doc
+
+
+def sheet_names(report_path):
+    doc = load_index(report_path)
+    if doc is not None:
+        return [entry["name"] for entry in doc["sheets"]]
+    import pandas as pd
+    with pd.ExcelFile(report_path) as book:
+        return list(book.sheet_names)
+
+
+def read_sheet(report_path, sheet):
+    """One sheet of a final report as a DataFrame: from the sidecar when fresh, else from the workbook."""
+    import pandas as pd
+
+    doc = load_index(report_path)
+    entry = next((e for e in doc["sheets"] if e["name"] == sheet), None) if doc else None
+    if entry is not None:
+        try:
+            return pd.read_parquet(os.path.join(os.path.dirname(report_path), *entry["file"].split("/")))
+        except Exception as e:
+            logger.warning(f"Report sidecar unreadable for sheet {sheet!r}, reading the workbook: {e}")
+    return pd.read_excel(report_path, sheet_name=sheet)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write the Parquet sidecar of final report workbooks")
+    parser.add_argument("reports", nargs="+", help="*_final_report_*.xlsx files")
+    args = parser.parse_args()
+    for path in args.reports:
+        print(json.dumps(write_sidecar(path), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main()
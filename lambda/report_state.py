@@ -0,0 +1,206 @@
+"""
+Intermediate results of a run, stored so the final reports can be rebuilt later
+without models, samples or VMs.
+
+save_reports() only works on the TestRunner that computed the scores, so
+changing report weights or formats used to mean a full rerun. With
+"report_state": true the run writes next to its outputs:
+
+  report_state/index.json          runner class, country / segment, models, stages in order
+  report_state/base.pkl.gz         runner attributes after construction (and checkpoint restore)
+  report_state/NN_<stage>.pkl.gz   runner changes since the previous stage finished (score_cache.state_delta)
+
+The stage files are the same deltas the local backend and the score cache
+already use to move stage results between runners, gzip-compressed; changes of
+stages running at the same time land in the file of the first one to finish,
+and a stage with nothing left to store has no file. With a checkpoint the files
+are stage artifacts, so a resumed run continues the same index. Attributes
+that cannot be pickled (loaded models, .NET handles) are left out and listed in
+the index. rebuild() creates the runner without calling its constructor (no
+model is loaded), replays base and stages, and calls save_reports() with the
+requested weights / formats into a new output folder; it relies on save_reports
+reading only the computed results.
+
+Config:
+  report_state   true to store the intermediate results (default off)
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import pickle
+import logging
+import tempfile
+import importlib
+
+import score_cache
+
+logger = logging.getLogger(__name__)
+
+FOLDER = "report_state"
+INDEX_NAME = "index.json"
+STATE_VERSION = 1
+
+
+def enabled(config):
+    return bool(config.get("report_state", False))
+
+
+def _picklable(values, where):
+    """values without the entries that cannot be pickled; returns (kept, skipped names)."""
+    kept, skipped = {}, []
+    for name, value in list(values.items()):
+        try:
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            skipped.append(f"{where}.{name}" if where else str(name))
+            continue
+        kept[name] = value
+    return kept, skipped
+
+
+def _dump(path, obj):
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wb", compresslevel=6) as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    return path
+
+
+def _load(path):
+    with gzip.open(path, "rb") as f:
+        return pickle.load(f)
+
+
+# ============================================================
+#  RECORD
+# ============================================================
+
+class StateRecorder:
+    """Writes the base state of a runner, then one delta per finished stage."""
+
+    def __init__(self, runner, output_folder, meta=None):
+        self.runner = runner
+        self.folder = os.path.join(output_folder, FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        index = self._read_index()
+        if index is not None and index.get("version") == STATE_VERSION:
+            # Restored from a checkpoint: the runner already holds the stages listed in the index
+            self.index = index
+            logger.info(f"Report state: continuing after {len(index['stages'])} stages")
+        else:
+            cls = type(runner)
+            state, skipped = _picklable(vars(runner), "")
+            self.index = dict(meta or {}, version=STATE_VERSION, runner=f"{cls.__module__}:{cls.__qualname__}",
+                              created=time.strftime("%Y-%m-%d %H:%M:%S"), base="base.pkl.gz",
+                              skipped=skipped, stages=[])
+            _dump(os.path.join(self.folder, "base.pkl.gz"), state)
+            self._write_index()
+        self._before = score_cache.shallow_state(runner)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.folder, INDEX_NAME), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_index(self):
+        path = os.path.join(self.folder, INDEX_NAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f, indent=2, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def record(self, stage_id):
+        """Store what the runner gained since the previous record; returns the files written."""
+        delta = score_cache.state_delta(self._before, self.runner)
+        self._before = score_cache.shallow_state(self.runner)
+        skipped = []
+        for kind in ("set", "dict", "list"):
+            delta[kind], names = _picklable(delta[kind], kind)
+            skipped += names
+        if not any(delta.values()):
+            return []
+        fname = f"{len(self.index['stages']):02d}_{re.sub(r'[^0-9A-Za-z_-]+', '_', stage_id)}.pkl.gz"
+        path = _dump(os.path.join(self.folder, fname), delta)
+        self.index["stages"].append({"stage": stage_id, "file": fname, "size": os.path.getsize(path),
+                                     "skipped": skipped})
+        if skipped:
+            logger.info(f"Report state of {stage_id}: not stored {', '.join(skipped)}")
+        return [path, self._write_index()]
+
+
+# ============================================================
+#  REBUILD
+# ============================================================
+
+def load_index(folder):
+    with open(os.path.join(folder, INDEX_NAME), "r", encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("version") != STATE_VERSION:
+        raise ValueError(f"Unsupported report state version {index.get('version')} in {folder}")
+    return index
+
+
+def load_runner(folder, output_folder, runner_cls=None):
+    """TestRunner rebuilt from a report_state folder, without running its constructor."""
+    index = load_index(folder)
+    if runner_cls is None:
+        module, _, name = index["runner"].partition(":")
+        runner_cls = importlib.import_module(module)
+        for part in name.split("."):
+            runner_cls = getattr(runner_cls, part)
+    runner = runner_cls.__new__(runner_cls)
+    vars(runner).update(_load(os.path.join(folder, index["base"])))
+    for entry in index["stages"]:
+        score_cache.apply_delta(runner, _load(os.path.join(folder, entry["file"])))
+    if hasattr(runner, "output_folder"):
+        runner.output_folder = output_folder
+    return runner
+
+
+def rebuild(folder, output_folder, weights=None, excel=True, pdf=False, runner_cls=None):
+    """
+    Run save_reports() on the runner stored in folder, writing into output_folder.
+    Returns the files it wrote, relative to output_folder.
+    """
+    import runner_pool
+    from output_index import OutputIndex
+
+    os.makedirs(output_folder, exist_ok=True)
+    runner = load_runner(folder, output_folder, runner_cls)
+    out_index = OutputIndex(output_folder)
+    t0 = time.perf_counter()
+    scratch = tempfile.mkdtemp(prefix=".save_reports_", dir=output_folder)
+    runner_pool.save_reports(runner, scratch, weights=weights, excel=excel, pdf=pdf)
+    written = out_index.collect(scratch)
+    logger.info(f"Reports rebuilt from {folder} in {time.perf_counter() - t0:.2f}s: {', '.join(written)}")
+    return written
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild the final reports from a stored report_state folder")
+    parser.add_argument("state", help="report_state folder of a run")
+    parser.add_argument("--out", required=True, help="Folder for the rebuilt reports")
+    parser.add_argument("--weights", help="JSON weights passed to save_reports")
+    parser.add_argument("--no-excel", action="store_true")
+    parser.add_argument("--pdf", action="store_true")
+    parser.add_argument("--ce-path", action="append", default=[], help="Folders holding suite_tests (repeatable)")
+    args = parser.parse_args()
+    for path in args.ce_path:
+        if path not in sys.path:
+            sys.path.append(path)
+    files = rebuild(args.state, args.out, weights=json.loads(args.weights) if args.weights else None,
+                    excel=not args.no_excel, pdf=args.pdf)
+    print(json.dumps(files, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main()
@@ -0,0 +1,441 @@
+"""
+History of the test suite runs, queryable by country / segment / model / date.
+
+Every completed run (Lambda or dashboard job) becomes one record:
+  - country, segment, version, old / new model and expert rules, config (without
+    the service principal fields), status, start / end, duration;
+  - stages: seconds, backend, sample file with its size and row count;
+  - artifacts: files of the output folder with their size;
+  - headline metrics read from the final report (via its Parquet sidecar): the
+    accuracy score rows (bank, metric, benchmark, development, delta), the PSI
+    per bank of the psi sheets, and the change rate of prediction_diff.json.
+
+Records are written as one JSON object per run on S3
+(<prefix>runs/<country>/<segment>/<date>_<run id>.json, never rewritten, so
+concurrent runs cannot conflict) and indexed in a local SQLite database;
+sync() adds the S3 records missing from the local index, so any machine can
+rebuild it. Queries (runs, stage timings, metric trends) only touch SQLite.
+
+Config:
+  run_history        false disables recording (default on)
+  run_history_db     SQLite file (default /tmp/run_history.db on Lambda)
+  run_history_prefix S3 prefix (default "<s3_prefix>run_history/")
+
+CLI:
+  python run_history.py --db hist.db --bucket B --prefix P/run_history/ sync
+  python run_history.py --db hist.db runs --country it --segment consumer --last 5
+  python run_history.py --db hist.db metrics --country it --segment consumer --metric psi
+  python run_history.py --db hist.db stages --country it --segment consumer
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+
+import report_sidecar
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB = os.environ.get("RUN_HISTORY_DB", "/tmp/run_history.db")
+
+# Config keys never stored in the history
+PRIVATE_KEYS = ("ServicePrincipal_CertificateThumbprint", "ServicePrincipal_ApplicationId")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, country TEXT, segment TEXT, version TEXT, old_model TEXT, new_model TEXT,
+    old_expert_rules TEXT, new_expert_rules TEXT, source TEXT, status TEXT, started REAL, finished REAL,
+    duration_s REAL, output_folder TEXT, config TEXT, s3_key TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_segment ON runs (country, segment, started);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (new_model, started);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id TEXT, stage_id TEXT, method TEXT, seconds REAL, backend TEXT, sample TEXT, sample_bytes INTEGER,
+    sample_rows INTEGER
+);
+CREATE INDEX IF NOT EXISTS stages_run ON stages (run_id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id TEXT, path TEXT, size INTEGER
+);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id TEXT, sheet TEXT, key TEXT, metric TEXT, benchmark REAL, development REAL, delta REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_run ON metrics (run_id, metric);
+"""
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if number != number else number        # NaN
+
+
+# ============================================================
+#  RECORD
+# ============================================================
+
+def _walk(output_folder):
+    for root, _dirs, files in os.walk(output_folder):
+        for fname in files:
+            yield os.path.relpath(os.path.join(root, fname), output_folder).replace(os.sep, "/")
+
+
+def manifest_files(output_folder):
+    """Files written by the run according to its output_manifest.json (for output folders shared by runs)."""
+    with open(os.path.join(output_folder, "output_manifest.json"), "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    files = ["output_manifest.json"]
+    for entry in doc["stages"]:
+        files += entry["produced"] + [copy["dst"] for copy in entry["copies"]]
+    return list(dict.fromkeys(files))
+
+
+def headline_metrics(output_folder, files=None):
+    """Metric rows of the final report(s) and of prediction_diff.json among files (default: all of output_folder)."""
+    rows = []
+    for rel in (files if files is not None else _walk(output_folder)):
+        path = os.path.join(output_folder, *rel.split("/"))
+        fname = os.path.basename(path)
+        if report_sidecar.is_final_report(path) and os.path.isfile(path):
+            try:
+                sheets = report_sidecar.sheet_names(path)
+            except Exception as e:
+                logger.warning(f"Run history: cannot open {fname}: {e}")
+                continue
+            for sheet in sheets:
+                name = sheet.lower()
+                if "accuracy" not in name and "psi" not in name:
+                    continue
+                try:
+                    df = report_sidecar.read_sheet(path, sheet)
+                except Exception as e:
+                    logger.warning(f"Run history: cannot read sheet {sheet} of {fname}: {e}")
+                    continue
+                if "accuracy" in name and df.shape[1] >= 5:
+                    # bank, metric, benchmark, development, delta (same layout the frontend parses)
+                    for values in df.iloc[:, :5].itertuples(index=False):
+                        bench, dev, delta = (_number(v) for v in values[2:5])
+                        if bench is None and dev is None:
+                            continue
+                        rows.append(dict(sheet=sheet, key=str(values[0]).strip(), metric=str(values[1]).strip(),
+                                         benchmark=bench, development=dev, delta=delta))
+                elif "psi" in name and df.shape[1] >= 7:
+                    # bank, category, freq old, count old, freq new, count new, psi: PSI per bank
+                    psi = df.iloc[:, 6].map(_number)
+                    for bank, total in psi.groupby(df.iloc[:, 0].astype(str).str.strip()).sum().items():
+                        rows.append(dict(sheet=sheet, key=bank, metric="psi", benchmark=None,
+                                         development=float(total), delta=None))
+
+    diff_path = os.path.join(output_folder, "prediction_diff.json")
+    if (files is None or "prediction_diff.json" in files) and os.path.isfile(diff_path):
+        try:
+            with open(diff_path, "r", encoding="utf-8") as f:
+                diff = json.load(f)
+            for stage_id, summary in diff.get("stages", {}).items():
+                rows.append(dict(sheet="prediction_diff", key=stage_id, metric="change_rate", benchmark=None,
+                                 development=summary.get("change_rate"), delta=None))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Run history: cannot read prediction_diff.json: {e}")
+    return rows
+
+
+def artifact_sizes(output_folder, files=None):
+    sizes = []
+    for rel in (files if files is not None else _walk(output_folder)):
+        try:
+            sizes.append(dict(path=rel, size=os.path.getsize(os.path.join(output_folder, *rel.split("/")))))
+        except OSError:
+            pass
+    return sizes
+
+
+def stage_entries(stages, sample_path=None):
+    """
+    stages: dicts with stage_id, seconds and optionally method, backend, sample;
+    the sample's size and row count are added when sample_path holds it.
+    """
+    from local_backend import sample_rows
+
+    entries = []
+    for stage in stages:
+        entry = dict(stage_id=stage["stage_id"], method=stage.get("method"), seconds=stage.get("seconds"),
+                     backend=stage.get("backend"), sample=stage.get("sample"), sample_bytes=None, sample_rows=None)
+        path = os.path.join(sample_path, stage["sample"]) if sample_path and stage.get("sample") else None
+        if path and os.path.isfile(path):
+            entry["sample_bytes"] = os.path.getsize(path)
+            try:
+                entry["sample_rows"] = sample_rows(path)
+            except OSError:
+                pass
+        entries.append(entry)
+    return entries
+
+
+def stages_from_spans(spans, stages):
+    """Stage timings from the metrics spans of handler.run_tests (runner.<method> spans)."""
+    by_id = {stage["id"]: stage for stage in stages}
+    timings = {}
+    for span in spans:
+        if not span["name"].startswith("runner.") or "stage" not in span or span["name"] == "runner.init":
+            continue
+        entry = timings.setdefault(span["stage"], dict(stage_id=span["stage"], method=span["name"][len("runner."):],
+                                                       seconds=0.0, backend=span.get("backend"),
+                                                       sample=by_id.get(span["stage"], {}).get("sample")))
+        entry["seconds"] = round(entry["seconds"] + span["seconds"], 3)
+    return list(timings.values())
+
+
+def build_record(config, output_folder, stages, started, finished=None, status="completed", source="lambda",
+                 files=None):
+    """
+    History record of a run; stages as returned by stage_entries(), files the run's
+    outputs relative to output_folder (default: everything in it).
+    """
+    finished = finished or time.time()
+    return {
+        "run_id": uuid.uuid4().hex[:16],
+        "country": config.get("country"),
+        "segment": (config.get("segment") or "").lower(),
+        "version": config.get("version"),
+        "old_model": config.get("old_model"),
+        "new_model": config.get("new_model"),
+        "old_expert_rules": config.get("old_expert_rules"),
+        "new_expert_rules": config.get("new_expert_rules"),
+        "source": source,
+        "status": status,
+        "started": started,
+        "finished": finished,
+        "duration_s": round(finished - started, 3),
+        "output_folder": output_folder,
+        "config": {k: v for k, v in config.items() if k not in PRIVATE_KEYS and not k.startswith("_")},
+        "stages": stages,
+        "artifacts": artifact_sizes(output_folder, files),
+        "metrics": headline_metrics(output_folder, files),
+    }
+
+
+# ============================================================
+#  STORE
+# ============================================================
+
+class RunHistory:
+
+    def __init__(self, db_path=None, s3=None, bucket=None, prefix="run_history/"):
+        self.db_path = db_path or DEFAULT_DB
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _query(self, sql, args=()):
+        db = self._connect()
+        try:
+            return [dict(row) for row in db.execute(sql, args)]
+        finally:
+            db.close()
+
+    def _key(self, record):
+        date = time.strftime("%Y%m%d-%H%M%S", time.gmtime(record["started"]))
+        return f"{self.prefix}runs/{record['country']}/{record['segment']}/{date}_{record['run_id']}.json"
+
+    def _insert(self, record, s3_key=None):
+        db = self._connect()
+        try:
+            with db:
+                if db.execute("SELECT 1 FROM runs WHERE run_id = ?", (record["run_id"],)).fetchone():
+                    return False
+                db.execute(
+                    "INSERT INTO runs (run_id, country, segment, version, old_model, new_model, old_expert_rules, "
+                    "new_expert_rules, source, status, started, finished, duration_s, output_folder, config, s3_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (record["run_id"], record["country"], record["segment"], record.get("version"),
+                     record.get("old_model"), record.get("new_model"), record.get("old_expert_rules"),
+                     record.get("new_expert_rules"), record.get("source"), record.get("status"), record["started"],
+                     record.get("finished"), record.get("duration_s"), record.get("output_folder"),
+                     json.dumps(record.get("config", {}), default=str), s3_key))
+                db.executemany(
+                    "INSERT INTO stages (run_id, stage_id, method, seconds, backend, sample, sample_bytes, sample_rows) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(record["run_id"], s["stage_id"], s.get("method"), s.get("seconds"), s.get("backend"),
+                      s.get("sample"), s.get("sample_bytes"), s.get("sample_rows")) for s in record.get("stages", [])])
+                db.executemany("INSERT INTO artifacts (run_id, path, size) VALUES (?, ?, ?)",
+                               [(record["run_id"], a["path"], a["size"]) for a in record.get("artifacts", [])])
+                db.executemany(
+                    "INSERT INTO metrics (run_id, sheet, key, metric, benchmark, development, delta) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(record["run_id"], m["sheet"], m["key"], m["metric"], m.get("benchmark"), m.get("development"),
+                      m.get("delta")) for m in record.get("metrics", [])])
+        finally:
+            db.close()
+        return True
+
+    def record(self, record):
+        """Store a run record locally and, with S3, as its own JSON object. Returns the run id."""
+        s3_key = None
+        if self.s3 is not None and self.bucket:
+            s3_key = self._key(record)
+            try:
+                self.s3.put_object(Bucket=self.bucket, Key=s3_key, ContentType="application/json",
+                                   Body=json.dumps(record, default=str).encode("utf-8"))
+            except Exception as e:
+                logger.warning(f"Run history: could not upload {s3_key}: {e}")
+                s3_key = None
+        self._insert(record, s3_key)
+        return record["run_id"]
+
+    def sync(self, country=None, segment=None):
+        """Index the S3 records missing from the local database; returns how many were added."""
+        if self.s3 is None or not self.bucket:
+            return 0
+        prefix = f"{self.prefix}runs/"
+        if country:
+            prefix += f"{country}/" + (f"{segment.lower()}/" if segment else "")
+        known = {row["s3_key"] for row in self._query("SELECT s3_key FROM runs WHERE s3_key IS NOT NULL")}
+        added = 0
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"] in known or not obj["Key"].endswith(".json"):
+                    continue
+                body = self.s3.get_object(Bucket=self.bucket, Key=obj["Key"])["Body"].read()
+                added += int(self._insert(json.loads(body), obj["Key"]))
+        return added
+
+    # --- queries ---
+
+    @staticmethod
+    def _filters(country=None, segment=None, model=None, since=None, until=None, status=None, alias="runs"):
+        clauses, args = [], []
+        for column, value in (("country", country), ("segment", segment.lower() if segment else None),
+                              ("status", status)):
+            if value:
+                clauses.append(f"{alias}.{column} = ?")
+                args.append(value)
+        if model:
+            clauses.append(f"({alias}.new_model = ? OR {alias}.old_model = ?)")
+            args += [model, model]
+        if since:
+            clauses.append(f"{alias}.started >= ?")
+            args.append(since)
+        if until:
+            clauses.append(f"{alias}.started < ?")
+            args.append(until)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", args
+
+    def runs(self, country=None, segment=None, model=None, since=None, until=None, status=None, limit=20):
+        """Most recent runs first, without the per-run details."""
+        where, args = self._filters(country, segment, model, since, until, status)
+        rows = self._query(f"SELECT * FROM runs{where} ORDER BY started DESC LIMIT ?", (*args, limit))
+        for row in rows:
+            row["config"] = json.loads(row["config"]) if row["config"] else {}
+        return rows
+
+    def run(self, run_id):
+        rows = self._query("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+        if not rows:
+            return None
+        run = rows[0]
+        run["config"] = json.loads(run["config"]) if run["config"] else {}
+        for table in ("stages", "artifacts", "metrics"):
+            run[table] = self._query(f"SELECT * FROM {table} WHERE run_id = ?", (run_id,))
+        return run
+
+    def stage_timings(self, country=None, segment=None, method=None, status="completed", limit=200):
+        """Stage rows of recent runs (with the run's start and models), most recent first."""
+        where, args = self._filters(country, segment, status=status, alias="r")
+        if method:
+            where += (" AND " if where else " WHERE ") + "s.method = ?"
+            args.append(method)
+        return self._query(
+            f"SELECT s.*, r.started, r.country, r.segment, r.new_model FROM stages s JOIN runs r USING (run_id)"
+            f"{where} ORDER BY r.started DESC LIMIT ?", (*args, limit))
+
+    def metric_trend(self, country=None, segment=None, metric=None, key=None, sheet=None, last=10):
+        """Metric rows of the last runs of a country / segment, oldest run first."""
+        where, args = self._filters(country, segment, status="completed")
+        recent = self._query(f"SELECT run_id FROM runs{where} ORDER BY started DESC LIMIT ?", (*args, last))
+        if not recent:
+            return []
+        marks = ", ".join("?" for _ in recent)
+        sql = (f"SELECT m.*, r.started, r.new_model FROM metrics m JOIN runs r USING (run_id) "
+               f"WHERE m.run_id IN ({marks})")
+        params = [row["run_id"] for row in recent]
+        for column, value in (("metric", metric), ("key", key), ("sheet", sheet)):
+            if value:
+                sql += f" AND m.{column} = ?"
+                params.append(value)
+        return self._query(sql + " ORDER BY r.started, m.sheet, m.key", params)
+
+
+def open_history(config, s3=None, bucket=None, s3_prefix="", db_path=None):
+    """RunHistory for a run, or None when run_history is off."""
+    if not config.get("run_history", True):
+        return None
+    return RunHistory(config.get("run_history_db") or db_path, s3, bucket,
+                      config.get("run_history_prefix") or f"{s3_prefix}run_history/")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the test suite run history")
+    parser.add_argument("--db", default=DEFAULT_DB, help="SQLite index (default RUN_HISTORY_DB or /tmp)")
+    parser.add_argument("--bucket", help="S3 bucket of the run records (for sync)")
+    parser.add_argument("--prefix", default="run_history/", help="S3 prefix of the run records")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("sync", help="Index the S3 records missing from the local database")
+    for name in ("runs", "stages", "metrics"):
+        p = sub.add_parser(name)
+        p.add_argument("--country")
+        p.add_argument("--segment")
+        p.add_argument("--last", type=int, default=5)
+        if name == "runs":
+            p.add_argument("--model")
+            p.add_argument("--since", help="YYYY-MM-DD")
+        if name == "stages":
+            p.add_argument("--method")
+        if name == "metrics":
+            p.add_argument("--metric")
+            p.add_argument("--key")
+    sub.add_parser("show").add_argument("run_id")
+    args = parser.parse_args()
+
+    s3 = None
+    if args.bucket:
+        import boto3
+        s3 = boto3.client("s3")
+    history = RunHistory(args.db, s3, args.bucket, args.prefix)
+    if args.command == "sync":
+        result = {"added": history.sync()}
+    elif args.command == "runs":
+        since = time.mktime(time.strptime(args.since, "%Y-%m-%d")) if args.since else None
+        result = history.runs(args.country, args.segment, args.model, since=since, limit=args.last)
+        for row in result:
+            row.pop("config")
+    elif args.command == "stages":
+        result = history.stage_timings(args.country, args.segment, args.method, limit=args.last * 20)
+    elif args.command == "metrics":
+        result = history.metric_trend(args.country, args.segment, args.metric, args.key, last=args.last)
+    else:
+        result = history.run(args.run_id)
+    print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main()
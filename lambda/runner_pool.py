@@ -0,0 +1,155 @@
+"""
+In-process TestRunners for the stages of one run.
+
+A TestRunner is not thread-safe, so stages running at the same time (one per
+VM pair, crossvalidation next to them) each take a runner of their own from
+RunnerPool. A stage runs with its own output folder and returns the runner
+attributes it changed (score_cache.state_delta), exactly like a local worker;
+the caller applies the delta to the main runner and moves the stage's files
+into the output folder on the scheduler thread, so every stage's files and
+results are its own whatever else is running.
+
+The main runner (main_runner) is a copy of the first runner built, made
+without running the constructor: it shares the loaded models, never runs a
+stage, and only collects the deltas for checkpoints and save_reports.
+
+Every runner loads the models again, so the pool holds at most the runners
+that fit in memory next to the first one (runner_budget): the growth of the
+resident memory while the first runner was built, against the memory left
+(Lambda function size, or MemAvailable elsewhere). With room for a single
+runner the stages run one at a time.
+
+Config:
+  max_runners        runners in the pool (default: as many as fit in memory)
+  runner_memory_mb   memory of one runner (default: measured on the first one)
+"""
+
+import os
+import logging
+import threading
+
+import metrics
+import score_cache
+from scheduler import run_stage
+
+logger = logging.getLogger(__name__)
+
+# Share of the free memory the extra runners may take
+MEMORY_HEADROOM = 0.8
+
+
+def available_memory_bytes():
+    """Memory this process can still use: Lambda function size minus RSS, else MemAvailable; None if unknown."""
+    limit_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    rss = metrics.current_rss_bytes()
+    if limit_mb and rss is not None:
+        return max(0, int(limit_mb) * metrics.MB - rss)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def runner_budget(config, runner_bytes, wanted):
+    """
+    Runners the pool may hold, at least 1 and at most wanted (stages that can run at once).
+    runner_bytes is the memory taken by building one runner (None when it could not be measured).
+    """
+    if config.get("max_runners"):
+        return max(1, min(int(config["max_runners"]), wanted))
+    if config.get("runner_memory_mb"):
+        runner_bytes = config["runner_memory_mb"] * metrics.MB
+    free = available_memory_bytes()
+    if runner_bytes is None or free is None:
+        logger.info("Runner memory unknown: stages run one at a time")
+        return 1
+    extra = int(free * MEMORY_HEADROOM // max(runner_bytes, metrics.MB))
+    budget = max(1, min(1 + extra, wanted))
+    logger.info(f"Runner pool: {budget} runners ({runner_bytes / metrics.MB:.0f} MB each, "
+                f"{free / metrics.MB:.0f} MB free, {wanted} wanted)")
+    return budget
+
+
+def main_runner(runner):
+    """
+    Runner of the same class holding the attributes of runner, built without its constructor.
+    Dicts and lists are copied, so deltas applied to it never reach runner.
+    """
+    main = type(runner).__new__(type(runner))
+    for name, value in list(vars(runner).items()):
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, list):
+            value = list(value)
+        setattr(main, name, value)
+    return main
+
+
+def save_reports(runner, folder, **kwargs):
+    """runner.save_reports(**kwargs) writing into folder, like a stage, so its files are known without a scan."""
+    default_folder = runner.output_folder
+    # save_reports writes under <output_folder>/<old_uid>/
+    os.makedirs(os.path.join(folder, getattr(runner, "old_uid", None) or ""), exist_ok=True)
+    runner.output_folder = folder
+    try:
+        return runner.save_reports(**kwargs)
+    finally:
+        runner.output_folder = default_folder
+
+
+class RunnerPool:
+    """Up to size TestRunners, built by factory() on demand; first, if given, is the first of them."""
+
+    def __init__(self, factory, size, first=None):
+        self.factory = factory
+        self.size = max(1, int(size))
+        self._idle = [first] if first is not None else []
+        self._built = len(self._idle)
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._built >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._built += 1
+        try:
+            return self.factory()
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, runner):
+        with self._cond:
+            if runner is None:
+                self._built -= 1
+            else:
+                self._idle.append(runner)
+            self._cond.notify()
+
+    def run(self, stage, sample_path, kwargs, output_folder):
+        """Run one stage on a free runner writing into output_folder; returns the runner delta."""
+        runner = self._acquire()
+        default_folder = runner.output_folder
+        os.makedirs(output_folder, exist_ok=True)
+        runner.output_folder = output_folder
+        try:
+            before = score_cache.shallow_state(runner)
+            run_stage(runner, stage, sample_path, kwargs)
+            delta = score_cache.state_delta(before, runner)
+        finally:
+            runner.output_folder = default_folder
+            self._release(runner)
+        # Containers the stage created stay with this runner, which later stages keep filling
+        delta["set"] = {name: type(value)(value) if isinstance(value, (dict, list)) else value
+                        for name, value in delta["set"].items()}
+        return delta
+
+    def close(self):
+        with self._cond:
+            self._idle = []
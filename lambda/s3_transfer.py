@@ -0,0 +1,363 @@
+"""
+Parallel S3 transfer engine used by handler.py.
+
+Objects are moved through a bounded thread pool, large files are split in
+multipart chunks by boto3's TransferManager, and a single pooled client is
+kept at module level so warm Lambda invocations reuse its connections.
+
+Set S3_ENDPOINT_URL (or pass endpoint_url) to run against a local S3
+stand-in such as moto_server or MinIO.
+"""
+
+import os
+import time
+import zlib
+import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+DEFAULT_MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", "16"))
+DEFAULT_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", "16")) * MB
+DEFAULT_MULTIPART_CHUNKSIZE = int(os.environ.get("S3_MULTIPART_CHUNKSIZE_MB", "16")) * MB
+DEFAULT_PART_CONCURRENCY = int(os.environ.get("S3_PART_CONCURRENCY", "4"))
+
+_client = None
+_client_key = None
+_client_lock = threading.Lock()
+
+
+# ============================================================
+#  CLIENT
+# ============================================================
+
+def get_client(endpoint_url=None, max_pool_connections=None):
+    """
+    Return the shared boto3 S3 client, creating it on first use.
+    The pool is sized so every worker thread can run its multipart parts
+    without waiting for a free connection.
+    """
+    global _client, _client_key
+    endpoint_url = endpoint_url or os.environ.get("S3_ENDPOINT_URL") or None
+    if max_pool_connections is None:
+        max_pool_connections = max(10, DEFAULT_MAX_WORKERS * DEFAULT_PART_CONCURRENCY)
+
+    key = (endpoint_url, max_pool_connections)
+    with _client_lock:
+        if _client is None or _client_key != key:
+            import boto3
+            from botocore.config import Config
+
+            cfg = Config(
+                max_pool_connections=max_pool_connections,
+                retries={"max_attempts": 5, "mode": "adaptive"},
+                tcp_keepalive=True,
+            )
+            _client = boto3.client("s3", endpoint_url=endpoint_url, config=cfg)
+            _client_key = key
+            logger.info(f"S3 client created (endpoint={endpoint_url or 'aws'}, pool={max_pool_connections})")
+        return _client
+
+
+def reset_client():
+    """Drop the cached client (e.g. between tests using a mocked S3)."""
+    global _client, _client_key
+    with _client_lock:
+        _client = None
+        _client_key = None
+
+
+def transfer_config(multipart_threshold=None, multipart_chunksize=None, part_concurrency=None):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=multipart_threshold or DEFAULT_MULTIPART_THRESHOLD,
+        multipart_chunksize=multipart_chunksize or DEFAULT_MULTIPART_CHUNKSIZE,
+        max_concurrency=part_concurrency or DEFAULT_PART_CONCURRENCY,
+        use_threads=True,
+    )
+
+
+# ============================================================
+#  STATS
+# ============================================================
+
+class TransferStats:
+    """Thread-safe collector of per-transfer bytes and latency."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = {"download": [], "upload": []}
+        self.errors = {"download": 0, "upload": 0}
+        self.wall = {"download": 0.0, "upload": 0.0}
+        self.cache = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0}
+
+    def add(self, direction, key, nbytes, seconds):
+        with self._lock:
+            self.records[direction].append({"key": key, "bytes": nbytes, "seconds": round(seconds, 3)})
+
+    def add_error(self, direction):
+        with self._lock:
+            self.errors[direction] += 1
+
+    def add_wall(self, direction, seconds):
+        with self._lock:
+            self.wall[direction] += seconds
+
+    def add_cache(self, hit, nbytes):
+        with self._lock:
+            if hit:
+                self.cache["hits"] += 1
+                self.cache["hit_bytes"] += nbytes
+            else:
+                self.cache["misses"] += 1
+                self.cache["miss_bytes"] += nbytes
+
+    def summary(self):
+        out = {}
+        with self._lock:
+            for direction, recs in self.records.items():
+                total = sum(r["bytes"] for r in recs)
+                lat = sorted(r["seconds"] for r in recs)
+                wall = self.wall[direction]
+                out[direction] = {
+                    "files": len(recs),
+                    "bytes": total,
+                    "errors": self.errors[direction],
+                    "wall_seconds": round(wall, 3),
+                    "throughput_mb_s": round(total / MB / wall, 2) if wall > 0 else 0.0,
+                    "latency_p50_s": lat[len(lat) // 2] if lat else 0.0,
+                    "latency_max_s": lat[-1] if lat else 0.0,
+                }
+            out["cache"] = dict(self.cache)
+        return out
+
+
+# ============================================================
+#  TRANSFERS
+# ============================================================
+
+def list_prefix(s3, bucket, prefix):
+    """Yield (key, size, etag) for every object under prefix."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"], obj.get("Size", 0), obj.get("ETag", "").strip('"')
+
+
+def _run_pool(direction, jobs, fn, max_workers, stats):
+    """Run fn(*job) for every job in a bounded pool; raise the first failure."""
+    start = time.perf_counter()
+    first_error = None
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_MAX_WORKERS) as pool:
+        futures = {pool.submit(fn, *job): job for job in jobs}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                stats.add_error(direction)
+                logger.error(f"S3 {direction} failed for {futures[fut][0]}: {e}")
+                if first_error is None:
+                    first_error = e
+    stats.add_wall(direction, time.perf_counter() - start)
+    if first_error is not None:
+        raise first_error
+
+
+def download_objects(s3, bucket, items, stats=None, max_workers=None, config=None):
+    """
+    Download (key, local_path) pairs in parallel.
+    Returns the TransferStats instance used.
+    """
+    stats = stats or TransferStats()
+    config = config or transfer_config()
+
+    def _one(key, local_path):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        t0 = time.perf_counter()
+        s3.download_file(bucket, key, local_path, Config=config)
+        stats.add("download", key, os.path.getsize(local_path), time.perf_counter() - t0)
+        logger.info(f"S3 download: s3://{bucket}/{key} -> {local_path}")
+
+    _run_pool("download", list(items), _one, max_workers, stats)
+    return stats
+
+
+def upload_files(s3, bucket, items, stats=None, max_workers=None, config=None):
+    """
+    Upload (local_path, key) pairs in parallel.
+    Returns the TransferStats instance used.
+    """
+    stats = stats or TransferStats()
+    config = config or transfer_config()
+
+    def _one(local_path, key):
+        t0 = time.perf_counter()
+        s3.upload_file(local_path, bucket, key, Config=config)
+        stats.add("upload", key, os.path.getsize(local_path), time.perf_counter() - t0)
+        logger.info(f"S3 upload: {local_path} -> s3://{bucket}/{key}")
+
+    _run_pool("upload", list(items), _one, max_workers, stats)
+    return stats
+
+
+# ============================================================
+#  STREAMING UPLOADS
+# ============================================================
+
+def _b64_crc32(value):
+    return base64.b64encode(value.to_bytes(4, "big")).decode("ascii")
+
+
+def file_crc32(path, part_size=None):
+    """
+    CRC32 of a file as S3 reports it (base64): (full-object value, composite value or None).
+    With part_size, the composite value of a multipart upload in parts of that size:
+    the CRC32 of the parts' CRC32s, followed by "-<parts>".
+    """
+    crc, part_crc, filled, parts = 0, 0, 0, []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(min(MB, part_size - filled) if part_size else MB)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            if part_size:
+                part_crc = zlib.crc32(chunk, part_crc)
+                filled += len(chunk)
+                if filled == part_size:
+                    parts.append(part_crc.to_bytes(4, "big"))
+                    part_crc, filled = 0, 0
+    if not part_size:
+        return _b64_crc32(crc), None
+    if filled:
+        parts.append(part_crc.to_bytes(4, "big"))
+    return _b64_crc32(crc), f"{_b64_crc32(zlib.crc32(b''.join(parts)))}-{len(parts)}"
+
+
+class StreamingUploader:
+    """
+    Background uploader for an output directory.
+
+    submit() queues a file as soon as it is written, so uploads overlap with
+    the next stage's compute. Uploads of one key run one at a time and read the
+    file when they start, so the last one always sends the current content; a
+    file whose CRC32 matches what was last sent is skipped. Objects are uploaded
+    with ChecksumAlgorithm CRC32, so S3 computes (and checks) the checksum of
+    what it stores. sync() + flush() + verify() form the final step: pick up
+    anything not streamed, wait, then compare S3's size and CRC32 with the file's.
+    """
+
+    def __init__(self, s3, bucket, local_dir, prefix, stats=None, max_workers=None, config=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.local_dir = local_dir
+        self.prefix = prefix
+        self.stats = stats or TransferStats()
+        self.config = config or transfer_config()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers or DEFAULT_MAX_WORKERS)
+        self._lock = threading.Lock()
+        self._futures = []
+        self._sent = {}          # key -> (size, full CRC32, composite CRC32 or None) of the last upload
+        self._waiting = {}       # key -> future not started yet (a new submit() joins it)
+        self._key_locks = {}
+        self._first_submit = None
+        self._last_done = None
+
+    def key_for(self, local_path):
+        rel = os.path.relpath(local_path, self.local_dir)
+        return self.prefix + rel.replace("\\", "/")
+
+    def submit(self, local_path):
+        key = self.key_for(local_path)
+        with self._lock:
+            if key in self._waiting:
+                return self._waiting[key]
+            if self._first_submit is None:
+                self._first_submit = time.perf_counter()
+            fut = self._pool.submit(self._upload, local_path, key)
+            self._waiting[key] = fut
+            self._futures.append((key, fut))
+        return fut
+
+    def _upload(self, local_path, key):
+        with self._lock:
+            self._waiting.pop(key, None)
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            size = os.path.getsize(local_path)
+            crc, composite = file_crc32(local_path, self._part_size(size))
+            with self._lock:
+                if self._sent.get(key, (None, None))[:2] == (size, crc):
+                    return
+            t0 = time.perf_counter()
+            self.s3.upload_file(local_path, self.bucket, key, Config=self.config,
+                                ExtraArgs={"ChecksumAlgorithm": "CRC32"})
+            done = time.perf_counter()
+            self.stats.add("upload", key, size, done - t0)
+            with self._lock:
+                self._sent[key] = (size, crc, composite)
+                self._last_done = done
+        logger.info(f"S3 upload: {local_path} -> s3://{self.bucket}/{key}")
+
+    def sync(self):
+        """Queue every file under local_dir; unchanged ones are skipped by content."""
+        for root, _dirs, files in os.walk(self.local_dir):
+            for fname in files:
+                self.submit(os.path.join(root, fname))
+
+    def flush(self):
+        """Wait for queued uploads; raise the first failure."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        first_error = None
+        for key, fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                self.stats.add_error("upload")
+                logger.error(f"S3 upload failed for {key}: {e}")
+                if first_error is None:
+                    first_error = e
+        if first_error is not None:
+            raise first_error
+
+    def _part_size(self, size):
+        """Part size of a multipart upload of size bytes (as boto3 picks it), None for a single PUT."""
+        if size < self.config.multipart_threshold:
+            return None
+        from s3transfer.utils import ChunksizeAdjuster
+        return ChunksizeAdjuster().adjust_chunksize(self.config.multipart_chunksize, size)
+
+    def verify(self):
+        """
+        Compare the size and CRC32 S3 computed for the last upload of every key with the local
+        file's; returns the keys that do not match. A multipart object has a composite checksum.
+        """
+        with self._lock:
+            sent = dict(self._sent)
+        bad = []
+        for key, (size, crc, composite) in sent.items():
+            try:
+                head = self.s3.head_object(Bucket=self.bucket, Key=key, ChecksumMode="ENABLED")
+            except Exception as e:
+                logger.error(f"S3 verify failed for {key}: {e}")
+                bad.append(key)
+                continue
+            remote = head.get("ChecksumCRC32")
+            expected = crc if composite is None or head.get("ChecksumType") == "FULL_OBJECT" else composite
+            # The part count after "-" is not always returned
+            if head["ContentLength"] != size or (remote or "").split("-")[0] != expected.split("-")[0]:
+                logger.error(f"S3 verify mismatch for {key}: local {size} bytes crc32 {expected}, "
+                             f"remote {head['ContentLength']} bytes crc32 {remote}")
+                bad.append(key)
+        return bad
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self._first_submit is not None and self._last_done is not None:
+            self.stats.add_wall("upload", self._last_done - self._first_submit)
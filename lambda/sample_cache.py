@@ -0,0 +1,238 @@
+"""
+Columnar cache of parsed sample files.
+
+The TestRunner parses its sample with pandas (read_csv / read_excel) at every
+stage, and a sample listed under several categories of sample_files is parsed
+again for each one. install() wraps those two readers for files inside the
+run's sample folder: the first read of a file is parsed as usual and the
+resulting DataFrame is stored as Parquet, keyed by the SHA-1 of the file and
+the reader arguments; later reads, in the same run or in later runs, memory-map
+the Parquet file instead of parsing the text or Excel again.
+
+Entries live in SAMPLE_CACHE_DIR (/tmp/sample_cache, shared by warm
+invocations) and on S3 under <data_root>/sample_cache/, so a cold container
+downloads the Parquet instead of re-parsing.
+
+Only results that read back identical from Parquet (values, dtypes, index and
+column labels) are stored; anything else (several sheets at once, chunked
+readers, mixed-type columns) goes through uncached. Needs pyarrow; without it
+install() does nothing.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+
+import s3_transfer
+
+logger = logging.getLogger(__name__)
+
+# Bump to drop every entry after a pandas / pyarrow upgrade that changes parsing
+SAMPLE_CACHE_VERSION = "1"
+
+DEFAULT_LOCAL_DIR = os.environ.get("SAMPLE_CACHE_DIR", "/tmp/sample_cache")
+
+READERS = ("read_csv", "read_excel")
+
+_active = None           # SampleCache used by the installed readers
+_originals = {}          # reader name -> original pandas function
+_install_lock = threading.Lock()
+
+
+def _hashable_args(args, kwargs):
+    """Stable text for the reader arguments, or None when they cannot be keyed (callables, open files)."""
+    def plain(value):
+        if isinstance(value, (str, int, float, bool, type(None), type)):
+            return True
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return all(plain(v) for v in value)
+        if isinstance(value, dict):
+            return all(plain(k) and plain(v) for k, v in value.items())
+        return False
+
+    if not plain(list(args)) or not plain(kwargs):
+        return None
+    return repr((list(args), sorted(kwargs.items())))
+
+
+class SampleCache:
+
+    def __init__(self, roots, s3=None, bucket=None, s3_prefix=None, local_dir=None):
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.s3 = s3
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix
+        self.local_dir = local_dir or DEFAULT_LOCAL_DIR
+        self._digests = {}       # (path, size, mtime_ns) -> sha1 of the content
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.stored, self.skipped = 0, 0, 0, 0
+        os.makedirs(self.local_dir, exist_ok=True)
+
+    def covers(self, path):
+        if not isinstance(path, (str, os.PathLike)):
+            return False
+        real = os.path.realpath(os.fspath(path))
+        return any(real == root or real.startswith(root + os.sep) for root in self.roots) and os.path.isfile(real)
+
+    def _content_digest(self, path):
+        st = os.stat(path)
+        sig = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(sig)
+        if digest is None:
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            with self._lock:
+                self._digests[sig] = digest
+        return digest
+
+    def key(self, reader, path, args, kwargs):
+        """Cache key of one reader call, or None when the call cannot be cached."""
+        if kwargs.get("chunksize") or kwargs.get("iterator"):
+            return None
+        arg_text = _hashable_args(args, kwargs)
+        if arg_text is None:
+            return None
+        parts = [SAMPLE_CACHE_VERSION, reader, self._content_digest(path), arg_text]
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+    def _local(self, key):
+        return os.path.join(self.local_dir, f"{key}.parquet")
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _fetch_remote(self, key):
+        if not self.s3 or not self.bucket:
+            return False
+        tmp = f"{self._local(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self.s3.download_file(self.bucket, f"{self.s3_prefix}{key}.parquet", tmp)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        os.replace(tmp, self._local(key))
+        return True
+
+    @staticmethod
+    def _load(path):
+        import pyarrow.parquet as pq
+        return pq.read_table(path, memory_map=True).to_pandas()
+
+    def _store(self, key, df, source):
+        """Write df as Parquet when it reads back identical; True when stored."""
+        import pandas as pd
+
+        if not isinstance(df, pd.DataFrame):
+            return False
+        local = self._local(key)
+        tmp = f"{local}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(tmp, engine="pyarrow")
+            restored = self._load(tmp)
+            same = (restored.equals(df) and list(restored.columns) == list(df.columns)
+                    and restored.dtypes.equals(df.dtypes) and restored.index.equals(df.index))
+        except Exception as e:
+            logger.info(f"Sample cache: {os.path.basename(source)} not storable as Parquet ({e})")
+            same = False
+        if not same:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        os.replace(tmp, local)
+        if self.s3 and self.bucket:
+            try:
+                s3_transfer.upload_files(self.s3, self.bucket, [(local, f"{self.s3_prefix}{key}.parquet")])
+            except Exception as e:
+                logger.warning(f"Sample cache: could not upload {os.path.basename(source)}: {e}")
+        return True
+
+    def read(self, reader, original, path, args, kwargs):
+        """Serve one pandas reader call from the cache, parsing (and storing) on a miss."""
+        try:
+            key = self.key(reader, path, args, kwargs)
+        except OSError:
+            key = None
+        if key is None:
+            with self._lock:
+                self.skipped += 1
+            return original(path, *args, **kwargs)
+
+        with self._key_lock(key):
+            local = self._local(key)
+            if os.path.isfile(local) or self._fetch_remote(key):
+                try:
+                    df = self._load(local)
+                    with self._lock:
+                        self.hits += 1
+                    return df
+                except Exception as e:
+                    logger.warning(f"Sample cache entry {key[:12]} unreadable, parsing again: {e}")
+                    os.remove(local)
+
+            df = original(path, *args, **kwargs)
+            stored = self._store(key, df, path)
+            with self._lock:
+                self.misses += 1
+                self.stored += int(stored)
+            if stored:
+                logger.info(f"Sample cache: stored {os.path.basename(path)} ({key[:12]})")
+            return df
+
+    def summary(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "stored": self.stored, "uncached": self.skipped}
+
+
+# ============================================================
+#  PANDAS READERS
+# ============================================================
+
+def _wrap(name, original):
+    def reader(filepath_or_buffer, *args, **kwargs):
+        cache = _active
+        if cache is None or not cache.covers(filepath_or_buffer):
+            return original(filepath_or_buffer, *args, **kwargs)
+        return cache.read(name, original, os.fspath(filepath_or_buffer), args, kwargs)
+
+    reader.__wrapped__ = original
+    reader.__name__ = original.__name__
+    reader.__doc__ = original.__doc__
+    return reader
+
+
+def install(cache):
+    """Route pandas.read_csv / read_excel on files under cache.roots through cache; returns False without pyarrow."""
+    global _active
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.warning("Sample cache disabled: pandas/pyarrow not available")
+        return False
+    with _install_lock:
+        for name in READERS:
+            if name not in _originals:
+                _originals[name] = getattr(pd, name)
+                setattr(pd, name, _wrap(name, _originals[name]))
+        _active = cache
+    return True
+
+
+def uninstall():
+    """Restore the original pandas readers."""
+    global _active
+    with _install_lock:
+        if _originals:
+            import pandas as pd
+            for name, original in _originals.items():
+                setattr(pd, name, original)
+            _originals.clear()
+        _active = None
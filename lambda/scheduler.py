@@ -0,0 +1,330 @@
+"""
+Stage list and concurrent stage scheduler for the TestRunner.
+
+Every validation stage occupies one Azure Batch VM pair (bench + dev) and
+mostly waits on it. StageScheduler hands stages to a pool of VM pairs, runs
+at most one stage per pair, and runs stages that need no VM (crossvalidation)
+alongside them. Stages running in this process need a TestRunner each
+(runner_pool.RunnerPool): at most `runners` of them run at once, so with a
+single runner they run one after the other (Azure Batch shards included).
+Stages assigned to the local backend (stage["backend"] == "local") take one
+of local_slots worker slots instead of a VM pair. A stage hitting "Virtual
+machine is already running" is put back in the queue and its pair rests for
+retry_delay seconds.
+
+With leases (vm_lease.VMLeases) a pair is leased before a stage is sent to
+it and released when the stage ends, so runs sharing the VMs never collide:
+a pair leased by another run rests for lease_retry_delay seconds while the
+stage waits for another pair, and a stage that finds no free pair for
+leases.wait_s seconds fails with VMBusyError.
+
+Completion callbacks (copying reports, checkpoints, Streamlit messages) run
+on the thread that called run(), never on the workers.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+VM_BUSY_MARKER = "Virtual machine is already running"
+
+
+class VMBusyError(RuntimeError):
+    pass
+
+
+# ============================================================
+#  STAGES
+# ============================================================
+
+def build_stages(config, tagger=None):
+    """
+    Ordered list of test stages for the config. Each stage names the TestRunner
+    method to call, its sample file and tag, and the report type copied afterwards.
+    tagger (default: segment == "tagger") selects the tagger TestRunner's single stage.
+    """
+    sample_files_cfg = config.get("sample_files", {})
+    if tagger is None:
+        tagger = config["segment"].lower() == "tagger"
+
+    if tagger:
+        f = sample_files_cfg.get("distribution")
+        if not f:
+            return []
+        return [dict(id="distribution", method="compute_validation_distribution", sample=f, tag=None, report=None)]
+
+    stages = [dict(id="crossvalidation", method="compute_crossvalidation_score", sample=None, tag=None, report=None)]
+    for i, f in enumerate(sample_files_cfg.get("accuracy", []), 1):
+        stages.append(dict(id=f"A_{i}", method="compute_validation_scores", sample=f, tag=f"A_{i}", report="ACC"))
+    for i, f in enumerate(sample_files_cfg.get("anomalies", []), 1):
+        stages.append(dict(id=f"ANOM_{i}", method="compute_validation_scores", sample=f, tag="ANOM", report="ANOM"))
+    for i, f in enumerate(sample_files_cfg.get("precision", []), 1):
+        stages.append(dict(id=f"PREC_{i}", method="compute_validation_scores", sample=f, tag="PREC", report="PREC"))
+    for i, f in enumerate(sample_files_cfg.get("stability", []), 1):
+        stages.append(dict(id=f"S_{i}", method="compute_validation_distribution", sample=f, tag=f"S_{i}", report="STAB"))
+    return stages
+
+
+def needs_vm(stage):
+    return stage["id"] != "crossvalidation" and stage.get("backend") != "local"
+
+
+def needs_local_slot(stage):
+    return stage.get("backend") == "local"
+
+
+def needs_runner(stage):
+    """True for stages run by a TestRunner of the pool (shards included), not by local workers."""
+    return not needs_local_slot(stage)
+
+
+def run_stage(runner, stage, sample_path, batch_kwargs):
+    method = getattr(runner, stage["method"])
+    if stage["id"] == "crossvalidation":
+        method(
+            old_expert_rules_zip_path=batch_kwargs.get("old_expert_rules_zip_path"),
+            new_expert_rules_zip_path=batch_kwargs.get("new_expert_rules_zip_path"),
+            save=True,
+        )
+        return
+    kwargs = dict(batch_kwargs)
+    if stage["tag"]:
+        kwargs["tag"] = stage["tag"]
+    method(os.path.join(sample_path, stage["sample"]), save=True, **kwargs)
+
+
+def vm_slots(config):
+    """
+    VM pairs available to the run, as (vm_for_bench, vm_for_dev) tuples.
+    vm_pool may list pairs ([[1, 2], [3, 4]]) or plain ids ([1, 2, 3, 4], paired in order);
+    without it the run uses the single vm_for_bench / vm_for_dev pair.
+    """
+    pool = config.get("vm_pool")
+    if not pool:
+        return [(config.get("vm_for_bench", 1), config.get("vm_for_dev", 2))]
+    if all(isinstance(p, (list, tuple)) for p in pool):
+        return [tuple(p) for p in pool]
+    if len(pool) % 2:
+        raise ValueError("vm_pool needs an even number of VM ids (bench/dev pairs)")
+    return [(pool[i], pool[i + 1]) for i in range(0, len(pool), 2)]
+
+
+# ============================================================
+#  BUSY DETECTION
+# ============================================================
+
+_busy_lock = threading.Lock()
+_running = {}      # thread ident -> stage id
+_busy = set()      # thread idents whose current attempt reported a busy VM
+
+
+def notice(text):
+    """Feed captured output; flags the stage running on this thread if its VM is busy."""
+    if VM_BUSY_MARKER not in text:
+        return False
+    ident = threading.get_ident()
+    with _busy_lock:
+        if ident in _running:
+            _busy.add(ident)
+    return True
+
+
+class _BusyLogHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            notice(record.getMessage())
+        except Exception:
+            pass
+
+
+# ============================================================
+#  SCHEDULER
+# ============================================================
+
+class StageScheduler:
+
+    def __init__(self, slots, max_retries=3, retry_delay=30.0, thread_initializer=None, local_slots=0,
+                 leases=None, lease_retry_delay=15.0, runners=1):
+        self.slots = list(slots)
+        self.local_slots = local_slots
+        self.runners = max(1, runners)
+        if not self.slots and not self.local_slots:
+            raise ValueError("StageScheduler needs at least one VM pair or local slot")
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.thread_initializer = thread_initializer
+        self.leases = leases
+        self.lease_retry_delay = lease_retry_delay
+
+    def _attempt(self, stage, slot, execute):
+        ident = threading.get_ident()
+        with _busy_lock:
+            _running[ident] = stage["id"]
+            _busy.discard(ident)
+        try:
+            try:
+                result = execute(stage, slot)
+            except Exception as e:
+                if VM_BUSY_MARKER in str(e):
+                    raise VMBusyError(str(e)) from e
+                raise
+            with _busy_lock:
+                busy = ident in _busy
+            if busy:
+                raise VMBusyError(f"{VM_BUSY_MARKER} (stage {stage['id']}, VMs {slot})")
+            return result
+        finally:
+            with _busy_lock:
+                _running.pop(ident, None)
+                _busy.discard(ident)
+
+    def run(self, stages, execute, on_done=None, should_stop=None):
+        """
+        Run execute(stage, slot) for every stage; slot is a (bench, dev) pair, or None
+        for stages that need no VM. on_done(stage, result) is called on this thread and
+        may return a list of follow-up stages, which are queued after the pending ones.
+        Returns the stages left undispatched because should_stop() turned true.
+        """
+        pending = deque(stages)
+        free = deque((slot, 0.0) for slot in self.slots)   # (slot, not-before time)
+        attempts = {}
+        running = {}
+        first_error = None
+        stopped = False
+        waiting_since = None     # first time VM stages were pending with no pair leased
+
+        handler = _BusyLogHandler()
+        logging.getLogger().addHandler(handler)
+        pool = ThreadPoolExecutor(max_workers=len(self.slots) + self.local_slots + 1,
+                                  initializer=self.thread_initializer)
+        try:
+            while pending or running:
+                if not stopped and first_error is None and should_stop is not None and pending and should_stop():
+                    logger.info(f"Scheduler stopping: {len(pending)} stages left")
+                    stopped = True
+
+                if not stopped and first_error is None:
+                    self._dispatch(pending, free, running, pool, execute)
+                    if self.leases is not None:
+                        if any(slot is not None for _stage, slot in running.values()) \
+                                or self._holding_vm_stages(running) \
+                                or not any(needs_vm(stage) for stage in pending):
+                            waiting_since = None
+                        elif waiting_since is None:
+                            waiting_since = time.monotonic()
+                        elif time.monotonic() - waiting_since > self.leases.wait_s:
+                            first_error = VMBusyError(f"No VM pair free for {self.leases.wait_s}s "
+                                                      f"(leased by other runs)")
+                            logger.error(str(first_error))
+
+                if not running:
+                    if stopped or first_error is not None or not pending:
+                        break
+                    if not free:
+                        raise ValueError(f"No VM pair for stage {pending[0]['id']}")
+                    # Every VM pair is resting after a busy answer: wait for the first one
+                    time.sleep(max(0.0, min(t for _slot, t in free) - time.monotonic()))
+                    continue
+
+                done, _ = wait(list(running), timeout=self._next_wake(free, pending), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    stage, slot = running.pop(fut)
+                    try:
+                        result = fut.result()
+                    except VMBusyError as e:
+                        attempts[stage["id"]] = attempts.get(stage["id"], 0) + 1
+                        if slot is not None:
+                            self._release(slot)
+                            free.append((slot, time.monotonic() + self.retry_delay))
+                        if attempts[stage["id"]] > self.max_retries:
+                            logger.error(f"Stage {stage['id']}: VMs still busy after {self.max_retries} retries")
+                            first_error = first_error or e
+                        else:
+                            logger.warning(f"Stage {stage['id']}: VMs {slot} busy, retrying "
+                                           f"({attempts[stage['id']]}/{self.max_retries})")
+                            pending.appendleft(stage)
+                        continue
+                    except Exception as e:
+                        logger.error(f"Stage {stage['id']} failed: {e}")
+                        if slot is not None:
+                            self._release(slot)
+                            free.append((slot, 0.0))
+                        first_error = first_error or e
+                        continue
+                    if slot is not None:
+                        self._release(slot)
+                        free.append((slot, 0.0))
+                    if on_done is not None:
+                        pending.extend(on_done(stage, result) or [])
+        finally:
+            pool.shutdown(wait=True)
+            logging.getLogger().removeHandler(handler)
+
+        if first_error is not None:
+            raise first_error
+        return list(pending)
+
+    def _dispatch(self, pending, free, running, pool, execute):
+        """Start every pending stage whose resource is available, keeping the order of the rest."""
+        now = time.monotonic()
+        local_busy = sum(1 for stage, _slot in running.values() if needs_local_slot(stage))
+        runners_busy = sum(1 for stage, _slot in running.values() if needs_runner(stage))
+        waiting = deque()
+        while pending:
+            stage = pending.popleft()
+            if needs_local_slot(stage):
+                if local_busy >= self.local_slots:
+                    waiting.append(stage)
+                    continue
+                local_busy += 1
+                logger.info(f"Stage {stage['id']} -> local worker")
+                running[pool.submit(self._attempt, stage, None, execute)] = (stage, None)
+                continue
+            if needs_runner(stage) and runners_busy >= self.runners:
+                waiting.append(stage)
+                continue
+            if not needs_vm(stage):
+                runners_busy += 1
+                running[pool.submit(self._attempt, stage, None, execute)] = (stage, None)
+                continue
+            slot = self._take_slot(free, now)
+            if slot is None:
+                waiting.append(stage)
+                continue
+            logger.info(f"Stage {stage['id']} -> VMs bench={slot[0]} dev={slot[1]}")
+            runners_busy += needs_runner(stage)
+            running[pool.submit(self._attempt, stage, slot, execute)] = (stage, slot)
+        pending.extend(waiting)
+
+    def _holding_vm_stages(self, running):
+        """True when VM stages wait for a TestRunner of this process, not for a pair."""
+        return sum(1 for stage, _slot in running.values() if needs_runner(stage)) >= self.runners
+
+    def _take_slot(self, free, now):
+        """First ready pair this run could lease (removed from free), or None."""
+        for item in [item for item in free if item[1] <= now]:
+            free.remove(item)
+            slot = item[0]
+            if self.leases is None or self.leases.acquire(slot):
+                return slot
+            logger.info(f"VMs {slot} leased by another run, retrying in {self.lease_retry_delay}s")
+            free.append((slot, now + self.lease_retry_delay))
+        return None
+
+    def _release(self, slot):
+        if self.leases is not None:
+            self.leases.release(slot)
+
+    @staticmethod
+    def _next_wake(free, pending):
+        """How long to wait for a running stage before re-checking resting VM pairs."""
+        now = time.monotonic()
+        resting = [t for _slot, t in free if t > now]
+        if not pending or not resting:
+            return None
+        return min(resting) - now
@@ -0,0 +1,254 @@
+"""
+Memoized stage results, keyed by the content of everything a stage reads.
+
+The key of a stage is a hash of the S3 fingerprints (ETag + size of every
+object) of the old model, old expert rules, new model, new expert rules and
+sample file, plus the TestRunner method and tag. An entry holds the files the
+stage wrote to the output folder (under the TestRunner's own names), the batch
+CSV it produced and the runner attributes it changed, and is kept both in a
+local directory and on S3. The final report / batch CSV names carry the date of
+the run, so a hit goes through the same rename and copy step as a computed stage.
+
+Not implemented: reusing the old-side (prod model) scores with a new develop
+model. TestRunner scores the old and the new model in one call and offers no
+way to inject precomputed old-side scores, so the unit of reuse is the whole
+stage and the key includes the new model: every new candidate misses. The cache
+only saves VM time when an unchanged prod/develop pair runs again on the same
+samples (report tweaks, retries, reruns after a failure).
+"""
+
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import logging
+import threading
+
+import s3_transfer
+
+logger = logging.getLogger(__name__)
+
+# Bump to invalidate every entry after a TestRunner upgrade
+SCORE_CACHE_VERSION = "2"
+
+DEFAULT_LOCAL_DIR = os.environ.get("SCORE_CACHE_DIR", "/tmp/score_cache")
+
+
+def fingerprint(objects):
+    """Stable hash of [(relative_key, etag, size), ...] describing a file or folder on S3."""
+    h = hashlib.sha1()
+    for rel, etag, size in sorted(objects):
+        h.update(f"{rel}\0{etag}\0{size}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def stage_key(stage, segment, fingerprints, old_model, new_model, old_expert, new_expert):
+    """fingerprints maps artifact path -> fingerprint; missing expert rules count as empty."""
+    parts = [
+        SCORE_CACHE_VERSION, segment, stage["method"], stage["tag"] or "",
+        fingerprints.get(old_model, ""), fingerprints.get(old_expert, "") if old_expert else "",
+        fingerprints.get(new_model, ""), fingerprints.get(new_expert, "") if new_expert else "",
+        fingerprints.get(f"sample/{stage['sample']}", "") if stage["sample"] else "",
+    ]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+# ============================================================
+#  RUNNER STATE DELTA
+# ============================================================
+
+def shallow_state(runner):
+    """Cheap description of the runner attributes, enough to find what a stage changed."""
+    state = {}
+    for name, value in list(vars(runner).items()):
+        if isinstance(value, dict):
+            state[name] = (id(value), {k: id(v) for k, v in list(value.items())})
+        elif isinstance(value, list):
+            state[name] = (id(value), len(value))
+        else:
+            state[name] = (id(value), None)
+    return state
+
+
+def state_delta(before, runner):
+    """Attributes the stage set, dict keys it added/replaced and items it appended to lists."""
+    delta = {"set": {}, "dict": {}, "list": {}}
+    for name, value in list(vars(runner).items()):
+        prev = before.get(name)
+        if prev is None or prev[0] != id(value):
+            delta["set"][name] = value
+        elif isinstance(value, dict):
+            changed = {k: v for k, v in list(value.items()) if prev[1].get(k) != id(v)}
+            if changed:
+                delta["dict"][name] = changed
+        elif isinstance(value, list) and len(value) > prev[1]:
+            delta["list"][name] = value[prev[1]:]
+    return delta
+
+
+def apply_delta(runner, delta):
+    for name, value in delta["set"].items():
+        setattr(runner, name, value)
+    for name, changed in delta["dict"].items():
+        target = getattr(runner, name, None)
+        if isinstance(target, dict):
+            target.update(changed)
+        else:
+            setattr(runner, name, dict(changed))
+    for name, items in delta["list"].items():
+        target = getattr(runner, name, None)
+        if isinstance(target, list):
+            target.extend(items)
+        else:
+            setattr(runner, name, list(items))
+
+
+# ============================================================
+#  CACHE
+# ============================================================
+
+class ScoreCache:
+
+    def __init__(self, s3=None, bucket=None, s3_prefix=None, local_dir=None, refresh=False):
+        self.s3 = s3
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix
+        self.local_dir = local_dir or DEFAULT_LOCAL_DIR
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.stored = [], [], []
+
+    def _local(self, key):
+        return os.path.join(self.local_dir, key)
+
+    def _remote(self, key):
+        return f"{self.s3_prefix}{key}/"
+
+    def _fetch_remote(self, key):
+        """Copy an entry from S3 into the local directory; True when found."""
+        if not self.s3 or not self.bucket:
+            return False
+        prefix = self._remote(key)
+        items = [(k, os.path.join(self._local(key), *k[len(prefix):].split("/")))
+                 for k, _size, _etag in s3_transfer.list_prefix(self.s3, self.bucket, prefix)]
+        if not any(k.endswith("/entry.json") for k, _ in items):
+            return False
+        s3_transfer.download_objects(self.s3, self.bucket, items)
+        return True
+
+    def contains(self, key):
+        """True when get() would find the entry (locally or on S3), without restoring it."""
+        if self.refresh:
+            return False
+        if os.path.isfile(os.path.join(self._local(key), "entry.json")):
+            return True
+        if not self.s3 or not self.bucket:
+            return False
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self._remote(key) + "entry.json")
+            return True
+        except Exception:
+            return False
+
+    def get(self, key, stage_id, output_folder, runner=None):
+        """
+        Restore a stored stage into output_folder and, if given, runner. Returns the entry on a hit
+        (with "batch": path of the stored batch CSV, or None, and "delta": the stored runner changes),
+        None on a miss.
+        """
+        if self.refresh:
+            with self._lock:
+                self.misses.append(stage_id)
+            return None
+        entry_path = os.path.join(self._local(key), "entry.json")
+        try:
+            if not os.path.isfile(entry_path) and not self._fetch_remote(key):
+                with self._lock:
+                    self.misses.append(stage_id)
+                return None
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+            for rel in entry["files"]:
+                dst = os.path.join(output_folder, *rel.split("/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(self._local(key), "files", *rel.split("/")), dst)
+            with open(os.path.join(self._local(key), "state.pkl"), "rb") as f:
+                delta = pickle.load(f)
+            if runner is not None:
+                apply_delta(runner, delta)
+        except Exception as e:
+            logger.warning(f"Score cache entry {key} unusable, recomputing {stage_id}: {e}")
+            with self._lock:
+                self.misses.append(stage_id)
+            return None
+        logger.info(f"Score cache hit for {stage_id} ({key[:12]}, from {entry['stage']} on {entry['created']})")
+        with self._lock:
+            self.hits.append(stage_id)
+        return dict(entry, batch=os.path.join(self._local(key), "batch", entry["batch"]) if entry.get("batch") else None,
+                    delta=delta)
+
+    def put(self, key, stage_id, output_folder, files, delta, batch_file=None):
+        """
+        Store a computed stage locally and, when configured, on S3. files are the stage's own
+        outputs (relative to output_folder, not the renamed copies); batch_file its batch CSV.
+        """
+        local = self._local(key)
+        tmp = f"{local}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            for rel in files:
+                dst = os.path.join(tmp, "files", *rel.split("/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(output_folder, *rel.split("/")), dst)
+            os.makedirs(tmp, exist_ok=True)
+            if batch_file:
+                os.makedirs(os.path.join(tmp, "batch"), exist_ok=True)
+                shutil.copy2(batch_file, os.path.join(tmp, "batch", os.path.basename(batch_file)))
+            with open(os.path.join(tmp, "state.pkl"), "wb") as f:
+                pickle.dump(delta, f, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp, "entry.json"), "w") as f:
+                json.dump({"key": key, "stage": stage_id, "files": files,
+                           "batch": os.path.basename(batch_file) if batch_file else None,
+                           "created": time.strftime("%Y-%m-%d %H:%M:%S")}, f)
+            shutil.rmtree(local, ignore_errors=True)
+            os.replace(tmp, local)
+        except Exception as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            logger.warning(f"Score cache: could not store {stage_id}: {e}")
+            return False
+
+        if self.s3 and self.bucket:
+            items = []
+            for root, _dirs, fnames in os.walk(local):
+                for fname in fnames:
+                    path = os.path.join(root, fname)
+                    rel = os.path.relpath(path, local).replace("\\", "/")
+                    # entry.json last: its presence marks a complete entry
+                    items.append((path, self._remote(key) + rel))
+            items.sort(key=lambda item: item[1].endswith("/entry.json"))
+            try:
+                s3_transfer.upload_files(self.s3, self.bucket, items[:-1])
+                s3_transfer.upload_files(self.s3, self.bucket, items[-1:])
+            except Exception as e:
+                logger.warning(f"Score cache: could not upload {stage_id}: {e}")
+        with self._lock:
+            self.stored.append(stage_id)
+        return True
+
+    def invalidate(self, key=None):
+        """Drop one entry, or every entry, locally and on S3. Returns the number of S3 objects deleted."""
+        shutil.rmtree(self._local(key) if key else self.local_dir, ignore_errors=True)
+        deleted = 0
+        if self.s3 and self.bucket:
+            prefix = self._remote(key) if key else self.s3_prefix
+            keys = [k for k, _size, _etag in s3_transfer.list_prefix(self.s3, self.bucket, prefix)]
+            for i in range(0, len(keys), 1000):
+                self.s3.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]]})
+            deleted = len(keys)
+        logger.info(f"Score cache invalidated ({'entry ' + key if key else 'all entries'}, {deleted} S3 objects)")
+        return deleted
+
+    def summary(self):
+        with self._lock:
+            return {"hits": list(self.hits), "misses": list(self.misses), "stored": list(self.stored)}
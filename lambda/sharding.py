@@ -0,0 +1,341 @@
+"""
+Sample sharding: one large validation stage spread over several VM pairs or
+local workers.
+
+A stage whose sample has more than shard_min_rows rows is split into N
+contiguous, row-balanced shards (header repeated, bytes copied unchanged).
+Each shard runs as its own stage ("A_1#0", "A_1#1", ...) with the parent's
+tag, never on the main runner: on a local worker, or on a TestRunner of the
+run's RunnerPool like any other stage, so shards load no more models than
+fit in memory (runner_pool). The runner deltas of the shards are then merged
+into the delta the unsharded stage would have produced and applied to the
+main runner, and the shards' batch CSVs are concatenated in order, so
+save_reports and the copied batch CSV see the same data as before.
+
+Merging is exact or it does not happen:
+  - values every shard set again unchanged from the main runner's value before
+    the stage (labels, configuration read at construction) are kept once;
+  - DataFrames, Series, arrays and lists whose lengths add up to the sample's
+    row count are row-level data and are concatenated in shard order;
+  - anything else (a count or metric computed per shard, even when equal in
+    every shard) cannot be merged: the shard_metrics function recomputes it
+    from the merged row-level data and batch CSV (recompute), as the unsharded
+    stage would. Without it, or when it leaves an entry out, ShardMergeError
+    and the stage is re-run unsharded.
+
+The stage report is then written by save_reports() on a copy of the main
+runner holding the merged delta (rebuild_reports), so it has the layout and
+formatting of the unsharded one; a report save_reports does not write is a
+ShardMergeError too.
+
+Sharded stages are not stored in the score cache; stages it already holds are
+not sharded.
+
+Config:
+  shard_min_rows   samples with more rows are sharded (unset: no sharding)
+  shards           number of shards (default: VM pairs with a runner in memory plus local
+                   workers that can take shards, at least 2)
+  shard_metrics    "module:function" recomputing the per-shard values of a merged stage
+                   (see recompute)
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import importlib
+
+import score_cache
+import runner_pool
+import local_backend
+
+logger = logging.getLogger(__name__)
+
+SHARD_DIR = "_shards"
+
+
+class ShardMergeError(ValueError):
+    pass
+
+
+# ============================================================
+#  SPLIT
+# ============================================================
+
+def iter_records(f):
+    """Raw CSV records of a binary file; a quoted field may span several lines."""
+    pending = b""
+    for line in f:
+        pending += line
+        if pending.count(b'"') % 2 == 0:
+            yield pending
+            pending = b""
+    if pending:
+        yield pending
+
+
+def count_records(path):
+    """Data records of a CSV sample (header excluded)."""
+    with open(path, "rb") as f:
+        return max(0, sum(1 for _ in iter_records(f)) - 1)
+
+
+def shard_sizes(rows, n):
+    """Row-balanced sizes: the first rows % n shards get one extra row."""
+    base, extra = divmod(rows, n)
+    return [base + (1 if i < extra else 0) for i in range(n)]
+
+
+def split_sample(path, n, out_dir):
+    """Write n contiguous shards of path into out_dir; returns their paths."""
+    rows = count_records(path)
+    sizes = [size for size in shard_sizes(rows, n) if size]
+    os.makedirs(out_dir, exist_ok=True)
+    name = os.path.basename(path)
+    paths = [os.path.join(out_dir, f"{i}_{name}") for i in range(len(sizes))]
+    with open(path, "rb") as f:
+        records = iter_records(f)
+        header = next(records, b"")
+        if header and not header.endswith(b"\n"):
+            header += b"\n"
+        for shard_path, size in zip(paths, sizes):
+            with open(shard_path, "wb") as out:
+                out.write(header)
+                for _ in range(size):
+                    out.write(next(records))
+    return paths
+
+
+def shard_slots(config, vm_pairs):
+    """VM pairs plus the local workers that can take shards (none when every stage stays on Azure Batch)."""
+    mode = config.get("execution_backend", "auto")
+    if mode == local_backend.LOCAL or (mode == "auto" and (config.get("local_max_rows") is not None
+                                                          or config.get("local_max_mb") is not None)):
+        return vm_pairs + local_backend.local_workers(config)
+    return vm_pairs
+
+
+def shard_count(config, slots, rows):
+    """Number of shards for a sample of rows rows: "shards", or one per slot (at least 2)."""
+    return min(int(config.get("shards") or max(2, slots)), rows)
+
+
+def plan(stage, config, sample_path, slots):
+    """
+    Shard stages for stage, or None when it should run whole.
+    slots is the number of VM pairs and local workers available to the shards (shard_slots).
+    """
+    min_rows = config.get("shard_min_rows")
+    if min_rows is None or not stage["sample"] or stage.get("no_shard") or not stage["sample"].lower().endswith(".csv"):
+        return None
+    path = os.path.join(sample_path, stage["sample"])
+    if not os.path.isfile(path):
+        return None
+    rows = count_records(path)
+    n = shard_count(config, slots, rows)
+    if rows <= min_rows or n < 2:
+        return None
+
+    out_dir = os.path.join(sample_path, SHARD_DIR, stage["id"])
+    shard_paths = split_sample(path, n, out_dir)
+    logger.info(f"Stage {stage['id']}: {rows} rows split into {len(shard_paths)} shards")
+    return [
+        dict(stage, id=f"{stage['id']}#{i}", sample=os.path.relpath(p, sample_path).replace("\\", "/"),
+             report=None, shard_of=stage["id"], shard_index=i, shard_count=len(shard_paths), shard_rows=rows)
+        for i, p in enumerate(shard_paths)
+    ]
+
+
+def cleanup(sample_path, stage_id):
+    shutil.rmtree(os.path.join(sample_path, SHARD_DIR, stage_id), ignore_errors=True)
+
+
+# ============================================================
+#  MERGE
+# ============================================================
+
+def _equal(a, b):
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    if hasattr(a, "equals"):                      # pandas
+        return a.equals(b)
+    if type(a).__module__ == "numpy":
+        import numpy as np
+        return np.array_equal(a, b)
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def _length(value):
+    if isinstance(value, (str, bytes, dict)):
+        return None
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+_MISSING = object()
+
+
+def merge_values(values, rows, where, base=_MISSING):
+    """
+    Merge one value across shards (in shard order) into its unsharded equivalent.
+    base is the main runner's value before the stage (_MISSING when it had none).
+    """
+    first = values[0]
+    # Only a value the stage set again unchanged is the same in every shard by construction:
+    # an equal count or metric per shard (row-balanced shards) is not the unsharded one.
+    if base is not _MISSING and all(_equal(base, v) for v in values):
+        return first
+    if isinstance(first, dict) and all(isinstance(v, dict) for v in values):
+        merged = {}
+        for key in dict.fromkeys(k for v in values for k in v):
+            merged[key] = merge_values([v[key] for v in values if key in v], rows, f"{where}[{key!r}]",
+                                       base.get(key, _MISSING) if isinstance(base, dict) else _MISSING)
+        return merged
+    lengths = [_length(v) for v in values]
+    if None in lengths or sum(lengths) != rows or any(type(v) is not type(first) for v in values):
+        raise ShardMergeError(f"{where} was computed per shard and is not row-level data")
+    module = type(first).__module__
+    if module.startswith("pandas"):
+        import pandas as pd
+        ranged = all(isinstance(v.index, pd.RangeIndex) and v.index.start == 0 for v in values)
+        return pd.concat(values, ignore_index=ranged)
+    if module == "numpy":
+        import numpy as np
+        return np.concatenate(values)
+    if isinstance(first, (list, tuple)):
+        return type(first)(item for v in values for item in v)
+    raise ShardMergeError(f"{where}: cannot concatenate {type(first).__name__}")
+
+
+def merge_deltas(deltas, rows, base):
+    """
+    Combine the runner deltas of every shard (in order) into the delta of the whole stage.
+    base holds the main runner's attributes before the stage. Returns (merged, unresolved):
+    unresolved lists the (kind, name, key) entries that are not row-level data (key is the
+    dict key for "dict" entries, None otherwise); they are left out of merged.
+    """
+    merged = {"set": {}, "dict": {}, "list": {}}
+    unresolved = []
+    for name in dict.fromkeys(n for d in deltas for n in d["set"]):
+        try:
+            merged["set"][name] = merge_values([d["set"][name] for d in deltas if name in d["set"]], rows, name,
+                                               base.get(name, _MISSING))
+        except ShardMergeError:
+            unresolved.append(("set", name, None))
+    for name in dict.fromkeys(n for d in deltas for n in d["dict"]):
+        parts = [d["dict"][name] for d in deltas if name in d["dict"]]
+        before = base.get(name)
+        for key in dict.fromkeys(k for part in parts for k in part):
+            try:
+                merged["dict"].setdefault(name, {})[key] = merge_values(
+                    [part[key] for part in parts if key in part], rows, f"{name}[{key!r}]",
+                    before.get(key, _MISSING) if isinstance(before, dict) else _MISSING)
+            except ShardMergeError:
+                unresolved.append(("dict", name, key))
+    # Appended items are new by definition: only row-level lists merge
+    for name in dict.fromkeys(n for d in deltas for n in d["list"]):
+        try:
+            merged["list"][name] = merge_values([d["list"][name] for d in deltas if name in d["list"]], rows, name)
+        except ShardMergeError:
+            unresolved.append(("list", name, None))
+    return merged, unresolved
+
+
+def _entry(kind, name, key):
+    return f"{name}[{key!r}]" if kind == "dict" else name
+
+
+def metrics_hook(config):
+    """The shard_metrics function ("module:function") of the config, or None."""
+    spec = config.get("shard_metrics")
+    if not spec:
+        return None
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"shard_metrics must be module:function, got {spec!r}")
+    hook = importlib.import_module(module)
+    for part in name.split("."):
+        hook = getattr(hook, part)
+    return hook
+
+
+def recompute(hook, runner, stage, merged, unresolved, batch_file):
+    """
+    Fill the unresolved entries of merged with hook(runner, stage, batch_file, unresolved): runner is
+    a copy of the main runner holding the merged row-level data, batch_file the merged batch CSV (or
+    None), and the hook returns the missing values as a delta ({"set", "dict", "list"}, any part may
+    be left out). An entry neither hook nor merge provides raises ShardMergeError.
+    """
+    if hook is None:
+        raise ShardMergeError(f"{', '.join(_entry(*e) for e in unresolved)} computed per shard "
+                              f"and no shard_metrics to rebuild them")
+    clone = runner_pool.main_runner(runner)
+    score_cache.apply_delta(clone, merged)
+    fixed = hook(clone, stage, batch_file, list(unresolved)) or {}
+    for kind, name, key in unresolved:
+        values = fixed.get(kind, {})
+        if name not in values or (kind == "dict" and key not in values[name]):
+            raise ShardMergeError(f"shard_metrics did not rebuild {_entry(kind, name, key)}")
+        if kind == "dict":
+            merged["dict"].setdefault(name, {})[key] = values[name][key]
+        else:
+            merged[kind][name] = values[name]
+    return merged
+
+
+def rebuild_reports(runner, delta, folders, suffix, dst_folder):
+    """
+    Write the stage report (the files ending in suffix the shards wrote, same relative paths in
+    every shard folder) into dst_folder, from save_reports() on a copy of runner holding delta:
+    the report the unsharded stage writes, formatting included. Returns the files written.
+    """
+    found = []
+    for folder in folders:
+        found.append(sorted(
+            os.path.relpath(os.path.join(root, f), folder)
+            for root, _dirs, files in os.walk(folder) for f in files if f.endswith(suffix)
+        ))
+    if any(rels != found[0] for rels in found[1:]):
+        raise ShardMergeError(f"shards wrote different {suffix} reports")
+    if not found[0]:
+        return []
+    clone = runner_pool.main_runner(runner)
+    score_cache.apply_delta(clone, delta)
+    os.makedirs(os.path.dirname(dst_folder), exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix=".save_reports_", dir=os.path.dirname(dst_folder))
+    try:
+        runner_pool.save_reports(clone, scratch, weights=None, excel=True, pdf=False)
+        missing = [rel for rel in found[0] if not os.path.isfile(os.path.join(scratch, rel))]
+        if missing:
+            raise ShardMergeError(f"save_reports did not write {', '.join(missing)}")
+        written = []
+        for rel in found[0]:
+            dst = os.path.join(dst_folder, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(os.path.join(scratch, rel), dst)
+            written.append(dst)
+        return written
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def concat_csv(paths, dst):
+    """Concatenate CSV files keeping the first header only."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(dst, "wb") as out:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as f:
+                records = iter_records(f)
+                header = next(records, b"")
+                if i == 0:
+                    out.write(header if header.endswith(b"\n") else header + b"\n")
+                for record in records:
+                    out.write(record if record.endswith(b"\n") else record + b"\n")
+    return dst
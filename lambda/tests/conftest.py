@@ -0,0 +1,107 @@
+"""
+Shared fixtures: the lambda modules on sys.path and an in-memory S3 (moto).
+
+Run from the lambda folder:
+  pip install -r requirements-dev.txt
+  python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+BUCKET = "test-bucket"
+
+
+@pytest.fixture(autouse=True)
+def aws_env(monkeypatch):
+    """Fake credentials, so nothing can reach a real account."""
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_SESSION_TOKEN", "testing"), ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("S3_ENDPOINT_URL", raising=False)
+
+
+@pytest.fixture
+def s3():
+    """boto3 S3 client on moto with an empty BUCKET; the shared s3_transfer client points at it too."""
+    moto = pytest.importorskip("moto")
+    import s3_transfer
+
+    with moto.mock_aws():
+        s3_transfer.reset_client()
+        client = s3_transfer.get_client()
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+        s3_transfer.reset_client()
+
+
+@pytest.fixture
+def suite(tmp_path, monkeypatch):
+    """The fake suite_tests package (tests/fake_suite), copied so its data/batch folder is per test."""
+    import shutil
+
+    root = str(tmp_path / "ce")
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_suite"), root)
+    for name in [n for n in sys.modules if n == "suite_tests" or n.startswith("suite_tests.")]:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.syspath_prepend(root)
+    from suite_tests import testRunner
+    yield testRunner
+    for name in [n for n in sys.modules if n == "suite_tests" or n.startswith("suite_tests.")]:
+        del sys.modules[name]
+
+
+SAMPLES = {
+    "s0.csv": ["coffee shop", "grocery store", "rent", "salary", "fuel station"],
+    "s1.csv": ["pharmacy", "train ticket", "restaurant"],
+    "s2.csv": ["cinema", "bookshop", "electricity bill", "water bill"],
+}
+
+
+def sample_csv(descriptions):
+    return ("description\n" + "".join(f"{d}\n" for d in descriptions)).encode("utf-8")
+
+
+def run_config(s3, tmp_path, **overrides):
+    """Consumer config on BUCKET with the SAMPLES, models and expert rules uploaded under P/it/consumer/."""
+    base = "P/it/consumer/"
+    for name, rows in SAMPLES.items():
+        put_file(s3, f"{base}sample/{name}", sample_csv(rows))
+    put_file(s3, f"{base}model/prod/it_0_old.zip", b"old model")
+    put_file(s3, f"{base}model/develop/it_0_new.zip", b"new model")
+    put_file(s3, f"{base}model/expertrules/rules.zip", b"rules")
+    config = dict(
+        country="it", segment="consumer", old_model="it_0_old.zip", new_model="it_0_new.zip",
+        old_expert_rules="rules.zip", new_expert_rules="rules.zip", s3_bucket=BUCKET, s3_prefix="P/",
+        work_root=str(tmp_path / "work"), download_mode="selective",
+        sample_files={"accuracy": ["s0.csv", "s1.csv"], "anomalies": ["s2.csv"]},
+    )
+    config.update(overrides)
+    return config
+
+
+def output_keys(s3, prefix="P/it/consumer/output/"):
+    import s3_transfer
+    return sorted(key[len(prefix):] for key, _size, _etag in s3_transfer.list_prefix(s3, BUCKET, prefix))
+
+
+def put_file(s3, key, data):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=data)
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
@@ -0,0 +1 @@
+"""Stand-in for the suite_tests package of CategorizationEnginePython, used by the tests."""
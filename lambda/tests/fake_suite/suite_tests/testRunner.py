@@ -0,0 +1,94 @@
+"""
+TestRunner stand-in: same constructor, stage methods and save_reports as the real one,
+with two toy "models" instead of CategorizationEnginePython and no Azure Batch.
+
+A stage reads the sample (CSV with a "description" column), predicts a category per
+row with the old and the new model, writes the batch CSV <sample stem>_categorized.csv
+into suite_tests/data/batch and the stage report <output>/<old_uid>/<tag>_<REPORT>.xlsx,
+and keeps the rows (predictions[tag]) and their metrics (scores[tag]). save_reports
+writes the final report and again the report of every stage, from predictions.
+shard_metrics is the sharding hook rebuilding scores and calls of a sharded stage.
+"""
+
+import os
+
+BATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "batch")
+BATCH_SUFFIX = "_categorized.csv"
+
+REPORTS = {"ANOM": "ANOM", "PREC": "PREC"}
+
+
+def predict(model, text):
+    return f"cat_{(len(text) + len(model)) % 3}"
+
+
+def report_of(tag):
+    return "STAB" if tag.startswith("S_") else REPORTS.get(tag, "ACC")
+
+
+def metrics(rows):
+    return {"rows": len(rows), "agreement": float((rows["category_old"] == rows["category_new"]).mean())}
+
+
+def shard_metrics(runner, stage, batch_file, unresolved):
+    """scores and calls of a sharded stage, from its merged rows."""
+    tag = stage["tag"]
+    return {"dict": {"scores": {tag: metrics(runner.predictions[tag])}}, "list": {"calls": [tag]}}
+
+
+class TestRunner:
+
+    # Constructions in this process: each one stands for a full model load
+    instances = 0
+
+    def __init__(self, old_model_path, new_model_path, output_folder, old_expert_rules_zip_path=None,
+                 new_expert_rules_zip_path=None):
+        type(self).instances += 1
+        self.old_model = os.path.basename(old_model_path)
+        self.new_model = os.path.basename(new_model_path)
+        self.output_folder = output_folder
+        self.old_uid, self.new_uid, self.now = "OLD", "NEW", "0000"
+        self.predictions = {}
+        self.scores = {}
+        self.calls = []
+
+    def compute_crossvalidation_score(self, old_expert_rules_zip_path=None, new_expert_rules_zip_path=None, save=True):
+        self.scores["crossvalidation"] = {"folds": 5}
+        self.calls.append("crossvalidation")
+
+    def _score(self, sample, tag, report, save):
+        import pandas as pd
+
+        frame = pd.read_csv(sample)
+        rows = pd.DataFrame({
+            "description": frame["description"],
+            "category_old": [predict(self.old_model, text) for text in frame["description"]],
+            "category_new": [predict(self.new_model, text) for text in frame["description"]],
+        })
+        self.predictions[tag] = rows
+        self.scores[tag] = metrics(rows)
+        self.calls.append(tag)
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(sample))[0]
+        rows.to_csv(os.path.join(BATCH_DIR, stem + BATCH_SUFFIX), index=False)
+        if save:
+            folder = os.path.join(self.output_folder, self.old_uid)
+            os.makedirs(folder, exist_ok=True)
+            rows.to_excel(os.path.join(folder, f"{tag}_{report}.xlsx"), index=False)
+
+    def compute_validation_scores(self, sample, save=True, tag=None, **kwargs):
+        self._score(sample, tag, REPORTS.get(tag, "ACC"), save)
+
+    def compute_validation_distribution(self, sample, save=True, tag=None, **kwargs):
+        self._score(sample, tag, "STAB", save)
+
+    def save_reports(self, weights=None, excel=True, pdf=False):
+        import pandas as pd
+
+        folder = os.path.join(self.output_folder, self.old_uid)
+        os.makedirs(folder, exist_ok=True)
+        summary = pd.DataFrame([dict(stage=tag, **values) for tag, values in sorted(self.scores.items())])
+        summary.to_excel(os.path.join(folder, f"{self.new_uid}_final_report_{self.now}.xlsx"), index=False)
+        for tag, rows in self.predictions.items():
+            rows.to_excel(os.path.join(folder, f"{tag}_{report_of(tag)}.xlsx"), index=False)
+        return self.scores
@@ -0,0 +1,17 @@
+"""Tagger TestRunner stand-in: a single distribution stage writing <sample stem>_tagged.csv."""
+
+import os
+
+from suite_tests import testRunner
+
+
+class TestRunner(testRunner.TestRunner):
+
+    def __init__(self, old_model_path, new_model_path, output_folder):
+        super().__init__(old_model_path, new_model_path, output_folder)
+
+    def compute_validation_distribution(self, sample, save=True, tag=None, **kwargs):
+        self._score(sample, tag or "distribution", "STAB", save)
+        stem = os.path.splitext(os.path.basename(sample))[0]
+        os.replace(os.path.join(testRunner.BATCH_DIR, stem + testRunner.BATCH_SUFFIX),
+                   os.path.join(testRunner.BATCH_DIR, stem + "_tagged.csv"))
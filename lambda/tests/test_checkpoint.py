@@ -0,0 +1,97 @@
+import io
+
+import pandas as pd
+import pytest
+
+import handler
+from conftest import run_config
+from test_handler import read_bytes, read_json
+
+FINAL_REPORT = "P/it/consumer/output/OLD/NEW_final_report_0000.xlsx"
+DIFF_JSON = "P/it/consumer/output/prediction_diff.json"
+
+
+def scored_stages(s3):
+    return sorted(pd.read_excel(io.BytesIO(read_bytes(s3, FINAL_REPORT)))["stage"])
+
+
+def record_calls(monkeypatch, runner_class, fail_tag=None):
+    """Tags scored by any runner; the first call for fail_tag raises, like a crashed invocation."""
+    calls = []
+    original = runner_class._score
+
+    def score(self, sample, tag, report, save):
+        calls.append(tag)
+        if tag == fail_tag and calls.count(tag) == 1:
+            raise RuntimeError("invocation killed")
+        return original(self, sample, tag, report, save)
+
+    monkeypatch.setattr(runner_class, "_score", score)
+    return calls
+
+
+def test_retry_after_crash_resumes_from_the_checkpoint(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner, fail_tag="ANOM")
+    config = run_config(s3, tmp_path, prediction_diff=True)
+
+    with pytest.raises(RuntimeError):
+        handler.run_tests(config)
+    assert calls == ["A_1", "A_2", "ANOM"]
+
+    # The Lambda retry lands on a fresh container: nothing local survives
+    result = handler.run_tests(dict(config, work_root=str(tmp_path / "retry")))
+
+    assert result["status"] == "completed"
+    assert result["checkpoint"]["resumed"] is True
+    assert result["checkpoint"]["skipped_stages"] == ["crossvalidation", "A_1", "A_2"]
+    assert calls == ["A_1", "A_2", "ANOM", "ANOM"]
+    # Runner state of the first invocation restored: the final report has every stage
+    assert scored_stages(s3) == ["ANOM", "A_1", "A_2", "crossvalidation"]
+    # Batch CSVs of the first invocation came back from the checkpoint
+    assert sorted(read_json(s3, DIFF_JSON)["stages"]) == ["ANOM_1", "A_1", "A_2"]
+
+
+def test_resume_false_starts_over(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner, fail_tag="ANOM")
+    config = run_config(s3, tmp_path)
+    with pytest.raises(RuntimeError):
+        handler.run_tests(config)
+
+    result = handler.run_tests(dict(config, resume=False))
+
+    assert result["checkpoint"]["resumed"] is False
+    assert calls == ["A_1", "A_2", "ANOM", "A_1", "A_2", "ANOM"]
+
+
+class ShortContext:
+    """Lambda context whose remaining time runs out after `stages` checks."""
+
+    def __init__(self, stages):
+        self.checks = stages
+
+    def get_remaining_time_in_millis(self):
+        self.checks -= 1
+        return 900_000 if self.checks >= 0 else 1_000
+
+
+def test_hand_off_continues_in_the_next_invocation(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+    handed = []
+    monkeypatch.setattr(handler, "hand_off", lambda config, context: handed.append(
+        dict(config, _handoffs=config.get("_handoffs", 0) + 1)))
+    config = run_config(s3, tmp_path, prediction_diff=True)
+
+    first = handler.run_tests(config, ShortContext(2))
+
+    assert first["status"] == "handed_off"
+    assert first["checkpoint"]["completed_stages"] == ["crossvalidation", "A_1"]
+    assert len(handed) == 1
+
+    second = handler.run_tests(handed[0], ShortContext(10))
+
+    assert second["status"] == "completed"
+    assert second["checkpoint"]["skipped_stages"] == ["crossvalidation", "A_1"]
+    assert calls == ["A_1", "A_2", "ANOM"]
+    assert scored_stages(s3) == ["ANOM", "A_1", "A_2", "crossvalidation"]
+    # The first invocation released its batch CSVs on hand-off; the diff still covers A_1
+    assert sorted(read_json(s3, DIFF_JSON)["stages"]) == ["ANOM_1", "A_1", "A_2"]
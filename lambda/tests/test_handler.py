@@ -0,0 +1,82 @@
+import io
+import json
+import time
+import threading
+
+import pandas as pd
+
+import handler
+import runner_pool
+from conftest import BUCKET, SAMPLES, run_config, output_keys
+
+
+def read_bytes(s3, key):
+    return s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def read_json(s3, key):
+    return json.loads(read_bytes(s3, key))
+
+
+def test_run_uploads_reports_and_manifest(s3, suite, tmp_path):
+    result = handler.run_tests(run_config(s3, tmp_path))
+
+    assert result["status"] == "completed"
+    keys = output_keys(s3)
+    date = next(k for k in keys if k.startswith("report_Accuracy_")).rsplit("_", 1)[1][:6]
+    assert f"report_Accuracy_it_CE_Consumer_OUT_{date}.xlsx" in keys
+    assert f"report_Anomalie_it_CE_Consumer_OUT_{date}.xlsx" in keys
+    assert f"Accuracy_it_CE_Consumer_OUT_{date}.csv" in keys
+    assert "OLD/NEW_final_report_0000.xlsx" in keys
+    manifest = read_json(s3, "P/it/consumer/output/output_manifest.json")
+    assert "save_reports" in [entry["stage"] for entry in manifest["stages"]]
+    final = pd.read_excel(io.BytesIO(read_bytes(s3, "P/it/consumer/output/OLD/NEW_final_report_0000.xlsx")))
+    assert sorted(final["stage"]) == ["ANOM", "A_1", "A_2", "crossvalidation"]
+    assert result["checkpoint"]["completed_stages"] == ["crossvalidation", "A_1", "A_2", "ANOM_1"]
+
+
+def test_concurrent_stages_run_on_their_own_runners(s3, suite, tmp_path, monkeypatch):
+    lock, active, shared, peak = threading.Lock(), {}, [], [0]
+    original = suite.TestRunner._score
+
+    def score(self, sample, tag, report, save):
+        with lock:
+            if id(self) in active:
+                shared.append(tag)
+            active[id(self)] = tag
+            peak[0] = max(peak[0], len(active))
+        time.sleep(0.3)
+        try:
+            return original(self, sample, tag, report, save)
+        finally:
+            with lock:
+                active.pop(id(self))
+
+    monkeypatch.setattr(suite.TestRunner, "_score", score)
+    config = run_config(s3, tmp_path, vm_pool=[[1, 2], [3, 4]], max_runners=3)
+
+    result = handler.run_tests(config)
+
+    assert result["status"] == "completed"
+    assert shared == [] and peak[0] == 2
+    # Two stages at a time on two VM pairs, crossvalidation next to them: three runners at most
+    assert suite.TestRunner.instances <= 3
+    produced = {entry["stage"]: entry["produced"]
+                for entry in read_json(s3, "P/it/consumer/output/output_manifest.json")["stages"]}
+    assert produced["A_1"] == ["OLD/A_1_ACC.xlsx"]
+    assert produced["A_2"] == ["OLD/A_2_ACC.xlsx"]
+    assert produced["ANOM_1"] == ["OLD/ANOM_ANOM.xlsx"]
+    report = pd.read_excel(io.BytesIO(read_bytes(s3, "P/it/consumer/output/OLD/A_1_ACC.xlsx")))
+    assert list(report["description"]) == SAMPLES["s0.csv"]
+    final = pd.read_excel(io.BytesIO(read_bytes(s3, "P/it/consumer/output/OLD/NEW_final_report_0000.xlsx")))
+    assert sorted(final["stage"]) == ["ANOM", "A_1", "A_2", "crossvalidation"]
+
+
+def test_one_runner_runs_stages_one_at_a_time(s3, suite, tmp_path, monkeypatch):
+    monkeypatch.setattr(runner_pool, "available_memory_bytes", lambda: 100 * runner_pool.metrics.MB)
+    config = run_config(s3, tmp_path, vm_pool=[[1, 2], [3, 4]], runner_memory_mb=90)
+
+    result = handler.run_tests(config)
+
+    assert result["status"] == "completed"
+    assert suite.TestRunner.instances == 1
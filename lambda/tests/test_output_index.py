@@ -0,0 +1,60 @@
+import json
+import os
+
+from output_index import OutputIndex, copy_latest_outputs, model_scope, MANIFEST_NAME
+from conftest import write_file, read_file
+
+
+def test_collect_moves_the_stage_files_and_registers_them(tmp_path):
+    index = OutputIndex(str(tmp_path / "out"))
+    write_file(str(tmp_path / "out" / "OLD" / "earlier_ACC.xlsx"), b"earlier stage")
+    stage = tmp_path / "stage" / "A_1"
+    write_file(str(stage / "OLD" / "A_1_ACC.xlsx"), b"report")
+    write_file(str(stage / "OLD" / "plots" / "a.png"), b"png")
+
+    produced = index.collect(str(stage))
+
+    assert produced == ["OLD/A_1_ACC.xlsx", "OLD/plots/a.png"]
+    assert read_file(index.abs("OLD/A_1_ACC.xlsx")) == b"report"
+    assert not stage.exists()
+    with open(index.export()) as f:
+        # Only what was collected or added: the folder itself is never walked
+        assert sorted(json.load(f)["files"]) == produced
+    assert MANIFEST_NAME not in produced
+
+
+def test_copy_latest_outputs_uses_the_files_recorded_for_the_stage(tmp_path):
+    index = OutputIndex(str(tmp_path / "out"))
+    write_file(index.abs("OLD/A_2_ACC.xlsx"), b"another stage")
+    stage = tmp_path / "stage"
+    write_file(str(stage / "OLD" / "A_1_ACC.xlsx"), b"A_1")
+    write_file(str(stage / "top_ACC.xlsx"), b"not a TestRunner report")
+    produced = index.collect(str(stage))
+    batch = write_file(str(tmp_path / "batch" / "s0_categorized.csv"), b"description\nx\n")
+    events = []
+
+    copies = copy_latest_outputs(index, produced, "Consumer", "ACC", "it", "it_1_new.zip", "250101",
+                                 batch_file=batch, notify=lambda event, name, error=None: events.append((event, name)))
+
+    assert copies == [("OLD/A_1_ACC.xlsx", "report_Accuracy_it_CE_Consumer_IN_250101.xlsx"),
+                      (batch, "Accuracy_it_CE_Consumer_IN_250101.csv")]
+    assert read_file(index.abs("report_Accuracy_it_CE_Consumer_IN_250101.xlsx")) == b"A_1"
+    assert events == [("report", "report_Accuracy_it_CE_Consumer_IN_250101.xlsx"),
+                      ("batch", "Accuracy_it_CE_Consumer_IN_250101.csv")]
+
+
+def test_copy_latest_outputs_without_batch_csv(tmp_path):
+    index = OutputIndex(str(tmp_path / "out"))
+    events = []
+
+    copies = copy_latest_outputs(index, [], "Consumer", "ANOM", "it", "it_0_new.zip", "250101",
+                                 notify=lambda event, name, error=None: events.append((event, name)))
+
+    assert copies == [] and events == [("no_batch", "ANOM")]
+    assert not os.path.exists(index.abs("report_Anomalie_it_CE_Consumer_OUT_250101.xlsx"))
+
+
+def test_model_scope():
+    assert model_scope("it_1_new.zip", "it") == "IN"
+    assert model_scope("it_0_new.zip", "it") == "OUT"
+    assert model_scope("model.zip", "it") == "OUT"
@@ -0,0 +1,150 @@
+import os
+
+import pytest
+
+import s3_transfer
+import handler
+from conftest import BUCKET, put_file, write_file, read_file
+
+# Smallest multipart settings S3 accepts (5 MB parts)
+SMALL_PARTS = dict(multipart_threshold=5 * s3_transfer.MB, multipart_chunksize=5 * s3_transfer.MB)
+
+
+def test_list_prefix_returns_size_and_etag(s3):
+    put_file(s3, "p/a.txt", b"aaa")
+    put_file(s3, "p/sub/b.txt", b"bb")
+    put_file(s3, "other/c.txt", b"c")
+
+    listed = {key: (size, etag) for key, size, etag in s3_transfer.list_prefix(s3, BUCKET, "p/")}
+
+    assert sorted(listed) == ["p/a.txt", "p/sub/b.txt"]
+    assert listed["p/a.txt"][0] == 3
+    assert listed["p/a.txt"][1] == s3.head_object(Bucket=BUCKET, Key="p/a.txt")["ETag"].strip('"')
+
+
+def test_upload_and_download_round_trip(s3, tmp_path):
+    small = write_file(str(tmp_path / "up" / "small.bin"), b"x" * 1000)
+    big = write_file(str(tmp_path / "up" / "big.bin"), os.urandom(11 * s3_transfer.MB))
+    config = s3_transfer.transfer_config(**SMALL_PARTS)
+
+    stats = s3_transfer.upload_files(s3, BUCKET, [(small, "r/small.bin"), (big, "r/big.bin")], config=config)
+    s3_transfer.download_objects(s3, BUCKET, [("r/small.bin", str(tmp_path / "down" / "small.bin")),
+                                              ("r/big.bin", str(tmp_path / "down" / "nested" / "big.bin"))],
+                                 stats=stats, config=config)
+
+    assert read_file(str(tmp_path / "down" / "small.bin")) == read_file(small)
+    assert read_file(str(tmp_path / "down" / "nested" / "big.bin")) == read_file(big)
+    # The big file went up in parts
+    assert s3.head_object(Bucket=BUCKET, Key="r/big.bin")["ETag"].strip('"').endswith("-3")
+    summary = stats.summary()
+    assert summary["upload"]["files"] == 2 and summary["download"]["files"] == 2
+    assert summary["download"]["bytes"] == 1000 + 11 * s3_transfer.MB
+    assert summary["upload"]["errors"] == summary["download"]["errors"] == 0
+
+
+def test_download_failure_is_counted_and_raised(s3, tmp_path):
+    put_file(s3, "ok.txt", b"ok")
+    stats = s3_transfer.TransferStats()
+
+    with pytest.raises(Exception):
+        s3_transfer.download_objects(s3, BUCKET, [("ok.txt", str(tmp_path / "ok.txt")),
+                                                  ("missing.txt", str(tmp_path / "missing.txt"))], stats=stats)
+
+    assert stats.summary()["download"]["errors"] == 1
+    assert read_file(str(tmp_path / "ok.txt")) == b"ok"
+
+
+def test_prefix_download_and_dir_upload(s3, tmp_path):
+    put_file(s3, "it/consumer/sample/a.csv", b"h\n1\n")
+    put_file(s3, "it/consumer/sample/sub/b.csv", b"h\n2\n")
+    put_file(s3, "it/consumer/sample/", b"")          # folder marker
+
+    handler.s3_download_prefix(s3, BUCKET, "it/consumer/sample/", str(tmp_path / "sample"))
+    assert read_file(str(tmp_path / "sample" / "sub" / "b.csv")) == b"h\n2\n"
+
+    handler.s3_upload_dir(s3, BUCKET, str(tmp_path / "sample"), "copy/")
+    keys = sorted(key for key, _size, _etag in s3_transfer.list_prefix(s3, BUCKET, "copy/"))
+    assert keys == ["copy/a.csv", "copy/sub/b.csv"]
+
+
+def test_selective_download_fetches_only_required_objects(s3, tmp_path):
+    base = "it/consumer/"
+    put_file(s3, base + "model/prod/old/weights.bin", b"old")
+    put_file(s3, base + "model/prod/old/vocab.txt", b"v")
+    put_file(s3, base + "model/prod/unused/weights.bin", b"unused")
+    put_file(s3, base + "sample/a.csv", b"a")
+    put_file(s3, base + "sample/a.csv.bak", b"not a")
+
+    handler.s3_download_selected(s3, BUCKET, base, ["model/prod/old", "sample/a.csv"], str(tmp_path))
+
+    found = sorted(os.path.relpath(os.path.join(root, f), tmp_path).replace(os.sep, "/")
+                   for root, _dirs, files in os.walk(tmp_path) for f in files)
+    assert found == ["model/prod/old/vocab.txt", "model/prod/old/weights.bin", "sample/a.csv"]
+
+
+def test_selective_download_reports_every_missing_artifact(s3, tmp_path):
+    put_file(s3, "it/consumer/sample/a.csv", b"a")
+
+    with pytest.raises(FileNotFoundError) as err:
+        handler.s3_download_selected(s3, BUCKET, "it/consumer/", ["sample/a.csv", "sample/b.csv", "model/prod/x"],
+                                     str(tmp_path))
+
+    assert "sample/b.csv" in str(err.value) and "model/prod/x" in str(err.value)
+    assert not os.path.exists(tmp_path / "sample" / "a.csv")
+
+
+def test_file_crc32_matches_what_s3_computes(s3, tmp_path):
+    data = os.urandom(11 * s3_transfer.MB + 17)
+    path = write_file(str(tmp_path / "big.bin"), data)
+    part = 5 * s3_transfer.MB
+
+    s3.upload_file(path, BUCKET, "multi.bin", Config=s3_transfer.transfer_config(**SMALL_PARTS),
+                   ExtraArgs={"ChecksumAlgorithm": "CRC32"})
+    s3.put_object(Bucket=BUCKET, Key="single.bin", Body=data, ChecksumAlgorithm="CRC32")
+
+    full, composite = s3_transfer.file_crc32(path, part)
+    assert composite.endswith("-3")
+    assert s3.head_object(Bucket=BUCKET, Key="single.bin", ChecksumMode="ENABLED")["ChecksumCRC32"] == full
+    remote = s3.head_object(Bucket=BUCKET, Key="multi.bin", ChecksumMode="ENABLED")["ChecksumCRC32"]
+    assert remote.split("-")[0] == composite.split("-")[0]
+    assert s3_transfer.file_crc32(path) == (full, None)
+
+
+def _uploader(s3, folder, **config):
+    return s3_transfer.StreamingUploader(s3, BUCKET, str(folder), "out/",
+                                         config=s3_transfer.transfer_config(**(config or SMALL_PARTS)))
+
+
+def test_streaming_uploader_skips_unchanged_files_and_verifies(s3, tmp_path):
+    small = write_file(str(tmp_path / "out" / "report.xlsx"), b"v1")
+    write_file(str(tmp_path / "out" / "sub" / "big.csv"), os.urandom(6 * s3_transfer.MB))
+    uploader = _uploader(s3, tmp_path / "out")
+
+    uploader.submit(small).result()
+    uploader.submit(small).result()                   # same content: not sent again
+    write_file(small, b"v2")
+    uploader.submit(small).result()
+    uploader.sync()
+    uploader.flush()
+    uploader.close()
+
+    assert [r["key"] for r in uploader.stats.records["upload"]].count("out/report.xlsx") == 2
+    assert s3.get_object(Bucket=BUCKET, Key="out/report.xlsx")["Body"].read() == b"v2"
+    assert uploader.verify() == []
+
+
+def test_verify_uses_the_checksum_s3_computed(s3, tmp_path):
+    small = write_file(str(tmp_path / "out" / "report.xlsx"), b"content")
+    big = write_file(str(tmp_path / "out" / "big.csv"), os.urandom(6 * s3_transfer.MB))
+    uploader = _uploader(s3, tmp_path / "out")
+    uploader.submit(small)
+    uploader.submit(big)
+    uploader.flush()
+    uploader.close()
+    assert uploader.verify() == []
+
+    # Same size, other bytes: only S3's own checksum tells them apart
+    s3.put_object(Bucket=BUCKET, Key="out/report.xlsx", Body=b"CONTENT", ChecksumAlgorithm="CRC32")
+    s3.delete_object(Bucket=BUCKET, Key="out/big.csv")
+
+    assert sorted(uploader.verify()) == ["out/big.csv", "out/report.xlsx"]
@@ -0,0 +1,60 @@
+import pytest
+
+import handler
+from conftest import run_config, put_file, output_keys
+from test_checkpoint import record_calls, scored_stages
+
+STAGES = sorted(["crossvalidation", "A_1", "A_2", "ANOM_1"])
+
+
+def cache_summary(result):
+    """Stage lookups run on worker threads: compare them regardless of order."""
+    return {name: sorted(stages) for name, stages in result["score_cache"].items()}
+
+
+@pytest.fixture
+def cached_config(s3, tmp_path):
+    # No checkpoint: every run computes or restores all its stages
+    return run_config(s3, tmp_path, score_cache=True, score_cache_dir=str(tmp_path / "score_cache"),
+                      checkpoint=False)
+
+
+def test_second_run_restores_every_stage_from_the_cache(s3, suite, tmp_path, monkeypatch, cached_config):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+
+    first = handler.run_tests(cached_config)
+    assert cache_summary(first) == {"hits": [], "misses": STAGES, "stored": STAGES}
+    assert calls == ["A_1", "A_2", "ANOM"]
+    before = output_keys(s3)
+
+    second = handler.run_tests(dict(cached_config, work_root=str(tmp_path / "again")))
+
+    assert second["status"] == "completed"
+    assert cache_summary(second) == {"hits": STAGES, "misses": [], "stored": []}
+    assert calls == ["A_1", "A_2", "ANOM"]
+    assert output_keys(s3) == before
+    assert scored_stages(s3) == ["ANOM", "A_1", "A_2", "crossvalidation"]
+
+
+def test_new_model_misses(s3, suite, tmp_path, monkeypatch, cached_config):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+    handler.run_tests(cached_config)
+
+    put_file(s3, "P/it/consumer/model/develop/it_0_new.zip", b"retrained model")
+    result = handler.run_tests(dict(cached_config, work_root=str(tmp_path / "again")))
+
+    # The key covers the new model too: no stage is reused (see score_cache's docstring)
+    assert result["score_cache"]["hits"] == []
+    assert sorted(calls) == sorted(["A_1", "A_2", "ANOM"] * 2)
+
+
+def test_refresh_recomputes_and_stores_again(s3, suite, tmp_path, monkeypatch, cached_config):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+    handler.run_tests(cached_config)
+
+    result = handler.run_tests(dict(cached_config, score_cache="refresh", work_root=str(tmp_path / "again")))
+
+    assert result["status"] == "completed"
+    assert cache_summary(result) == {"hits": [], "misses": STAGES, "stored": STAGES}
+    assert sorted(calls) == sorted(["A_1", "A_2", "ANOM"] * 2)
+    assert scored_stages(s3) == ["ANOM", "A_1", "A_2", "crossvalidation"]
@@ -0,0 +1,78 @@
+import io
+
+import pandas as pd
+
+import handler
+import sharding
+from conftest import SAMPLES, run_config, output_keys
+from test_checkpoint import FINAL_REPORT, record_calls
+from test_handler import read_bytes, read_json
+
+HOOK = "suite_tests.testRunner:shard_metrics"
+
+
+def sharded_config(s3, tmp_path, **overrides):
+    """s0.csv (5 rows) as the only accuracy sample, split in shards on two VM pairs."""
+    settings = dict(sample_files={"accuracy": ["s0.csv"]}, shard_min_rows=3, vm_pool=[[1, 2], [3, 4]], max_runners=3)
+    return run_config(s3, tmp_path, **dict(settings, **overrides))
+
+
+def final_scores(s3):
+    final = pd.read_excel(io.BytesIO(read_bytes(s3, FINAL_REPORT)))
+    return {row["stage"]: row for _i, row in final.iterrows()}
+
+
+def test_merge_deltas_leaves_per_shard_values_unresolved():
+    rows_a, rows_b = pd.DataFrame({"x": [1, 2, 3]}), pd.DataFrame({"x": [4, 5]})
+    deltas = [{"set": {"label": "it"}, "dict": {"predictions": {"A_1": rows_a}, "scores": {"A_1": {"rows": 3}}},
+               "list": {"calls": ["A_1"]}},
+              {"set": {"label": "it"}, "dict": {"predictions": {"A_1": rows_b}, "scores": {"A_1": {"rows": 2}}},
+               "list": {"calls": ["A_1"]}}]
+
+    merged, unresolved = sharding.merge_deltas(deltas, 5, {"label": "it", "predictions": {}, "scores": {}})
+
+    assert merged["set"] == {"label": "it"}
+    assert list(merged["dict"]["predictions"]["A_1"]["x"]) == [1, 2, 3, 4, 5]
+    assert unresolved == [("dict", "scores", "A_1"), ("list", "calls", None)]
+
+
+def test_shard_metrics_rebuild_the_stage_without_a_rerun(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+
+    result = handler.run_tests(sharded_config(s3, tmp_path, shard_metrics=HOOK))
+
+    assert result["status"] == "completed"
+    # Two shards, no whole-stage rerun
+    assert calls == ["A_1", "A_1"]
+    assert final_scores(s3)["A_1"]["rows"] == len(SAMPLES["s0.csv"])
+    # Report written by save_reports from the merged rows
+    report = pd.read_excel(io.BytesIO(read_bytes(s3, "P/it/consumer/output/OLD/A_1_ACC.xlsx")))
+    assert list(report["description"]) == SAMPLES["s0.csv"]
+    batch = next(k for k in output_keys(s3) if k.startswith("Accuracy_") and k.endswith(".csv"))
+    merged = pd.read_csv(io.BytesIO(read_bytes(s3, f"P/it/consumer/output/{batch}")))
+    assert list(merged["description"]) == SAMPLES["s0.csv"]
+    manifest = read_json(s3, "P/it/consumer/output/output_manifest.json")
+    assert next(e for e in manifest["stages"] if e["stage"] == "A_1")["produced"] == ["OLD/A_1_ACC.xlsx"]
+
+
+def test_without_shard_metrics_the_stage_runs_whole(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+
+    result = handler.run_tests(sharded_config(s3, tmp_path))
+
+    assert result["status"] == "completed"
+    assert calls == ["A_1", "A_1", "A_1"]
+    assert final_scores(s3)["A_1"]["rows"] == len(SAMPLES["s0.csv"])
+
+
+def test_shards_share_the_runner_pool(s3, suite, tmp_path, monkeypatch):
+    calls = record_calls(monkeypatch, suite.TestRunner)
+    config = sharded_config(s3, tmp_path, shard_metrics=HOOK, vm_pool=[[1, 2], [3, 4], [5, 6]], max_runners=2)
+
+    result = handler.run_tests(config)
+
+    assert result["status"] == "completed"
+    # Shards as many as the runners that fit, never a model load of their own
+    assert calls == ["A_1", "A_1"]
+    assert suite.TestRunner.instances <= 2
+    assert final_scores(s3)["A_1"]["rows"] == len(SAMPLES["s0.csv"])
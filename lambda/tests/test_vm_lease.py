@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+import vm_lease
+from conftest import BUCKET
+
+
+@pytest.fixture(params=["local", "s3"])
+def store(request, tmp_path):
+    if request.param == "local":
+        return vm_lease.LocalLeaseStore(str(tmp_path / "leases"))
+    s3 = request.getfixturevalue("s3")
+    store = vm_lease.S3LeaseStore(s3, BUCKET, "vm_leases/")
+    store.check()
+    return store
+
+
+def leases(store, owner, ttl_s=60):
+    return vm_lease.VMLeases(store, owner, ttl_s=ttl_s)
+
+
+def test_acquire_is_exclusive_until_released(store):
+    first, second = leases(store, "run-a"), leases(store, "run-b")
+
+    assert first.acquire((1, 2))
+    assert not second.acquire((1, 2))
+    assert not second.acquire((2, 3))          # all or nothing: VM 3 is not kept
+    assert first.holder(3) is None
+    assert second.contended == 2
+
+    first.release((1, 2))
+    assert second.acquire((2, 3))
+    assert first.holder(2) == "run-b"
+    second.close()
+    assert first.holder(2) is None and first.holder(3) is None
+
+
+def test_same_run_does_not_lease_a_vm_twice(store):
+    run = leases(store, "run-a")
+    assert run.acquire((1, 2))
+    assert not run.acquire((2, 3))
+    run.close()
+
+
+def test_renew_extends_the_lease(store):
+    run = leases(store, "run-a", ttl_s=60)
+    assert run.acquire((1, 2))
+    before = store.get(1)[0]["expires"]
+    time.sleep(0.01)
+
+    run.renew()
+
+    assert store.get(1)[0]["expires"] > before
+    assert run.summary()["held"] == [1, 2]
+    run.close()
+
+
+def test_expired_lease_is_taken_over_and_lost_by_its_owner(store):
+    crashed = leases(store, "crashed", ttl_s=0.01)
+    assert crashed.acquire((1, 2))
+    time.sleep(0.05)
+
+    taker = leases(store, "taker")
+    assert taker.acquire((1, 2))
+    assert taker.holder(1) == "taker"
+
+    # The old owner's renewal finds another token: the lease is dropped, not overwritten
+    crashed.renew()
+    assert crashed.summary()["held"] == []
+    assert taker.holder(1) == "taker"
+    crashed.close()
+    assert taker.holder(1) == "taker"
+    taker.close()
+
+
+def test_live_lease_of_another_run_is_not_taken_over(store):
+    holder = leases(store, "holder", ttl_s=60)
+    assert holder.acquire((1, 2))
+    assert not leases(store, "other").acquire((1, 2))
+    assert holder.holder(1) == "holder"
+    holder.close()
+
+
+class _BrokenStore(vm_lease.LocalLeaseStore):
+    """Store that fails on the second VM of a pair."""
+
+    def create(self, vm, record):
+        if vm == 2:
+            raise OSError("store down")
+        return super().create(vm, record)
+
+
+def test_store_failure_raises_and_releases_what_was_taken(tmp_path):
+    store = _BrokenStore(str(tmp_path / "leases"))
+    run = leases(store, "run-a")
+
+    with pytest.raises(vm_lease.LeaseStoreError):
+        run.acquire((1, 2))
+
+    assert store.get(1) == (None, None)
+    assert run.summary()["held"] == []
+
+
+def test_check_rejects_a_client_without_conditional_writes(s3, monkeypatch):
+    store = vm_lease.S3LeaseStore(s3, BUCKET)
+    monkeypatch.setitem(vm_lease._CONDITIONAL_PARAMS, "PutObject", ("IfNoneMatch", "IfNotAParameter"))
+
+    with pytest.raises(vm_lease.LeaseStoreError):
+        store.check()
+
+
+def test_open_leases_picks_the_configured_store(s3, tmp_path):
+    assert vm_lease.open_leases({"vm_lease": False}) is None
+    local = vm_lease.open_leases({"vm_lease_store": "local", "vm_lease_dir": str(tmp_path)})
+    assert isinstance(local.store, vm_lease.LocalLeaseStore)
+    remote = vm_lease.open_leases({}, s3, BUCKET, "runs/")
+    assert isinstance(remote.store, vm_lease.S3LeaseStore) and remote.store.prefix == "runs/vm_leases/"
+    with pytest.raises(ValueError):
+        vm_lease.open_leases({"vm_lease_store": "s3"})
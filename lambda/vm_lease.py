@@ -0,0 +1,362 @@
+"""
+Leases on the Azure Batch VMs, shared by every run.
+
+Two runs submitting to the same vm_for_bench / vm_for_dev collide on the VM,
+and today the loser only finds out from the "Virtual machine is already
+running" text, minutes later. Before a stage is sent to a VM pair the
+scheduler now acquires a lease on both VMs: a small record (owner, expiry)
+written with a compare-and-swap, so at most one run holds a VM at a time.
+
+  S3LeaseStore     one object per VM under <prefix>, created with If-None-Match
+                   and renewed / taken over / deleted with If-Match on its ETag
+                   (S3 conditional writes), for Lambda and dashboards sharing VMs
+  LocalLeaseStore  one JSON file per VM in a folder, read-modify-write under an
+                   exclusive lock file, for runs on one machine and for tests
+
+Leases expire after ttl seconds and are renewed by a heartbeat thread every
+ttl / 3, so a run that crashes (or a Lambda that times out) frees its VMs once
+the TTL runs out; a normal run releases them when each stage finishes and at
+close(). A run that finds a pair leased by someone else leaves it resting and
+tries another pair, or waits (StageScheduler). A configured store that cannot
+be used (no access, or a boto3 too old for conditional writes: boto3 >= 1.36)
+is an error, never a silent fallback to unleased VMs.
+
+Config:
+  vm_lease          false disables leasing (default on)
+  vm_lease_store    "s3" or "local" (default: s3 when the run has an S3 bucket)
+  vm_lease_bucket   bucket of the S3 store (default s3_bucket)
+  vm_lease_prefix   key prefix of the S3 store (default "<s3_prefix>vm_leases/")
+  vm_lease_dir      folder of the local store (default /tmp/vm_leases)
+  vm_lease_ttl_s    lease duration (default 300)
+  vm_lease_wait_s   how long a stage may wait for a free pair before failing (default 3600)
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_S = 300
+DEFAULT_WAIT_S = 3600
+DEFAULT_LOCAL_DIR = os.environ.get("VM_LEASE_DIR", "/tmp/vm_leases")
+
+# A lock file older than this belongs to a process that died inside the critical section
+LOCK_STALE_S = 30
+
+_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+_MISSING_CODES = ("NoSuchKey", "404", "NotFound")
+
+
+# S3 conditional writes used by S3LeaseStore (boto3 / botocore >= 1.36)
+_CONDITIONAL_PARAMS = {"PutObject": ("IfNoneMatch", "IfMatch"), "DeleteObject": ("IfMatch",)}
+
+
+class LeaseStoreError(RuntimeError):
+    pass
+
+
+def _error_code(e):
+    return str(getattr(e, "response", {}).get("Error", {}).get("Code", ""))
+
+
+def default_owner(label=""):
+    """Owner id of this run: host, process and a random suffix."""
+    return f"{label + '@' if label else ''}{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# ============================================================
+#  STORES
+# ============================================================
+# get(vm) -> (record, token); create / replace return the new token, or None
+# when another writer got there first.
+
+class LocalLeaseStore:
+
+    def __init__(self, folder=None):
+        self.folder = folder or DEFAULT_LOCAL_DIR
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, vm):
+        return os.path.join(self.folder, f"vm_{vm}.json")
+
+    def _locked(self, vm):
+        store = self
+
+        class _Lock:
+            def __enter__(self):
+                self.path = store._path(vm) + ".lock"
+                deadline = time.monotonic() + LOCK_STALE_S
+                while True:
+                    try:
+                        os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                        return self
+                    except FileExistsError:
+                        try:
+                            if time.time() - os.path.getmtime(self.path) > LOCK_STALE_S:
+                                os.remove(self.path)
+                                continue
+                        except OSError:
+                            continue
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f"VM lease lock {self.path} held too long")
+                        time.sleep(0.05)
+
+            def __exit__(self, *exc):
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+        return _Lock()
+
+    def _read(self, vm):
+        try:
+            with open(self._path(vm), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        return record, record.get("token")
+
+    def _write(self, vm, record):
+        record = dict(record, token=uuid.uuid4().hex)
+        tmp = f"{self._path(vm)}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp, self._path(vm))
+        return record["token"]
+
+    def get(self, vm):
+        with self._locked(vm):
+            return self._read(vm)
+
+    def create(self, vm, record):
+        with self._locked(vm):
+            if self._read(vm)[0] is not None:
+                return None
+            return self._write(vm, record)
+
+    def replace(self, vm, record, token):
+        with self._locked(vm):
+            if self._read(vm)[1] != token:
+                return None
+            return self._write(vm, record)
+
+    def delete(self, vm, token):
+        with self._locked(vm):
+            if self._read(vm)[1] != token:
+                return False
+            os.remove(self._path(vm))
+            return True
+
+
+class S3LeaseStore:
+
+    def __init__(self, s3, bucket, prefix="vm_leases/"):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, vm):
+        return f"{self.prefix}vm_{vm}.json"
+
+    def check(self):
+        """Raise LeaseStoreError when the client cannot send conditional writes."""
+        try:
+            model = self.s3.meta.service_model
+        except AttributeError:
+            return                          # not a botocore client (tests)
+        for operation, params in _CONDITIONAL_PARAMS.items():
+            members = model.operation_model(operation).input_shape.members
+            missing = [p for p in params if p not in members]
+            if missing:
+                import botocore
+                raise LeaseStoreError(f"botocore {botocore.__version__} has no {operation} {', '.join(missing)}: "
+                                      f"the S3 lease store needs boto3 >= 1.36")
+
+    def get(self, vm):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._key(vm))
+        except Exception as e:
+            if _error_code(e) in _MISSING_CODES:
+                return None, None
+            raise
+        return json.loads(obj["Body"].read()), obj["ETag"]
+
+    def _put(self, vm, record, **condition):
+        try:
+            resp = self.s3.put_object(Bucket=self.bucket, Key=self._key(vm), Body=json.dumps(record).encode("utf-8"),
+                                      ContentType="application/json", **condition)
+        except Exception as e:
+            if _error_code(e) in _CONFLICT_CODES:
+                return None
+            raise
+        return resp["ETag"]
+
+    def create(self, vm, record):
+        return self._put(vm, record, IfNoneMatch="*")
+
+    def replace(self, vm, record, token):
+        return self._put(vm, record, IfMatch=token)
+
+    def delete(self, vm, token):
+        try:
+            self.s3.delete_object(Bucket=self.bucket, Key=self._key(vm), IfMatch=token)
+        except Exception as e:
+            if _error_code(e) in _CONFLICT_CODES + _MISSING_CODES:
+                return False
+            raise
+        return True
+
+
+# ============================================================
+#  LEASES
+# ============================================================
+
+class VMLeases:
+    """Leases held by one run, renewed in the background until released."""
+
+    def __init__(self, store, owner=None, ttl_s=DEFAULT_TTL_S, wait_s=DEFAULT_WAIT_S):
+        self.store = store
+        self.owner = owner or default_owner()
+        self.ttl_s = ttl_s
+        self.wait_s = wait_s
+        self._held = {}          # vm -> token
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.contended = 0       # acquisitions refused because another run held a VM
+
+    def _record(self):
+        now = time.time()
+        return {"owner": self.owner, "acquired": now, "expires": now + self.ttl_s}
+
+    def _acquire_one(self, vm):
+        with self._lock:
+            if vm in self._held:
+                return None                     # in use by another stage of this run
+        record, token = self.store.get(vm)
+        if record is None:
+            new_token = self.store.create(vm, self._record())
+        elif record.get("owner") == self.owner or record.get("expires", 0) < time.time():
+            if record.get("owner") != self.owner:
+                logger.warning(f"VM {vm}: taking over the expired lease of {record.get('owner')}")
+            new_token = self.store.replace(vm, self._record(), token)
+        else:
+            return None
+        return new_token
+
+    def acquire(self, slot):
+        """
+        Lease every VM of slot (a (bench, dev) pair); all or nothing. True when leased.
+        A store failure raises LeaseStoreError: the run never submits to a VM it could not lease.
+        """
+        taken = []
+        for vm in dict.fromkeys(slot):
+            try:
+                token = self._acquire_one(vm)
+            except Exception as e:
+                for held_vm, held_token in taken:
+                    self._delete(held_vm, held_token)
+                raise LeaseStoreError(f"VM {vm}: lease store unavailable ({e})") from e
+            if token is None:
+                for held_vm, held_token in taken:
+                    self._delete(held_vm, held_token)
+                with self._lock:
+                    self.contended += 1
+                return False
+            taken.append((vm, token))
+        if taken:
+            with self._lock:
+                self._held.update(taken)
+            self._ensure_heartbeat()
+            logger.info(f"VMs {[vm for vm, _token in taken]} leased by {self.owner}")
+        return True
+
+    def holder(self, vm):
+        record, _token = self.store.get(vm)
+        if record is None or record.get("expires", 0) < time.time():
+            return None
+        return record.get("owner")
+
+    def _delete(self, vm, token):
+        try:
+            self.store.delete(vm, token)
+        except Exception as e:
+            logger.warning(f"VM {vm}: could not release lease ({e}), it expires in {self.ttl_s}s")
+
+    def release(self, slot):
+        for vm in dict.fromkeys(slot):
+            with self._lock:
+                token = self._held.pop(vm, None)
+            if token is not None:
+                self._delete(vm, token)
+
+    def renew(self):
+        """Extend every held lease; a lease lost to another run is dropped (and logged)."""
+        with self._lock:
+            held = dict(self._held)
+        for vm, token in held.items():
+            try:
+                new_token = self.store.replace(vm, self._record(), token)
+            except Exception as e:
+                logger.warning(f"VM {vm}: lease renewal failed ({e})")
+                continue
+            with self._lock:
+                if vm not in self._held:
+                    continue                    # released meanwhile
+                if new_token is None:
+                    logger.error(f"VM {vm}: lease lost (expired and taken by another run)")
+                    del self._held[vm]
+                else:
+                    self._held[vm] = new_token
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._beat, name="vm-lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(max(1.0, self.ttl_s / 3)):
+            self.renew()
+
+    def close(self):
+        """Stop renewing and release every lease still held."""
+        self._stop.set()
+        with self._lock:
+            held = list(self._held.items())
+            self._held.clear()
+        for vm, token in held:
+            self._delete(vm, token)
+
+    def summary(self):
+        with self._lock:
+            return {"owner": self.owner, "held": sorted(self._held, key=str), "contended": self.contended}
+
+
+def open_leases(config, s3=None, bucket=None, prefix="", owner_label=""):
+    """
+    VMLeases for a run, or None when vm_lease is off. s3 / bucket / prefix are the
+    run's S3 client and location, used when the store is "s3".
+    """
+    if not config.get("vm_lease", True):
+        return None
+    bucket = config.get("vm_lease_bucket") or bucket
+    kind = config.get("vm_lease_store") or ("s3" if s3 is not None and bucket else "local")
+    if kind == "s3":
+        if s3 is None or not bucket:
+            raise ValueError("vm_lease_store s3 needs an S3 bucket")
+        store = S3LeaseStore(s3, bucket, config.get("vm_lease_prefix") or f"{prefix}vm_leases/")
+        store.check()
+    elif kind == "local":
+        store = LocalLeaseStore(config.get("vm_lease_dir"))
+    else:
+        raise ValueError(f"Unknown vm_lease_store: {kind} (s3 or local)")
+    return VMLeases(store, default_owner(owner_label), ttl_s=config.get("vm_lease_ttl_s", DEFAULT_TTL_S),
+                    wait_s=config.get("vm_lease_wait_s", DEFAULT_WAIT_S))
@@ -0,0 +1,134 @@
+"""
+Cold-start helpers for the Lambda handler.
+
+handler.py itself only imports the standard library and the small helper
+modules next to it; boto3, the TestRunner and everything it pulls in
+(CategorizationEnginePython, TensorFlow, scikit-learn, the .NET runtime) are
+imported on first use. A {"mode": "warmup"} event does that first use ahead of
+time: it imports the runner modules, loads the .NET bridge and creates the S3
+client, so the next real invocation on the same container starts hot.
+
+{"mode": "profile_imports"} runs the same imports in a fresh interpreter with
+-X importtime and reports the most expensive modules.
+"""
+
+import os
+import sys
+import time
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+RUNNER_MODULES = ("suite_tests.testRunner", "suite_tests.testRunner_tagger")
+
+_warm = {}   # step -> seconds, for the steps already done in this container
+
+
+def ce_paths(config):
+    """sys.path entries for CategorizationEnginePython (config ce_python_path, or CE_PYTHON_PATH)."""
+    ce_path = config.get("ce_python_path") or os.environ.get("CE_PYTHON_PATH")
+    if not ce_path:
+        return []
+    return [ce_path, os.path.join(ce_path, "CategorizationEngineTests", "CETestSuite")]
+
+
+def add_ce_paths(config):
+    for p in ce_paths(config):
+        if p not in sys.path:
+            sys.path.insert(0, p)
+            logger.info(f"Added to sys.path: {p}")
+
+
+def _step(name, fn):
+    if name in _warm:
+        return {"seconds": 0.0, "status": "already_warm"}
+    t0 = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        logger.warning(f"Warmup step {name} failed: {e}")
+        return {"seconds": round(time.perf_counter() - t0, 3), "status": "error", "error": str(e)}
+    seconds = _warm[name] = round(time.perf_counter() - t0, 3)
+    return {"seconds": seconds, "status": "ok"}
+
+
+def _init_dotnet():
+    # CategorizationEnginePython adds its assemblies while being imported; this only makes
+    # sure the CLR is loaded (honouring PYTHONNET_RUNTIME) when the runner import did not.
+    if "clr" not in sys.modules:
+        import clr  # noqa: F401
+
+
+def warmup(config, get_s3):
+    """Import the runner modules, load the CLR and create the S3 client; get_s3(config) builds the client."""
+    add_ce_paths(config)
+    t0 = time.perf_counter()
+    steps = {}
+    for module in config.get("warmup_modules") or RUNNER_MODULES:
+        steps[f"import {module}"] = _step(f"import {module}", lambda m=module: __import__(m))
+    steps["dotnet"] = _step("dotnet", _init_dotnet)
+    steps["s3_client"] = _step("s3_client", lambda: get_s3(config))
+    result = {
+        "status": "warm" if all(st["status"] != "error" for st in steps.values()) else "partial",
+        "seconds": round(time.perf_counter() - t0, 3),
+        "steps": steps,
+        "modules_loaded": len(sys.modules),
+    }
+    logger.info(f"Warmup done in {result['seconds']}s")
+    return result
+
+
+# ============================================================
+#  IMPORT PROFILE
+# ============================================================
+
+def parse_importtime(text):
+    """Parse -X importtime output into [{module, self_ms, cumulative_ms}]."""
+    rows = []
+    for line in text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue   # header line
+        rows.append({
+            "module": parts[2].strip(),
+            "self_ms": round(int(parts[0]) / 1000, 1),
+            "cumulative_ms": round(int(parts[1]) / 1000, 1),
+        })
+    return rows
+
+
+def profile_imports(config, top=20):
+    """
+    Import the runner modules in a child interpreter with -X importtime and return the top
+    modules by cumulative and by self time. The child starts cold even on a warm container;
+    it needs as much memory as the imports themselves.
+    """
+    modules = config.get("warmup_modules") or RUNNER_MODULES
+    code = "\n".join(f"import {m}" for m in modules)
+    if config.get("profile_dotnet", True):
+        code += "\ntry:\n    import clr\nexcept ImportError:\n    pass"
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(ce_paths(config) + [p for p in sys.path if p])
+
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, capture_output=True, text=True)
+    seconds = round(time.perf_counter() - t0, 3)
+    rows = parse_importtime(proc.stderr)
+    errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+
+    result = {
+        "status": "ok" if proc.returncode == 0 else "error",
+        "seconds": seconds,
+        "modules": len(rows),
+        "top_cumulative": sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top],
+        "top_self": sorted(rows, key=lambda r: r["self_ms"], reverse=True)[:top],
+    }
+    if proc.returncode != 0:
+        result["error"] = "\n".join(errors[-20:])
+    for row in result["top_self"][:10]:
+        logger.info(f"import {row['module']}: {row['self_ms']} ms self, {row['cumulative_ms']} ms cumulative")
+    return result